@@ -0,0 +1,114 @@
+import threading
+import time
+
+# Idle connections kept per database
+POOL_SIZE = 10
+# Connections older than this many seconds are replaced (below MySQL's wait_timeout)
+POOL_RECYCLE = 3600
+# Connections idle for longer than this many seconds are pinged before reuse
+POOL_PING_AFTER = 10
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    # Process wide set of idle DB-API connections for one database alias. Any
+    # thread can check a connection out, so DRF views, database_sync_to_async
+    # calls of the consumers and the message pipeline all reuse the same
+    # connections instead of opening one each.
+    def __init__(self, size=POOL_SIZE, recycle=POOL_RECYCLE, ping_after=POOL_PING_AFTER):
+        self.size = size
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self.lock = threading.Lock()
+        self.idle = []
+        self.created = {}
+
+    def checkout(self):
+        now = time.monotonic()
+        while True:
+            with self.lock:
+                if not self.idle:
+                    return None
+                connection, returned_at = self.idle.pop()
+            if now - self.created[id(connection)] > self.recycle:
+                self.discard(connection)
+            elif now - returned_at > self.ping_after and not self.ping(connection):
+                self.discard(connection)
+            else:
+                return connection
+
+    def checkin(self, connection):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((connection, time.monotonic()))
+                return
+        self.discard(connection)
+
+    def track(self, connection):
+        self.created[id(connection)] = time.monotonic()
+        return connection
+
+    def discard(self, connection):
+        self.created.pop(id(connection), None)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def ping(connection):
+        try:
+            cursor = connection.cursor()
+            try:
+                cursor.execute('SELECT 1')
+            finally:
+                cursor.close()
+        except Exception:
+            return False
+        return True
+
+
+def get_pool(alias, settings_dict):
+    with pools_lock:
+        if alias not in pools:
+            options = settings_dict.get('POOL_OPTIONS', {})
+            pools[alias] = ConnectionPool(size=options.get('SIZE', POOL_SIZE),
+                                          recycle=options.get('RECYCLE', POOL_RECYCLE),
+                                          ping_after=options.get('PING_AFTER', POOL_PING_AFTER))
+        return pools[alias]
+
+
+class PooledDatabaseWrapperMixin:
+    # Django opens a connection per thread and closes it at the end of every
+    # request (CONN_MAX_AGE = 0). With this mixin "opening" takes a health
+    # checked connection from the pool and "closing" hands it back, rolled back
+    # to a clean state.
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.settings_dict)
+
+    def get_new_connection(self, conn_params):
+        connection = self.pool.checkout()
+        if connection is None:
+            connection = self.pool.track(super().get_new_connection(conn_params))
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        if self.in_atomic_block or self.errors_occurred:
+            # Django keeps using a connection closed inside atomic(), and closes
+            # one that failed when close_if_unusable_or_obsolete() finds it
+            # unusable: neither can be shared
+            self.pool.discard(self.connection)
+            return
+        if not self.get_autocommit():
+            try:
+                with self.wrap_database_errors:
+                    self.connection.rollback()
+            except Exception:
+                self.pool.discard(self.connection)
+                raise
+        self.pool.checkin(self.connection)
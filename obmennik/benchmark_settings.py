@@ -0,0 +1,36 @@
+# Settings for `manage.py benchmark_api`: a throwaway SQLite file, the
+# in-process channel layer and a local memory cache, so a run needs neither
+# MySQL nor Redis
+from obmennik.settings import *  # noqa: F401,F403
+from obmennik.settings import BASE_DIR
+
+DEBUG = False
+ALLOWED_HOSTS = ['localhost']
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'obmennik.backends.sqlite3',
+        'NAME': BASE_DIR / 'benchmark.sqlite3',
+        'OPTIONS': {
+            'timeout': 30,
+        },
+    }
+}
+
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': "channels.layers.InMemoryChannelLayer"
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# The commands import the ASGI application before they create their rows
+WARM_ORDER_BOOKS = False
+
+# Endpoints over their query budget are reported by the benchmark, not failed
+QUERY_BUDGET_STRICT = False
@@ -0,0 +1,75 @@
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class Histogram:
+    # Cumulative Prometheus histogram keyed by a tuple of label values. An
+    # observation is a bisect and a few additions under a lock.
+    def __init__(self, name, documentation, label_names, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = label_names
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def format_labels(self, labels, extra=()):
+        pairs = list(zip(self.label_names, labels)) + list(extra)
+        return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                        for name, value in pairs)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} histogram'.format(self.name)]
+        with self.lock:
+            series = {labels: (list(counts), count, total) for labels, (counts, count, total) in self.series.items()}
+        for labels, (counts, count, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append('{}_bucket{{{}}} {}'.format(self.name, self.format_labels(labels, [('le', bound)]),
+                                                         cumulative))
+            lines.append('{}_count{{{}}} {}'.format(self.name, self.format_labels(labels), count))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, self.format_labels(labels), total))
+        return lines
+
+
+class Metrics:
+    # In-process aggregator, one per worker; render() gives the Prometheus text
+    # exposition served at metrics/
+    def __init__(self):
+        self.request_seconds = Histogram('http_request_duration_seconds', 'Request latency by route',
+                                         ('route', 'method'), LATENCY_BUCKETS)
+        self.request_queries = Histogram('http_request_queries', 'SQL queries per request by route',
+                                         ('route', 'method'), QUERY_BUCKETS)
+        self.request_query_seconds = Histogram('http_request_query_seconds', 'SQL time per request by route',
+                                               ('route', 'method'), LATENCY_BUCKETS)
+        self.response_bytes = Histogram('http_response_bytes', 'Response body size by route',
+                                        ('route', 'method'), BYTES_BUCKETS)
+        self.ws_event_seconds = Histogram('ws_event_duration_seconds',
+                                          'Time for a socket to handle a channel layer event and send its frames',
+                                          ('event',), LATENCY_BUCKETS)
+        self.histograms = [self.request_seconds, self.request_queries, self.request_query_seconds,
+                           self.response_bytes, self.ws_event_seconds]
+
+    def render(self):
+        lines = []
+        for histogram in self.histograms:
+            lines.extend(histogram.render())
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
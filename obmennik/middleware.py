@@ -0,0 +1,92 @@
+import logging
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+from obmennik.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryCounter:
+    # execute_wrapper that counts the queries run on a connection and their time
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.seconds += time.perf_counter() - started
+
+
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    with ExitStack() as stack:
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(counter))
+        yield counter
+
+
+@contextmanager
+def query_budget(budget, label='Block'):
+    # For tests and benchmarks: fails if the block runs more than `budget` queries
+    with count_queries() as counter:
+        yield counter
+    if counter.count > budget:
+        raise QueryBudgetExceeded('{} ran {} queries, the budget is {}'.format(label, counter.count, budget))
+
+
+class QueryBudgetMiddleware:
+    # Checks every request against settings.QUERY_BUDGETS, a map of URL route to
+    # the most queries that endpoint may run. Unlike DEBUG query logging it
+    # also counts in production. An endpoint over budget is logged, or fails the
+    # request when QUERY_BUDGET_STRICT is on, as it is for the test suite
+    # (obmennik.test_settings) so that CI catches per-row query regressions.
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with count_queries() as counter:
+            response = self.get_response(request)
+
+        # Settings are read per request so that tests can override them
+        route = request.resolver_match.route if request.resolver_match else None
+        budget = getattr(settings, 'QUERY_BUDGETS', {}).get(route, None)
+        if budget is not None and counter.count > budget:
+            message = '{} ran {} queries, the budget is {}'.format(route, counter.count, budget)
+            if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
+        return response
+
+
+class MetricsMiddleware:
+    # Records latency, SQL query count and time, and response size per route
+    # into obmennik.metrics
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        with count_queries() as counter:
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        labels = (request.resolver_match.route if request.resolver_match else 'unmatched', request.method)
+        metrics.request_seconds.observe(labels, elapsed)
+        metrics.request_queries.observe(labels, counter.count)
+        metrics.request_query_seconds.observe(labels, counter.seconds)
+        if not response.streaming:
+            metrics.response_bytes.observe(labels, len(response.content))
+        return response
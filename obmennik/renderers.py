@@ -0,0 +1,43 @@
+import json
+from datetime import datetime
+
+from rest_framework.renderers import BaseRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def format_datetime(value: datetime):
+    # Same text as strftime('%Y-%m-%d %H:%M:%S'), several times faster
+    return value.isoformat(sep=' ', timespec='seconds')[:19]
+
+
+def default(value):
+    if isinstance(value, datetime):
+        return format_datetime(value)
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(value).__name__))
+
+
+def dumps(data):
+    # Compact UTF-8 JSON bytes; orjson when it is installed, the json module otherwise
+    if orjson is not None:
+        return orjson.dumps(data, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, default=default, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def dumps_text(data):
+    return dumps(data).decode()
+
+
+class FastJSONRenderer(BaseRenderer):
+    # Drop-in for rest_framework.renderers.JSONRenderer on top of dumps()
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return dumps(data)
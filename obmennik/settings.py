@@ -45,11 +45,27 @@ INSTALLED_APPS = [
 ASGI_APPLICATION = "offer.routing.application" #routing.py will handle the ASGI
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': "channels.layers.InMemoryChannelLayer"
+        'BACKEND': "offer.layers.ShardedRedisChannelLayer",
+        'CONFIG': {
+            # One URL per shard, every ASGI worker has to list the same shards
+            'hosts': ['redis://0.0.0.0:6380/0'],
+            # A burst of writes must not overflow a worker's index listener (offer.indexfeed)
+            'channel_capacity': {'index.*': 10000},
         }
     }
+}
+
+# Presence, the currency catalogue version, book feed sequence numbers and
+# response cache versions live here, so every worker must use the same server
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': 'redis://0.0.0.0:6380/1',
+    }
+}
 
 MIDDLEWARE = [
+    'obmennik.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,6 +73,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'obmennik.middleware.QueryBudgetMiddleware',
 ]
 
 ROOT_URLCONF = 'obmennik.urls'
@@ -84,7 +101,8 @@ TEMPLATES = [
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.mysql',
+        # django.db.backends.mysql with a process wide connection pool
+        'ENGINE': 'obmennik.backends.mysql',
         'NAME': 'obmennik_db',
         'USER': 'diazzzu',
         'PASSWORD': 'pass1234',
@@ -93,10 +111,59 @@ DATABASES = {
         'OPTIONS': {
             'init_command': "SET sql_mode='STRICT_TRANS_TABLES'",
             'charset': 'utf8mb4'
+        },
+        'POOL_OPTIONS': {
+            'SIZE': 10,
+            'RECYCLE': 3600,
+            'PING_AFTER': 10,
         }
     }
 }
 
+# Load the order books (offer.orderbook) when the ASGI application starts
+# rather than on the first match request
+WARM_ORDER_BOOKS = True
+
+# Most queries each endpoint may run, enforced by QueryBudgetMiddleware. None
+# of them may grow with the number of rows involved.
+QUERY_BUDGETS = {
+    'user/create/': 2,
+    'user/getOffers/': 3,
+    'user/watchlist/': 3,
+    'user/addWatchlist/': 5,
+    'user/removeWatchlist/': 3,
+    'user/addWatchlistBulk/': 5,
+    'user/removeWatchlistBulk/': 3,
+    'user/rename/': 3,
+    'user/info/': 1,
+    'user/updateRating/': 6,
+    'currency/getList/': 1,
+    'currency/add/': 6,
+    'offer/create/': 6,
+    'offer/getList/': 3,
+    'offer/book/': 3,
+    'offer/match/': 4,
+    'offer/edit/': 6,
+    # offer/bulk/ has none: without RETURNING (MySQL) every created offer is its own INSERT
+    'session/create/': 18,
+    'session/sendMessage/': 7,
+    'session/messages/': 2,
+    'session/export/': 0,
+    'session/markRead/': 1,
+    'session/list/': 7,
+    'session/close/': 14,
+    'search/': 5,
+    'metrics/': 0,
+}
+
+# orjson backed when it is installed; the browsable API stays for DEBUG use
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'obmennik.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ]
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -0,0 +1,31 @@
+# Settings for `manage.py test`: SQLite, the in-process channel layer and a
+# local memory cache, so the suite needs neither MySQL nor Redis
+from obmennik.settings import *  # noqa: F401,F403
+from obmennik.settings import BASE_DIR
+
+ALLOWED_HOSTS = ['testserver', 'localhost']
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'obmennik.backends.sqlite3',
+        'NAME': BASE_DIR / 'test.sqlite3',
+    }
+}
+
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': "channels.layers.InMemoryChannelLayer"
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Tests load the order books they use themselves
+WARM_ORDER_BOOKS = False
+
+# An endpoint over its query budget fails the test that called it
+QUERY_BUDGET_STRICT = True
@@ -1,7 +1,8 @@
 from django.contrib import admin
 from django.urls import path
 
-from obmennik.view import UserViewSet, CurrencyViewSet, OfferViewSet, SessionViewSet
+from obmennik.view import UserViewSet, CurrencyViewSet, OfferViewSet, SessionViewSet, SearchViewSet, \
+    MetricsViewSet
 
 urlpatterns = [
     path('user/create/', UserViewSet.as_view({"post": "create_user"}), name='create_user'),
@@ -9,6 +10,9 @@ urlpatterns = [
     path('user/watchlist/', UserViewSet.as_view({"get": "get_user_watchlist"}), name='get_user_watchlist'),
     path('user/addWatchlist/', UserViewSet.as_view({"post": "add_watchlist"}), name='add_watchlist'),
     path('user/removeWatchlist/', UserViewSet.as_view({"post": "remove_watchlist"}), name='add_watchlist'),
+    path('user/addWatchlistBulk/', UserViewSet.as_view({"post": "add_watchlist_bulk"}), name='add_watchlist_bulk'),
+    path('user/removeWatchlistBulk/', UserViewSet.as_view({"post": "remove_watchlist_bulk"}),
+         name='remove_watchlist_bulk'),
     path('user/rename/', UserViewSet.as_view({"post": "rename"}), name='user_rename'),
     path('user/info/', UserViewSet.as_view({"get": "info"}), name='user_info'),
     path('user/updateRating/', UserViewSet.as_view({"post": "update_rating"}), name='update_rating'),
@@ -18,10 +22,20 @@ urlpatterns = [
 
     path('offer/create/', OfferViewSet.as_view({"post": "create_offer"}), name='create_offer'),
     path('offer/getList/', OfferViewSet.as_view({"get": "get_all_offers"}), name='get_all_offers'),
+    path('offer/book/', OfferViewSet.as_view({"get": "get_offer_book"}), name='get_offer_book'),
+    path('offer/match/', OfferViewSet.as_view({"get": "get_matching_offers"}), name='get_matching_offers'),
+    path('offer/bulk/', OfferViewSet.as_view({"post": "bulk_offers"}), name='bulk_offers'),
     path('offer/edit/', OfferViewSet.as_view({"post": "edit_offer"}), name='edit_offer'),
 
     path('session/create/', SessionViewSet.as_view({"post": "create_session"}), name='create_session'),
     path('session/sendMessage/', SessionViewSet.as_view({"post": "send_message"}), name='send_message'),
+    path('session/messages/', SessionViewSet.as_view({"get": "get_messages"}), name='get_session_messages'),
+    path('session/export/', SessionViewSet.as_view({"get": "export"}), name='session_export'),
+    path('session/markRead/', SessionViewSet.as_view({"post": "mark_read"}), name='session_mark_read'),
     path('session/list/', SessionViewSet.as_view({"get": "get_list"}), name='get_session_list'),
     path('session/close/', SessionViewSet.as_view({"post": "close"}), name='session_close'),
+
+    path('search/', SearchViewSet.as_view({"get": "search"}), name='search'),
+
+    path('metrics/', MetricsViewSet.as_view({"get": "get_metrics"}), name='metrics'),
 ]
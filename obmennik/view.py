@@ -1,52 +1,275 @@
-import pytz
+import base64
 
 from datetime import datetime
 
+from django.db import connection, transaction, IntegrityError
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
 from rest_framework import viewsets
-from rest_framework.exceptions import ValidationError, PermissionDenied
-
-from offer.models import User, Currency, Offer, Session, SessionUser, Messages, UserRating
+from rest_framework.exceptions import ValidationError, PermissionDenied, NotFound
+
+from obmennik.metrics import metrics
+from obmennik.renderers import dumps_text, format_datetime
+from offer.models import User, Currency, Offer, Session, SessionUser, Messages, UserRating, OutboxEvent
+from offer.bookfeed import BookChanges, book_feed
+from offer.currencies import currency_cache
+from offer.export import EXPORT_FORMATS, EXPORT_CONTENT_TYPES, export_chunks, aiter_chunks
+from offer.groups import session_group, user_group
+from offer.ingest import message_pipeline, message_ids
+from offer.orderbook import order_books
+from offer.outbox import outbox
+from offer.responsecache import response_cache, cached_per_user
+from offer.search import search_index, matches
 from rest_framework.response import Response
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 
 
+# Through model of User.user_watchlist
+Watchlist = User.user_watchlist.through
+
+OFFER_BOOK_PAGE_SIZE = 50
+OFFER_BOOK_MAX_PAGE_SIZE = 200
+OFFER_MATCH_MAX_LIMIT = 100
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_MAX_PAGE_SIZE = 200
+OFFER_BULK_MAX_ITEMS = 1000
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_LIMIT = 100
+# Seconds a replay waits for frames numbered before the socket connected
+OUTBOX_REPLAY_WAIT = 1
+
+# Offer fields accepted by offer/bulk/: request key -> (model field, conversion)
+OFFER_BULK_FIELDS = {
+    'fromCurrencyId': ('from_currency_id', int),
+    'toCurrencyId': ('to_currency_id', int),
+    'fromAmount': ('from_amount', float),
+    'toAmount': ('to_amount', float),
+    'exchangeRate': ('exchange_rate', float),
+}
+
+
 def MessageModelToMessageData(message: Messages):
     return {
         'messageId': message.message_id,
-        'messageDate': message.message_date.strftime('%Y-%m-%d %H:%M:%S'),
+        'messageDate': format_datetime(message.message_date),
         'messageText': message.message_text,
         'messageSender': UserModelToUserData(message.message_sender),
-        'messageSessionId': message.message_session.session_id
+        'messageSessionId': message.message_session_id
     }
 
 
 def SessionModelToSessionData(session: Session, currentUser: User):
-    users = getUsersBySession(session=session)
-
-    users_data = []
-    for user in users:
-        if user.user_id != currentUser.user_id:
+    return SessionModelsToSessionData([session], currentUser)[0]
+
+
+def SessionModelsToSessionData(sessions, currentUser: User):
+    sessions = list(sessions)
+    watchlist_ids = getWatchlistIds(currentUser)
+    unread_counts = getUnreadCounts([session.session_id for session in sessions], currentUser.user_id)
+
+    sessions_data = []
+    for session, data in zip(sessions, SessionModelsToSharedSessionData(sessions)):
+        sessions_data.append(SharedSessionDataToSessionData(data, currentUser.user_id, session.session_owner_id,
+                                                            session.offer_id in watchlist_ids,
+                                                            unread_counts.get(session.session_id, 0)))
+    return sessions_data
+
+
+def SessionModelsToSharedSessionData(sessions):
+    # Session summary as seen by no one in particular: every participant is listed
+    # and the viewer-dependent fields are filled in by SharedSessionDataToSessionData.
+    # Full message history is served by SessionViewSet.get_messages.
+    sessions = list(sessions)
+    session_ids = [session.session_id for session in sessions]
+
+    session_users = {}
+    for session_user in SessionUser.objects.filter(session_id__in=session_ids) \
+            .select_related('user').order_by('session_user_id'):
+        session_users.setdefault(session_user.session_id, []).append(session_user.user)
+
+    last_message_ids = Session.objects.filter(session_id__in=session_ids).annotate(
+        last_message_id=Subquery(Messages.objects.filter(message_session_id=OuterRef('session_id'))
+                                 .order_by('-message_date', '-message_id').values('message_id')[:1])
+    ).values_list('last_message_id', flat=True)
+    last_messages = {message.message_session_id: message for message in Messages.objects.filter(
+        message_id__in=[message_id for message_id in last_message_ids if message_id is not None]
+    ).select_related('message_sender')}
+
+    sessions_data = []
+    for session in sessions:
+        users_data = []
+        for user in session_users.get(session.session_id, []):
             users_data.append(UserModelToUserData(user))
 
+        last_message = last_messages.get(session.session_id, None)
+        if last_message is not None:
+            last_message = MessageModelToMessageData(last_message)
+
+        sessions_data.append({
+            'sessionId': session.session_id,
+            'sessionUsers': users_data,
+            'sessionType': None,
+            'sessionState': session.session_state,
+            'sessionOffer': OfferModelToOfferData(session.offer, None, set()),
+            'sessionLatestMessage': last_message,
+            'sessionUnreadCount': 0,
+            'sessionLastMessage': format_datetime(session.last_message_date)
+        })
+    return sessions_data
+
+
+def SharedSessionDataToSessionData(data, user_id, owner_id, is_on_watchlist, unread_count):
     session_type = 'incoming'
-    if session.session_owner.user_id == currentUser.user_id:
+    if owner_id == user_id:
         session_type = 'outcoming'
 
-    messages = Messages.objects.order_by('message_date').filter(message_session_id=session.session_id)
-    messages_data = []
+    return {
+        **data,
+        'sessionUsers': [user for user in data['sessionUsers'] if user['user_id'] != user_id],
+        'sessionType': session_type,
+        'sessionOffer': {**data['sessionOffer'], 'isOnWatchlist': is_on_watchlist},
+        'sessionUnreadCount': unread_count
+    }
+
 
-    for message in messages:
-        messages_data.append(MessageModelToMessageData(message))
+class ViewerField:
+    # Stands for a viewer dependent value of a shared session, spliced in by EncodedSessionToSessionJson
+    def __init__(self, name):
+        self.name = name
+
+
+def hasViewerFields(value):
+    return isinstance(value, ViewerField) or \
+        isinstance(value, dict) and any(hasViewerFields(item) for item in value.values())
+
+
+def encodeAroundViewerFields(value, fragments, fields):
+    # Appends the JSON text of value to the last fragment and starts a new one
+    # at each ViewerField. Dicts holding one are written key by key, everything
+    # else is encoded whole, so the text is never searched and user supplied
+    # strings cannot be taken for a field.
+    if isinstance(value, ViewerField):
+        fields.append(value.name)
+        fragments.append('')
+    elif hasViewerFields(value):
+        fragments[-1] += '{'
+        for index, (key, item) in enumerate(value.items()):
+            fragments[-1] += (',' if index else '') + dumps_text(key) + ':'
+            encodeAroundViewerFields(item, fragments, fields)
+        fragments[-1] += '}'
+    else:
+        fragments[-1] += dumps_text(value)
+
+
+def SharedSessionDataToEncodedSession(data):
+    # Encodes a SessionModelsToSharedSessionData entry once for all of its
+    # recipients: the text is cut at the viewer dependent fields, and each
+    # participant is encoded on their own
+    fragments = ['']
+    fields = []
+    encodeAroundViewerFields({
+        **data,
+        'sessionUsers': ViewerField('sessionUsers'),
+        'sessionType': ViewerField('sessionType'),
+        'sessionOffer': {**data['sessionOffer'], 'isOnWatchlist': ViewerField('isOnWatchlist')},
+        'sessionUnreadCount': ViewerField('sessionUnreadCount')
+    }, fragments, fields)
 
     return {
+        'fragments': fragments,
+        'fields': fields,
+        'users': [[user['user_id'], dumps_text(user)] for user in data['sessionUsers']]
+    }
+
+
+def EncodedSessionToSessionJson(encoded, user_id, owner_id, is_on_watchlist, unread_count):
+    # JSON text of SharedSessionDataToSessionData for one viewer, without encoding anything again
+    values = {
+        'sessionUsers': '[' + ','.join(user for other_id, user in encoded['users'] if other_id != user_id) + ']',
+        'sessionType': '"outcoming"' if owner_id == user_id else '"incoming"',
+        'isOnWatchlist': 'true' if is_on_watchlist else 'false',
+        'sessionUnreadCount': str(int(unread_count))
+    }
+    parts = [encoded['fragments'][0]]
+    for field, fragment in zip(encoded['fields'], encoded['fragments'][1:]):
+        parts.append(values[field])
+        parts.append(fragment)
+    return ''.join(parts)
+
+
+# Socket responseType of each session event
+SESSION_RESPONSE_TYPES = {'create_session': 'sessionCreated', 'close_session': 'sessionClosed'}
+
+
+def SessionEventToFrame(event, user_id):
+    session = EncodedSessionToSessionJson(event['session'], user_id, event['ownerId'], user_id in event['watcherIds'],
+                                          event['unreadCounts'].get(user_id, 0))
+    return '{"seq":' + str(event['seq']) + ',"responseType":"' + SESSION_RESPONSE_TYPES[event['type']] + \
+        '","session":' + session + '}'
+
+
+def MessageJsonToFrame(message_json, seq):
+    return '{"seq":' + str(seq) + ',"responseType":"messageSent","message":' + message_json + '}'
+
+
+def OutboxEventToFrame(event: OutboxEvent):
+    # The frame as it was sent live
+    if event.message_id is not None:
+        return MessageJsonToFrame(dumps_text(MessageModelToMessageData(event.message)), event.seq)
+    return event.frame
+
+
+def sendSessionEvent(channel_layer, groups, event, user_ids):
+    # Numbers the event, sends it to the groups and queues it for user_ids
+    with message_ids.reserve() as seq:
+        event['seq'] = seq
+        for group in groups:
+            async_to_sync(channel_layer.group_send)(group, event)
+        outbox.add([OutboxEvent(user_id=user_id, seq=seq, frame=SessionEventToFrame(event, user_id))
+                    for user_id in user_ids])
+
+
+def replayOutbox(user_id, since):
+    # (frames, last sequence number, complete) for a connecting socket, called
+    # once it is in its groups. Frames numbered before that may still be on
+    # their way to the database, so the replay waits for them: one that is
+    # still missing after OUTBOX_REPLAY_WAIT makes the replay incomplete. A
+    # socket without since has just loaded its full state and only gets the
+    # sequence number to resume from.
+    target = message_ids.current()
+    flushed = message_ids.wait_flushed(target, OUTBOX_REPLAY_WAIT)
+    if since is None:
+        return [], flushed, flushed >= target
+    events, complete = outbox.replay(user_id, since, flushed)
+    if len(events) == outbox.size:
+        last = events[-1].seq
+    else:
+        last = max(since, flushed)
+    return [OutboxEventToFrame(event) for event in events], last, complete and flushed >= target
+
+
+def MessageModelToMessageEvent(message: Messages):
+    # The message is encoded here once, recipients forward the text as is
+    return {
+        'type': 'send_message',
+        'seq': message.message_id,
+        'message': dumps_text(MessageModelToMessageData(message))
+    }
+
+
+def SessionModelToSessionEvent(session: Session, event_type):
+    data = SessionModelsToSharedSessionData([session])[0]
+    user_ids = [user['user_id'] for user in data['sessionUsers']]
+    return {
+        'type': event_type,
         'sessionId': session.session_id,
-        'sessionUsers': users_data,
-        'sessionType': session_type,
-        'sessionState': session.session_state,
-        'sessionOffer': OfferModelToOfferData(session.offer, currentUser),
-        'sessionMessages': messages_data,
-        'sessionLastMessage': session.last_message_date.strftime('%Y-%m-%d %H:%M:%S')
+        'session': SharedSessionDataToEncodedSession(data),
+        'ownerId': session.session_owner_id,
+        'watcherIds': list(getOfferWatcherIds(session.offer_id, user_ids)),
+        'unreadCounts': getSessionUnreadCounts(session.session_id)
     }
 
 
@@ -55,23 +278,92 @@ def UserModelToUserData(user):
         'user_id': user.user_id,
         'user_name': user.user_name,
         'user_rating': user.user_rating,
-        'closed_sessions': len(SessionUser.objects.filter(user_id=user.user_id, session__session_state=0))
+        'closed_sessions': user.closed_sessions
     }
 
 
-def OfferModelToOfferData(offer, user):
+def OfferModelToOfferData(offer, user, watchlist_ids=None):
+    if watchlist_ids is None:
+        watchlist_ids = getWatchlistIds(user)
     return {
         'offerId': offer.offer_id,
-        'fromCurrencyId': offer.from_currency.currency_id,
-        'toCurrencyId': offer.to_currency.currency_id,
+        'fromCurrencyId': offer.from_currency_id,
+        'toCurrencyId': offer.to_currency_id,
         'fromAmount': offer.from_amount,
         'toAmount': offer.to_amount,
         'exchangeRate': offer.exchange_rate,
         'creator': UserModelToUserData(offer.user),
-        'isOnWatchlist': offer in user.user_watchlist.all()
+        'isOnWatchlist': offer.offer_id in watchlist_ids
+    }
+
+
+def OfferModelToBookEntry(offer):
+    # Compact offer of the offer book feed, the pair is given by the frame
+    return {
+        'offerId': offer.offer_id,
+        'fromAmount': float(offer.from_amount),
+        'toAmount': float(offer.to_amount),
+        'exchangeRate': float(offer.exchange_rate),
+        'creatorId': int(offer.user_id)
     }
 
 
+def getOfferPair(offer):
+    return int(offer.from_currency_id), int(offer.to_currency_id)
+
+
+def addBookChange(changes: BookChanges, offer, previous_pair=None):
+    # An offer that moved to another pair leaves the old book and joins the new one
+    pair = getOfferPair(offer)
+    if previous_pair is not None and previous_pair != pair:
+        changes.add(previous_pair, {'op': 'remove', 'offerId': offer.offer_id})
+    op = 'update' if previous_pair == pair else 'add'
+    changes.add(pair, {'op': op, **OfferModelToBookEntry(offer)})
+
+
+def getBookSnapshot(from_currency_id, to_currency_id, limit):
+    # The sequence number is read first: every delta up to it is in the offers
+    seq = book_feed.current((from_currency_id, to_currency_id))
+    offers = list(Offer.objects.filter(from_currency_id=from_currency_id, to_currency_id=to_currency_id)
+                  .order_by('exchange_rate', 'offer_id')[:limit + 1])
+    return seq, [OfferModelToBookEntry(offer) for offer in offers[:limit]], len(offers) > limit
+
+
+def OfferModelsToOfferData(offers, user):
+    if hasattr(offers, 'select_related'):
+        offers = offers.select_related('user')
+    offers = list(offers)
+    watchlist_ids = getWatchlistIds(user)
+    return [OfferModelToOfferData(offer, user, watchlist_ids) for offer in offers]
+
+
+def getWatchlistIds(user: User):
+    return set(user.user_watchlist.values_list('offer_id', flat=True))
+
+
+def getOfferWatcherIds(offer_id, user_ids):
+    return set(Watchlist.objects.filter(offer_id=offer_id, user_id__in=user_ids)
+               .values_list('user_id', flat=True))
+
+
+def unreadMessagesCount():
+    # Messages of a SessionUser's session after its read marker, not sent by its user
+    return Count('session__messages', filter=Q(
+        session__messages__message_id__gt=Coalesce(F('last_read_message_id'), 0)
+    ) & ~Q(session__messages__message_sender_id=F('user_id')))
+
+
+def getUnreadCounts(session_ids, user_id):
+    counts = SessionUser.objects.filter(session_id__in=session_ids, user_id=user_id) \
+        .values('session_id').annotate(unread=unreadMessagesCount())
+    return {row['session_id']: row['unread'] for row in counts}
+
+
+def getSessionUnreadCounts(session_id):
+    counts = SessionUser.objects.filter(session_id=session_id).values('user_id').annotate(unread=unreadMessagesCount())
+    return {row['user_id']: row['unread'] for row in counts}
+
+
 def CurrencyModelToCurrencyData(currency):
     return {
         "currencyId": currency.currency_id,
@@ -86,38 +378,161 @@ def parseDateTime(date_time_str):
     return datetime.strptime(date_time_str, '%Y-%m-%d %H:%M:%S')
 
 
-def getUsersBySession(session: Session):
-    user_sessions = SessionUser.objects.filter(session=session)
-    users = []
-    for userSession in user_sessions:
-        users.append(userSession.user)
-    return users
+def encodeOfferCursor(offer: Offer):
+    raw = '{}:{}'.format(repr(offer.exchange_rate), offer.offer_id)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decodeOfferCursor(cursor):
+    try:
+        exchange_rate, offer_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(':')
+        return float(exchange_rate), int(offer_id)
+    except ValueError:
+        raise ValidationError("Invalid cursor")
+
+
+def encodeMessageCursor(message: Messages):
+    raw = '{}|{}'.format(message.message_date.isoformat(), message.message_id)
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decodeMessageCursor(cursor):
+    try:
+        message_date, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(message_date), int(message_id)
+    except ValueError:
+        raise ValidationError("Invalid cursor")
+
+
+def saveMessage(data):
+    sender_id = data.get('senderId', None)
+    session_id = data.get('sessionId', None)
+    message_date = data.get('messageDate', None)
+    message_text = data.get('messageText', None)
+
+    if None in [sender_id, session_id, message_date, message_text]:
+        raise ValidationError("Some field(s) does not exist")
+
+    message = validateMessage(sender_id, message_date, message_text)
+    try:
+        message.message_session_id = int(session_id)
+    except (TypeError, ValueError):
+        raise ValidationError("Invalid field(s)")
+    checkMessageSender(message)
+    return message_pipeline.submit(message)
+
+
+def validateMessage(sender_id, message_date, message_text):
+    # The message is acknowledged before its row is written, so everything the
+    # write could reject is checked here; the session is set by the caller
+    try:
+        message = Messages(message_sender_id=int(sender_id), message_date=parseDateTime(message_date),
+                           message_text=message_text)
+    except (TypeError, ValueError):
+        raise ValidationError("Invalid field(s)")
+    if not isinstance(message_text, str) or len(message_text) > Messages._meta.get_field('message_text').max_length:
+        raise ValidationError("Invalid messageText")
+    return message
+
+
+def checkMessageSender(message: Messages):
+    session_id, sender_id = message.message_session_id, message.message_sender_id
+    if not SessionUser.objects.filter(session_id=session_id, user_id=sender_id).exists():
+        if not Session.objects.filter(session_id=session_id).exists():
+            raise NotFound("Session does not exist")
+        raise PermissionDenied("User is not in this session")
+
+
+def markMessagesRead(user_id, session_id, message_id):
+    # The read marker only ever moves forward
+    try:
+        user_id, session_id, message_id = int(user_id), int(session_id), int(message_id)
+    except (TypeError, ValueError):
+        raise ValidationError("Invalid field(s)")
+    SessionUser.objects.filter(session_id=session_id, user_id=user_id) \
+        .filter(Q(last_read_message_id__isnull=True) | Q(last_read_message_id__lt=message_id)) \
+        .update(last_read_message_id=message_id)
+    response_cache.invalidate([user_id])
 
 
 def getUserSessions(user: User):
-    user_sessions = SessionUser.objects.filter(user=user)
+    user_sessions = SessionUser.objects.filter(user=user).select_related('session__offer__user')
     session = []
     for userSession in user_sessions:
         session.append(userSession.session)
     return session
 
 
+def getUserSessionIds(user_id):
+    # None when the user does not exist
+    if not User.objects.filter(user_id=user_id).exists():
+        return None
+    return list(SessionUser.objects.filter(user_id=user_id).values_list('session_id', flat=True).distinct())
+
+
+def getAffectedUserIds(user_ids):
+    # Users whose cached responses embed the given users' data: the users
+    # themselves, everyone sharing a session with them or on their offers, and
+    # the watchers of their offers. user_ids may be a values() subquery.
+    users = User.objects.filter(user_id__in=user_ids).values_list('user_id', flat=True)
+    partners = SessionUser.objects.filter(Q(session__sessionuser__user_id__in=user_ids) |
+                                          Q(session__offer__user_id__in=user_ids)).values_list('user_id', flat=True)
+    watchers = Watchlist.objects.filter(offer__user_id__in=user_ids).values_list('user_id', flat=True)
+    return set(users.union(partners, watchers))
+
+
+def getOfferAudienceIds(offer_ids):
+    # Users whose cached responses include the offers
+    watchers = Watchlist.objects.filter(offer_id__in=offer_ids).values_list('user_id', flat=True)
+    participants = SessionUser.objects.filter(session__offer_id__in=offer_ids).values_list('user_id', flat=True)
+    return set(watchers.union(participants))
+
+
+def parseBulkOfferId(item):
+    # offerId of a bulk item; raises ValueError
+    offer_id = item.get('offerId', None)
+    if offer_id is None:
+        raise ValueError("Some field(s) does not exist")
+    if isinstance(offer_id, bool) or not isinstance(offer_id, int):
+        raise ValueError("Invalid offerId")
+    return offer_id
+
+
+def parseBulkOfferFields(item, required):
+    # Model field values of the offer fields in a bulk item; raises ValueError
+    fields = {}
+    for key, (field, convert) in OFFER_BULK_FIELDS.items():
+        value = item.get(key, None)
+        if value is None:
+            if required:
+                raise ValueError("Some field(s) does not exist")
+            continue
+        try:
+            fields[field] = convert(value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid {}".format(key))
+    for field in ('from_currency_id', 'to_currency_id'):
+        if field in fields and currency_cache.get(fields[field]) is None:
+            raise ValueError("Currency does not exist")
+    return fields
+
+
 class UserViewSet(viewsets.ViewSet):
     def create_user(self, request):
         user = User(user_name="New user", user_rating=0)
         user.save()
         user.user_name += " " + str(user.user_id)
         user.save()
+        search_index.add_user(user)
         return Response(UserModelToUserData(user), status=200)
 
+    @cached_per_user
     def get_user_watchlist(self, request):
         user_id = request.GET.get('userId', None)
         if user_id is None:
             raise ValidationError("user_id does not exist")
-        watchlist = User.objects.get(user_id=user_id).user_watchlist.all()
-        response_data = []
-        for offer in watchlist:
-            response_data.append(OfferModelToOfferData(offer, User.objects.get(user_id=user_id)))
+        user = User.objects.get(user_id=user_id)
+        response_data = OfferModelsToOfferData(user.user_watchlist.all(), user)
         return Response(response_data, status=200)
 
     def add_watchlist(self, request):
@@ -125,12 +540,16 @@ class UserViewSet(viewsets.ViewSet):
         offer_id = request.GET.get('offerId', None)
         if None in (user_id, offer_id):
             raise ValidationError('Some field(s) does not exist')
-        user = User.objects.get(user_id=user_id)
-
-        if user.user_watchlist.filter(offer_id=offer_id):
-            raise PermissionDenied("This offer is already in watchlist")
 
-        user.user_watchlist.add(Offer.objects.get(offer_id=offer_id))
+        # One INSERT; the through table's unique constraint catches duplicates
+        try:
+            with transaction.atomic():
+                Watchlist.objects.create(user_id=user_id, offer_id=offer_id)
+        except IntegrityError:
+            if Watchlist.objects.filter(user_id=user_id, offer_id=offer_id).exists():
+                raise PermissionDenied("This offer is already in watchlist")
+            raise ValidationError("User or offer does not exist")
+        response_cache.invalidate([user_id])
         return Response("Offer successfully added to watchlist", status=200)
 
     def remove_watchlist(self, request):
@@ -138,22 +557,45 @@ class UserViewSet(viewsets.ViewSet):
         offer_id = request.GET.get('offerId', None)
         if None in (user_id, offer_id):
             raise ValidationError('Some field(s) does not exist')
-        user = User.objects.get(user_id=user_id)
 
-        if not user.user_watchlist.filter(offer_id=offer_id):
+        deleted, _ = Watchlist.objects.filter(user_id=user_id, offer_id=offer_id).delete()
+        if not deleted:
             raise PermissionDenied("This offer is not in watchlist")
-
-        user.user_watchlist.remove(Offer.objects.get(offer_id=offer_id))
+        response_cache.invalidate([user_id])
         return Response("Offer successfully removed from watchlist", status=200)
 
+    def add_watchlist_bulk(self, request):
+        user_id = request.data.get('userId', None)
+        offer_ids = request.data.get('offerIds', None)
+        if None in (user_id, offer_ids):
+            raise ValidationError('Some field(s) does not exist')
+
+        if not User.objects.filter(user_id=user_id).exists():
+            raise ValidationError("User does not exist")
+        offer_ids = Offer.objects.filter(offer_id__in=offer_ids).values_list('offer_id', flat=True)
+        # INSERT IGNORE / ON CONFLICT DO NOTHING: offers already on the watchlist are skipped
+        Watchlist.objects.bulk_create([Watchlist(user_id=user_id, offer_id=offer_id) for offer_id in offer_ids],
+                                      ignore_conflicts=True)
+        response_cache.invalidate([user_id])
+        return Response("Offers successfully added to watchlist", status=200)
+
+    def remove_watchlist_bulk(self, request):
+        user_id = request.data.get('userId', None)
+        offer_ids = request.data.get('offerIds', None)
+        if None in (user_id, offer_ids):
+            raise ValidationError('Some field(s) does not exist')
+
+        Watchlist.objects.filter(user_id=user_id, offer_id__in=offer_ids).delete()
+        response_cache.invalidate([user_id])
+        return Response("Offers successfully removed from watchlist", status=200)
+
+    @cached_per_user
     def get_user_offers(self, request):
         user_id = request.GET.get('userId', None)
         if user_id is None:
             raise ValidationError("user_id does not exist")
         offers = Offer.objects.filter(user__user_id=user_id)
-        data = []
-        for offer in offers:
-            data.append(OfferModelToOfferData(offer, User.objects.get(user_id=user_id)))
+        data = OfferModelsToOfferData(offers, User.objects.get(user_id=user_id))
         return Response(data, status=200)
 
     def rename(self, request):
@@ -166,8 +608,11 @@ class UserViewSet(viewsets.ViewSet):
         user = User.objects.get(user_id=user_id)
         user.user_name = new_name
         user.save()
+        search_index.add_user(user)
+        response_cache.invalidate(getAffectedUserIds([user.user_id]))
         return Response(UserModelToUserData(user), status=200)
 
+    @cached_per_user
     def info(self, request):
         user_id = request.GET.get('userId', None)
 
@@ -185,18 +630,19 @@ class UserViewSet(viewsets.ViewSet):
         if None in (user_id, new_rating):
             raise ValidationError('Some field(s) does not exist')
 
-        user_rating = UserRating.objects.create(user_id=user_id, rating=new_rating)
-        user_rating.save()
-
-        user_ratings = UserRating.objects.filter(user_id=user_id)
+        try:
+            new_rating = float(new_rating)
+        except ValueError:
+            raise ValidationError("Invalid rating")
 
-        sum = 0
-        for rating in user_ratings:
-            sum += rating.rating
-
-        user = user_rating.user
-        user.user_rating = sum / len(user_ratings)
-        user.save()
+        # Keep the running aggregates in step with the inserted row; both updates
+        # are single-row and independent of how many ratings the user has.
+        with transaction.atomic():
+            UserRating.objects.create(user_id=user_id, rating=new_rating)
+            users = User.objects.filter(user_id=user_id)
+            users.update(rating_count=F('rating_count') + 1, rating_sum=F('rating_sum') + new_rating)
+            users.update(user_rating=F('rating_sum') / F('rating_count'))
+        response_cache.invalidate(getAffectedUserIds([user_id]))
 
         return Response("Rating successfully updated")
 
@@ -206,9 +652,90 @@ class OfferViewSet(viewsets.ViewSet):
     def get_all_offers(self, request):
         user_id = request.GET.get('userId', None)
         offers = Offer.objects.all()
-        data = []
-        for offer in offers:
-            data.append(OfferModelToOfferData(offer, User.objects.get(user_id=user_id)))
+        data = OfferModelsToOfferData(offers, User.objects.get(user_id=user_id))
+        return Response(data, status=200)
+
+    def get_offer_book(self, request):
+        user_id = request.GET.get('userId', None)
+        from_currency_id = request.GET.get('fromCurrencyId', None)
+        to_currency_id = request.GET.get('toCurrencyId', None)
+        creator_id = request.GET.get('creatorId', None)
+        min_amount = request.GET.get('minAmount', None)
+        max_amount = request.GET.get('maxAmount', None)
+        cursor = request.GET.get('cursor', None)
+
+        if user_id is None:
+            raise ValidationError("Some field(s) does not exist")
+
+        try:
+            limit = min(int(request.GET.get('limit', OFFER_BOOK_PAGE_SIZE)), OFFER_BOOK_MAX_PAGE_SIZE)
+        except ValueError:
+            raise ValidationError("Invalid limit")
+        if limit <= 0:
+            raise ValidationError("Invalid limit")
+
+        try:
+            from_currency_id = int(from_currency_id) if from_currency_id is not None else None
+            to_currency_id = int(to_currency_id) if to_currency_id is not None else None
+            creator_id = int(creator_id) if creator_id is not None else None
+            min_amount = float(min_amount) if min_amount is not None else None
+            max_amount = float(max_amount) if max_amount is not None else None
+        except ValueError:
+            raise ValidationError("Invalid field(s)")
+
+        # (exchange_rate, offer_id) is the keyset order. A pair, fromCurrencyId,
+        # creatorId or no filter at all are equality columns followed by that
+        # order in one of the Offer indexes, so pages are read in index order
+        # without a sort; toCurrencyId alone, creatorId with a currency and the
+        # amount range are checked on the rows read that way instead.
+        offers = Offer.objects.all()
+        if from_currency_id is not None:
+            offers = offers.filter(from_currency_id=from_currency_id)
+        if to_currency_id is not None:
+            offers = offers.filter(to_currency_id=to_currency_id)
+        if creator_id is not None:
+            offers = offers.filter(user_id=creator_id)
+        if min_amount is not None:
+            offers = offers.filter(from_amount__gte=min_amount)
+        if max_amount is not None:
+            offers = offers.filter(from_amount__lte=max_amount)
+        if cursor is not None:
+            exchange_rate, offer_id = decodeOfferCursor(cursor)
+            offers = offers.filter(Q(exchange_rate__gt=exchange_rate) |
+                                   Q(exchange_rate=exchange_rate, offer_id__gt=offer_id))
+
+        offers = list(offers.select_related('user').order_by('exchange_rate', 'offer_id')[:limit + 1])
+        next_cursor = None
+        if len(offers) > limit:
+            offers = offers[:limit]
+            next_cursor = encodeOfferCursor(offers[-1])
+
+        return Response({
+            'offers': OfferModelsToOfferData(offers, User.objects.get(user_id=user_id)),
+            'nextCursor': next_cursor
+        }, status=200)
+
+    def get_matching_offers(self, request):
+        user_id = request.GET.get('userId', None)
+        from_currency_id = request.GET.get('fromCurrencyId', None)
+        to_currency_id = request.GET.get('toCurrencyId', None)
+        exchange_rate = request.GET.get('exchangeRate', None)
+
+        if None in (user_id, from_currency_id, to_currency_id):
+            raise ValidationError("Some field(s) does not exist")
+
+        try:
+            limit = min(int(request.GET.get('limit', 10)), OFFER_MATCH_MAX_LIMIT)
+            # A counter-offer sells to_currency for from_currency, so it crosses the
+            # proposed trade when its own rate is at most the inverse of ours.
+            max_rate = 1 / float(exchange_rate) if exchange_rate is not None else None
+            offer_ids = order_books.best(int(to_currency_id), int(from_currency_id), limit, max_rate)
+        except (ValueError, ZeroDivisionError):
+            raise ValidationError("Invalid field(s)")
+
+        offers = Offer.objects.select_related('user').in_bulk(offer_ids)
+        offers = [offers[offer_id] for offer_id in offer_ids if offer_id in offers]
+        data = OfferModelsToOfferData(offers, User.objects.get(user_id=user_id))
         return Response(data, status=200)
 
     def create_offer(self, request):
@@ -226,6 +753,11 @@ class OfferViewSet(viewsets.ViewSet):
                                      from_amount=from_amount, to_amount=to_amount,
                                      user_id=creator_id, exchange_rate=exchange_rate)
         offer.save()
+        order_books.update([offer])
+        response_cache.invalidate([creator_id])
+        changes = BookChanges()
+        addBookChange(changes, offer)
+        changes.publish()
         return Response(OfferModelToOfferData(offer, User.objects.get(user_id=creator_id)), status=200)
 
     def edit_offer(self, request):
@@ -237,26 +769,133 @@ class OfferViewSet(viewsets.ViewSet):
         to_amount = request.data.get('toAmount', None)
         exchange_rate = request.data.get('exchangeRate', None)
 
-        user = User.objects.get(user_id=creator_id)
-
         if None in (offer_id, creator_id, from_amount, from_currency_id, to_currency_id, to_amount, exchange_rate):
             raise ValidationError("Some field(s) does not exist")
 
+        if None in (currency_cache.get(from_currency_id), currency_cache.get(to_currency_id)):
+            raise ValidationError("Currency does not exist")
+
+        user = User.objects.get(user_id=creator_id)
+
         offer = Offer.objects.get(offer_id=offer_id)
-        offer.user = User.objects.get(user_id=creator_id)
-        offer.from_currency = Currency.objects.get(currency_id=from_currency_id)
-        offer.to_currency = Currency.objects.get(currency_id=to_currency_id)
+        previous_owner_id = offer.user_id
+        previous_pair = getOfferPair(offer)
+        offer.user = user
+        offer.from_currency_id = int(from_currency_id)
+        offer.to_currency_id = int(to_currency_id)
         offer.from_amount = from_amount
         offer.to_amount = to_amount
         offer.exchange_rate = exchange_rate
         offer.save()
+        order_books.update([offer])
+        response_cache.invalidate(getOfferAudienceIds([offer.offer_id]) | {previous_owner_id, user.user_id})
+        changes = BookChanges()
+        addBookChange(changes, offer, previous_pair)
+        changes.publish()
 
         return Response(OfferModelToOfferData(offer, user), status=200)
 
+    def bulk_offers(self, request):
+        creator_id = request.data.get('creatorId', None)
+        items = request.data.get('offers', None)
+
+        if None in (creator_id, items):
+            raise ValidationError("Some field(s) does not exist")
+        if not isinstance(items, list) or len(items) > OFFER_BULK_MAX_ITEMS:
+            raise ValidationError("Invalid offers")
+
+        creator = User.objects.get(user_id=creator_id)
+        offer_ids = set()
+        for item in items:
+            try:
+                if isinstance(item, dict):
+                    offer_ids.add(parseBulkOfferId(item))
+            except ValueError:
+                # Reported by the loop below
+                pass
+        offers = Offer.objects.in_bulk(offer_ids)
+
+        # Every item is checked against the currency cache and the offers loaded
+        # above; items that fail get an error result and the rest are applied
+        results = []
+        creates, updates, deletes = [], [], []
+        update_fields = set()
+        previous_pairs = {}
+        seen = set()
+        for item in items:
+            try:
+                if not isinstance(item, dict):
+                    raise ValueError("Invalid offer")
+                action = item.get('action', None)
+                if action == 'create':
+                    offer = Offer(user=creator, **parseBulkOfferFields(item, True))
+                    creates.append(offer)
+                    results.append(('created', offer))
+                    continue
+                if action not in ('update', 'delete'):
+                    raise ValueError("Invalid action")
+                offer = offers.get(parseBulkOfferId(item), None)
+                if offer is None:
+                    raise ValueError("Offer does not exist")
+                if offer.user_id != creator.user_id:
+                    raise ValueError("Offer belongs to another user")
+                if offer.offer_id in seen:
+                    raise ValueError("Offer appears more than once")
+                offer.user = creator
+                if action == 'update':
+                    fields = parseBulkOfferFields(item, False)
+                    previous_pairs[offer.offer_id] = getOfferPair(offer)
+                    for field, value in fields.items():
+                        setattr(offer, field, value)
+                    update_fields.update(fields)
+                    updates.append(offer)
+                    results.append(('updated', offer))
+                else:
+                    deletes.append(offer)
+                    results.append(('deleted', offer))
+                seen.add(offer.offer_id)
+            except ValueError as exc:
+                results.append(('error', str(exc)))
+
+        # Taken before the deletes cascade to the watchlists and sessions
+        audience_ids = getOfferAudienceIds(seen) if seen else set()
+        with transaction.atomic():
+            if connection.features.can_return_rows_from_bulk_insert:
+                Offer.objects.bulk_create(creates)
+            else:
+                # MySQL cannot report the ids of a multi-row INSERT
+                for offer in creates:
+                    offer.save()
+            if updates and update_fields:
+                Offer.objects.bulk_update(updates, fields=sorted(update_fields))
+            if deletes:
+                Offer.objects.filter(offer_id__in=[offer.offer_id for offer in deletes]).delete()
+
+        order_books.update(creates + updates, [offer.offer_id for offer in deletes])
+        changes = BookChanges()
+        for offer in creates + updates:
+            addBookChange(changes, offer, previous_pairs.get(offer.offer_id, None))
+        for offer in deletes:
+            changes.add(getOfferPair(offer), {'op': 'remove', 'offerId': offer.offer_id})
+        response_cache.invalidate(audience_ids | {creator.user_id})
+        changes.publish()
+
+        watchlist_ids = getWatchlistIds(creator)
+        response_data = []
+        for status, value in results:
+            if status == 'error':
+                response_data.append({'status': status, 'error': value})
+            elif status == 'deleted':
+                response_data.append({'status': status, 'offerId': value.offer_id})
+            else:
+                response_data.append({'status': status, 'offer': OfferModelToOfferData(value, creator, watchlist_ids)})
+        return Response(response_data, status=200)
+
 
 class SessionViewSet(viewsets.ViewSet):
     channel_layer = get_channel_layer()
 
+    @cached_per_user
     def get_list(self, request):
         user_id = request.GET.get('userId', None)
 
@@ -266,46 +905,101 @@ class SessionViewSet(viewsets.ViewSet):
         user = User.objects.get(user_id=user_id)
         sessions = getUserSessions(user=user)
 
-        sessions_data = []
-        for session in sessions:
-            sessions_data.append(SessionModelToSessionData(session, user))
+        sessions_data = SessionModelsToSessionData(sessions, user)
         return Response(sessions_data, status=200)
 
-    def send_message_not(self, data):
-        sender_id = data.get('senderId', None)
-        session_id = data.get('sessionId', None)
-        message_date = data.get('messageDate', None)
-        message_text = data.get('messageText', None)
+    def get_messages(self, request):
+        user_id = request.GET.get('userId', None)
+        session_id = request.GET.get('sessionId', None)
+        cursor = request.GET.get('cursor', None)
+        since_message_id = request.GET.get('sinceMessageId', None)
 
-        if None in [sender_id, session_id, message_date, message_text]:
+        if None in (user_id, session_id):
             raise ValidationError("Some field(s) does not exist")
 
-        session = Session.objects.get(session_id=session_id)
-
-        message = Messages.objects.create(message_sender_id=sender_id, message_date=parseDateTime(message_date),
-                                          message_session_id=session_id, message_text=message_text)
-        message.save()
-
-        print(type(session.last_message_date))
-        print(type(message.message_date))
-
-        utc = pytz.UTC
+        try:
+            limit = min(int(request.GET.get('limit', MESSAGES_PAGE_SIZE)), MESSAGES_MAX_PAGE_SIZE)
+        except ValueError:
+            raise ValidationError("Invalid limit")
+        if limit <= 0:
+            raise ValidationError("Invalid limit")
+        try:
+            since_message_id = int(since_message_id) if since_message_id is not None else None
+        except ValueError:
+            raise ValidationError("Invalid sinceMessageId")
+
+        if not SessionUser.objects.filter(session_id=session_id, user_id=user_id).exists():
+            raise PermissionDenied("User is not in this session")
+
+        messages = Messages.objects.filter(message_session_id=session_id).select_related('message_sender')
+        if since_message_id is not None:
+            # Delta mode for reconnecting clients: everything stored after the given
+            # message, oldest first; repeat with the last messageId while hasMore.
+            # Messages past message_ids.flushed() wait for the next call, since a
+            # lower id may still be written after them.
+            messages = list(messages.filter(message_id__gt=since_message_id, message_id__lte=message_ids.flushed())
+                            .order_by('message_id')[:limit + 1])
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+            next_cursor = None
+        else:
+            # History mode: pages walk backwards from the newest message, each page
+            # is returned oldest first.
+            if cursor is not None:
+                message_date, message_id = decodeMessageCursor(cursor)
+                messages = messages.filter(Q(message_date__lt=message_date) |
+                                           Q(message_date=message_date, message_id__lt=message_id))
+            messages = list(messages.order_by('-message_date', '-message_id')[:limit + 1])
+            has_more = len(messages) > limit
+            messages = messages[:limit][::-1]
+            next_cursor = encodeMessageCursor(messages[0]) if has_more else None
+
+        return Response({
+            'messages': [MessageModelToMessageData(message) for message in messages],
+            'hasMore': has_more,
+            'nextCursor': next_cursor
+        }, status=200)
+
+    def export(self, request):
+        user_id = request.GET.get('userId', None)
+        since = request.GET.get('since', None)
+        until = request.GET.get('until', None)
+        export_format = request.GET.get('exportFormat', 'ndjson')
+
+        if export_format not in EXPORT_FORMATS:
+            raise ValidationError("Invalid format")
+        try:
+            user_id = int(user_id) if user_id is not None else None
+            since = parseDateTime(since) if since is not None else None
+            until = parseDateTime(until) if until is not None else None
+        except ValueError:
+            raise ValidationError("Invalid field(s)")
+
+        # Rows are read page by page while the response is sent
+        chunks = export_chunks(export_format, user_id=user_id, since=since, until=until)
+        if isinstance(request._request, ASGIRequest):
+            chunks = aiter_chunks(chunks)
+        return StreamingHttpResponse(chunks, content_type=EXPORT_CONTENT_TYPES[export_format], headers={
+            'Content-Disposition': 'attachment; filename="sessions.{}"'.format(export_format)
+        })
+
+    def mark_read(self, request):
+        user_id = request.GET.get('userId', None)
+        session_id = request.GET.get('sessionId', None)
+        message_id = request.GET.get('messageId', None)
 
-        if session.last_message_date.replace(tzinfo=utc) < message.message_date.replace(tzinfo=utc):
-            session.last_message_date = message.message_date
-            session.save()
+        if None in (user_id, session_id, message_id):
+            raise ValidationError("Some field(s) does not exist")
 
-        users = getUsersBySession(session)
-        for user in users:
-            if user.user_channel_name != 'nc':
-                async_to_sync(self.channel_layer.send)(
-                    user.user_channel_name,
-                    {
-                        'type': 'send_message',
-                        'message': MessageModelToMessageData(message)
-                    }
-                )
+        markMessagesRead(user_id, session_id, message_id)
+        return Response("Messages marked as read", status=200)
 
+    def send_message_not(self, data):
+        message = saveMessage(data)
+        async_to_sync(self.channel_layer.group_send)(
+            session_group(message.message_session_id),
+            MessageModelToMessageEvent(message)
+        )
 
     def send_message(self, request):
         self.send_message_not(request.data)
@@ -315,35 +1009,56 @@ class SessionViewSet(viewsets.ViewSet):
         owner_id = request.data.get('ownerId', None)
         user_ids = request.data.get('userIds', None)
         offer_id = request.data.get('offerId', None)
+        data = request.data.get('initialMessage', None)
 
-        if None in [owner_id, user_ids, offer_id]:
+        if None in [owner_id, user_ids, offer_id, data]:
+            raise ValidationError("Some field(s) does not exist")
+        if not isinstance(user_ids, list) or not isinstance(data, dict):
+            raise ValidationError("Invalid field(s)")
+        try:
+            user_ids = [int(user_id) for user_id in user_ids]
+        except (TypeError, ValueError):
+            raise ValidationError("Invalid userIds")
+
+        # The initial message is checked before anything is written, so a bad
+        # one leaves no session behind
+        sender_id = data.get('senderId', None)
+        message_date = data.get('messageDate', None)
+        message_text = data.get('messageText', None)
+        if None in [sender_id, message_date, message_text]:
             raise ValidationError("Some field(s) does not exist")
+        message = validateMessage(sender_id, message_date, message_text)
+        if message.message_sender_id not in user_ids:
+            raise PermissionDenied("User is not in this session")
 
-        session = Session.objects.create(session_owner_id=owner_id, offer_id=offer_id)
-        session.save()
+        with transaction.atomic():
+            session = Session.objects.create(session_owner_id=owner_id, offer_id=offer_id)
+            SessionUser.objects.bulk_create([SessionUser(session=session, user_id=user_id) for user_id in user_ids])
 
-        for user_id in user_ids:
-            session_user = SessionUser.objects.create(session_id=session.session_id, user_id=user_id)
-            session_user.save()
+            event = SessionModelToSessionEvent(session, 'create_session')
+        response_cache.invalidate(set(user_ids) | {owner_id})
 
-        for user_id in user_ids:
-            user = User.objects.get(user_id=user_id)
-            if user.user_channel_name != 'nc':
-                async_to_sync(self.channel_layer.send)(
-                    user.user_channel_name,
-                    {
-                        'type': 'create_session',
-                        'session': SessionModelToSessionData(session=session, currentUser=user)
-                    }
-                )
+        message.message_session_id = session.session_id
+        message_pipeline.submit(message)
 
-        data = request.data['initialMessage']
-        data['sessionId'] = session.session_id
+        # Participants are not in the session group until they handle this event,
+        # so the initial message travels with it instead of through the group.
+        event['message'] = dumps_text(MessageModelToMessageData(message))
+        event['messageSeq'] = message.message_id
 
-        self.send_message_not(data)
+        self.notify_participants(user_ids, event)
 
         return Response("Session successfully created", status=200)
 
+    def notify_participants(self, user_ids, event):
+        # Sent to every participant's user group, whatever presence says: a send
+        # to a group without sockets costs nothing, and one a socket is in must
+        # reach it so that it joins the session group. Every participant's
+        # devices replay it as well, the initial message is queued by the
+        # message pipeline.
+        groups = [user_group(user_id) for user_id in set(user_ids)]
+        sendSessionEvent(self.channel_layer, groups, event, set(user_ids))
+
     def close(self, request):
         session_id = request.GET.get('sessionId', None)
 
@@ -352,35 +1067,35 @@ class SessionViewSet(viewsets.ViewSet):
 
         session = Session.objects.get(session_id=session_id)
 
-        if session.session_state == 0:
-            return Response("Session already closed", status=200)
-
+        with transaction.atomic():
+            # The conditional UPDATE lets only one of several concurrent closes
+            # count the session for its participants
+            if not Session.objects.filter(session_id=session_id, session_state=1).update(session_state=0):
+                return Response("Session already closed", status=200)
+            User.objects.filter(sessionuser__session_id=session_id) \
+                .update(closed_sessions=F('closed_sessions') + 1)
         session.session_state = 0
-        session.save()
-
-        print("Send")
+        # closed_sessions of every participant changed
+        participants = SessionUser.objects.filter(session_id=session_id).values('user_id')
+        response_cache.invalidate(getAffectedUserIds(participants))
 
-        users = getUsersBySession(session)
-        for user in users:
-            if user.user_channel_name != 'nc':
-                async_to_sync(self.channel_layer.send)(
-                    user.user_channel_name,
-                    {
-                        'type': 'close_session',
-                        'session': SessionModelToSessionData(session=session, currentUser=user)
-                    }
-                )
+        event = SessionModelToSessionEvent(session, 'close_session')
+        sendSessionEvent(self.channel_layer, [session_group(session.session_id)], event,
+                         [user_id for user_id, _ in event['session']['users']])
 
         return Response("Session closed", status=200)
 
 
 class CurrencyViewSet(viewsets.ViewSet):
     def get_list_currencies(self, request):
-        currenciesQuerySet = Currency.objects.all()
+        etag = currency_cache.etag()
+        if request.META.get('HTTP_IF_NONE_MATCH', None) == etag:
+            return Response(status=304, headers={'ETag': etag})
+
         currencies = []
-        for currency in currenciesQuerySet:
+        for currency in currency_cache.all():
             currencies.append(CurrencyModelToCurrencyData(currency))
-        return Response(currencies, status=200)
+        return Response(currencies, status=200, headers={'ETag': etag})
 
     def add_currency(self, request):
         data = request.data.get('data', None)
@@ -402,4 +1117,50 @@ class CurrencyViewSet(viewsets.ViewSet):
             currency.save()
             response_data.append(CurrencyModelToCurrencyData(currency))
 
+        currency_cache.invalidate()
+
         return Response(response_data, status=200)
+
+
+class SearchViewSet(viewsets.ViewSet):
+    def search(self, request):
+        user_id = request.GET.get('userId', None)
+        query = request.GET.get('query', None)
+
+        if None in (user_id, query) or not query.strip():
+            raise ValidationError("Some field(s) does not exist")
+
+        try:
+            limit = min(int(request.GET.get('limit', SEARCH_PAGE_SIZE)), SEARCH_MAX_LIMIT)
+        except ValueError:
+            raise ValidationError("Invalid limit")
+        if limit <= 0:
+            raise ValidationError("Invalid limit")
+
+        # Hits come from this worker's index; the rows are re-read and re-checked
+        # since another worker may have renamed the user since
+        user_ids = search_index.search_users(query, limit)
+        users = User.objects.in_bulk(user_ids)
+        users = [users[user_id] for user_id in user_ids
+                 if user_id in users and matches(query, users[user_id].user_name)]
+
+        currency_ids = search_index.search_currencies(query, limit)
+        currencies = [currency_cache.get(currency_id) for currency_id in currency_ids]
+
+        # Offers selling or buying a matching currency, best rates first
+        offers = []
+        if currency_ids:
+            offers = Offer.objects.filter(Q(from_currency_id__in=currency_ids) | Q(to_currency_id__in=currency_ids))
+            offers = list(offers.select_related('user').order_by('exchange_rate', 'offer_id')[:limit])
+
+        return Response({
+            'users': [UserModelToUserData(user) for user in users],
+            'currencies': [CurrencyModelToCurrencyData(currency) for currency in currencies if currency is not None],
+            'offers': OfferModelsToOfferData(offers, User.objects.get(user_id=user_id))
+        }, status=200)
+
+
+class MetricsViewSet(viewsets.ViewSet):
+    def get_metrics(self, request):
+        # Prometheus text exposition of this worker's metrics
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
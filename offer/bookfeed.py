@@ -0,0 +1,73 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import caches
+
+from offer.groups import book_group
+
+# Seconds a consumer collects the deltas of a pair before sending them as one frame
+BOOK_FEED_WINDOW = 0.1
+
+
+def coalesce(deltas, delta):
+    # Folds delta into {offer_id: delta}, keeping one entry per offer: the
+    # latest values, still an 'add' for an offer the subscriber has not seen,
+    # and nothing for an offer added and removed within the window
+    offer_id = delta['offerId']
+    previous = deltas.get(offer_id, None)
+    if previous is not None and previous['op'] == 'add':
+        if delta['op'] == 'remove':
+            del deltas[offer_id]
+            return
+        delta = {**delta, 'op': 'add'}
+    deltas[offer_id] = delta
+
+
+class BookChanges:
+    # Offer book deltas of one request, published together so that a batch of
+    # changes reaches the subscribers of a pair as one event
+    def __init__(self):
+        self.pairs = {}
+
+    def add(self, pair, delta):
+        coalesce(self.pairs.setdefault(pair, {}), delta)
+
+    def publish(self):
+        for pair, deltas in self.pairs.items():
+            if deltas:
+                book_feed.publish(pair, list(deltas.values()))
+
+
+class BookFeed:
+    # Fans offer book deltas out to the book_group of their currency pair. Each
+    # event gets the pair's next sequence number from the Django cache, shared
+    # by every worker whenever CACHES points to a shared backend. A snapshot
+    # reads the current number before it reads the offers, so everything up to
+    # that number is already in the snapshot.
+    def __init__(self, cache_alias='default'):
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def key(self, pair):
+        return 'book-seq:{}:{}'.format(*pair)
+
+    def current(self, pair):
+        return self.cache.get(self.key(pair), 0)
+
+    def next(self, pair):
+        self.cache.add(self.key(pair), 0, None)
+        return self.cache.incr(self.key(pair))
+
+    def publish(self, pair, deltas):
+        async_to_sync(get_channel_layer().group_send)(book_group(*pair), {
+            'type': 'book_delta',
+            'fromCurrencyId': pair[0],
+            'toCurrencyId': pair[1],
+            'seq': self.next(pair),
+            'deltas': deltas
+        })
+
+
+book_feed = BookFeed()
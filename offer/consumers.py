@@ -1,54 +1,301 @@
+import asyncio
 import json
-from channels.generic.websocket import WebsocketConsumer
-from offer.models import User
+import time
+from urllib.parse import parse_qs
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
+from rest_framework.exceptions import APIException, PermissionDenied, ValidationError
+from obmennik.metrics import metrics
+from obmennik.renderers import dumps_text
+from obmennik.view import SessionEventToFrame, MessageJsonToFrame, MessageModelToMessageEvent, saveMessage, \
+    markMessagesRead, getUserSessionIds, replayOutbox, getBookSnapshot, OFFER_BOOK_PAGE_SIZE, OFFER_BOOK_MAX_PAGE_SIZE
+from offer.bookfeed import BOOK_FEED_WINDOW, coalesce
+from offer.groups import session_group, user_group, book_group
+from offer.presence import presence, PRESENCE_TTL
 
 
-class TextRoomConsumer(WebsocketConsumer):
-    def connect(self):
+class TextRoomConsumer(AsyncWebsocketConsumer):
+    # Inbound frames are {"type": ..., "clientMessageId": ..., "data": {...}}
+    inbound_handlers = {
+        'heartbeat': 'receive_heartbeat',
+        'sendMessage': 'receive_send_message',
+        'typing': 'receive_typing',
+        'markRead': 'receive_mark_read',
+        'subscribeBook': 'receive_subscribe_book',
+        'unsubscribeBook': 'receive_unsubscribe_book',
+    }
+
+    user_id = None
+    heartbeat_task = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (fromCurrencyId, toCurrencyId) -> {'seq': last sent, 'events': received before the snapshot,
+        # 'deltas': pending per offer, 'task': pending flush}
+        self.books = {}
+
+    async def connect(self):
         user_id = self.scope['url_route']['kwargs']['user_id']
-        user = User.objects.get(user_id=user_id)
-        user.user_channel_name = self.channel_name
-        user.save()
-        self.user_id = user_id
-        self.accept()
-
-    def disconnect(self, close_code):
-        # Leave room group
-        print("Disconnected")
-        user = User.objects.get(user_id=self.user_id)
-        user.user_channel_name = 'nc'
-        user.save()
-
-    def receive(self, text_data):
+        # database_sync_to_async hands the connection back to the pool afterwards
+        session_ids = await database_sync_to_async(getUserSessionIds)(user_id)
+        if session_ids is None:
+            await self.close()
+            return
+        self.user_id = int(user_id)
+
+        await self.join_group(user_group(self.user_id))
+        for session_id in session_ids:
+            await self.join_group(session_group(session_id))
+
+        await presence.ajoin(self.user_id, self.channel_name)
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat())
+        await self.accept()
+        await self.replay()
+
+    async def replay(self):
+        # ws/<user_id>/?since=<seq> replays the user's frames after the given
+        # sequence number, the highest seq the client has seen live or
+        # replayed, then reports the last one. A socket without since has a
+        # freshly loaded state and is only told where to resume from.
+        try:
+            since = int(parse_qs(self.scope.get('query_string', b'').decode())['since'][0])
+        except (KeyError, ValueError):
+            since = None
+        frames, last, complete = await database_sync_to_async(replayOutbox)(self.user_id, since)
+        for frame in frames:
+            await self.send(text_data=frame)
+        await self.send(text_data=dumps_text({
+            'responseType': 'replayed',
+            'seq': last,
+            'complete': complete
+        }))
+
+    async def disconnect(self, close_code):
+        # Groups in self.groups have already been left by websocket_disconnect
+        if self.user_id is None:
+            return
+        self.heartbeat_task.cancel()
+        for book in self.books.values():
+            if book['task'] is not None:
+                book['task'].cancel()
+        await presence.aleave(self.user_id, self.channel_name)
+
+    async def heartbeat(self):
+        # Keep the channel live for as long as this socket is open; if the worker
+        # dies the entry simply expires
+        while True:
+            await asyncio.sleep(PRESENCE_TTL / 3)
+            await presence.aheartbeat(self.user_id, self.channel_name)
+
+    async def dispatch(self, message):
+        started = time.perf_counter()
+        await super().dispatch(message)
+        # Channel layer events only, websocket.* messages are the socket's own
+        if not message['type'].startswith('websocket.'):
+            metrics.ws_event_seconds.observe((message['type'],), time.perf_counter() - started)
+
+    async def join_group(self, group):
+        await self.channel_layer.group_add(group, self.channel_name)
+        self.groups.append(group)
+
+    async def receive(self, text_data=None, bytes_data=None):
         # Receive message from WebSocket
-        text_data_json = json.loads(text_data)
-        data = text_data_json['data']
-        print(data)
+        try:
+            text_data_json = json.loads(text_data)
+        except (TypeError, ValueError):
+            text_data_json = None
+        if not isinstance(text_data_json, dict) or not isinstance(text_data_json.get('data', {}), dict):
+            await self.send_error(None, 'Malformed request')
+            return
 
-    def create_session(self, event):
-        # Receive message from room group
-        session = event['session']
-        # Send message to WebSocket
-        self.send(text_data=json.dumps({
-            'responseType': 'sessionCreated',
-            'session': session
+        client_message_id = text_data_json.get('clientMessageId', None)
+        handler = self.inbound_handlers.get(text_data_json.get('type', None), None)
+        if handler is None:
+            await self.send_error(client_message_id, 'Unknown request type')
+            return
+        try:
+            await getattr(self, handler)(text_data_json.get('data', {}), client_message_id)
+        except APIException as exc:
+            await self.send_error(client_message_id, exc.detail)
+        except ObjectDoesNotExist:
+            await self.send_error(client_message_id, 'Not found')
+        except ValueError:
+            # The exception text describes the code, not the request
+            await self.send_error(client_message_id, 'Invalid field(s)')
+
+    async def receive_heartbeat(self, data, client_message_id):
+        await presence.aheartbeat(self.user_id, self.channel_name)
+
+    async def receive_send_message(self, data, client_message_id):
+        session_id = data.get('sessionId', None)
+        if session_group(session_id) not in self.groups:
+            raise PermissionDenied("User is not in this session")
+
+        # Same persistence path as session/sendMessage/, with the socket's user as sender
+        message_date = data.get('messageDate', None) or timezone.now().strftime('%Y-%m-%d %H:%M:%S')
+        message = await database_sync_to_async(saveMessage)({
+            'senderId': self.user_id,
+            'sessionId': session_id,
+            'messageDate': message_date,
+            'messageText': data.get('messageText', None)
+        })
+        await self.channel_layer.group_send(session_group(session_id),
+                                            await database_sync_to_async(MessageModelToMessageEvent)(message))
+        await self.send_ack(client_message_id, messageId=message.message_id)
+
+    async def receive_typing(self, data, client_message_id):
+        session_id = data.get('sessionId', None)
+        if session_group(session_id) not in self.groups:
+            raise PermissionDenied("User is not in this session")
+        await self.channel_layer.group_send(session_group(session_id), {
+            'type': 'typing',
+            'sessionId': session_id,
+            'userId': self.user_id
+        })
+
+    async def receive_mark_read(self, data, client_message_id):
+        try:
+            session_id, message_id = int(data['sessionId']), int(data['messageId'])
+        except (KeyError, TypeError):
+            raise ValidationError("Some field(s) does not exist")
+        except ValueError:
+            raise ValidationError("Invalid field(s)")
+        await database_sync_to_async(markMessagesRead)(self.user_id, session_id, message_id)
+        await self.send_ack(client_message_id)
+
+    async def receive_subscribe_book(self, data, client_message_id):
+        # Joins the book group before loading the snapshot: deltas that arrive
+        # meanwhile and are already in the snapshot are dropped by their seq
+        try:
+            pair = int(data['fromCurrencyId']), int(data['toCurrencyId'])
+            limit = min(int(data.get('limit', OFFER_BOOK_PAGE_SIZE)), OFFER_BOOK_MAX_PAGE_SIZE)
+        except (KeyError, TypeError):
+            raise ValidationError("Some field(s) does not exist")
+        book = self.books.get(pair, None)
+        if book is None:
+            await self.join_group(book_group(*pair))
+        elif book['task'] is not None:
+            book['task'].cancel()
+        book = self.books[pair] = {'seq': None, 'events': [], 'deltas': {}, 'task': None}
+        seq, offers, has_more = await database_sync_to_async(getBookSnapshot)(*pair, limit)
+        if self.books.get(pair, None) is not book:
+            # Unsubscribed or subscribed again meanwhile
+            return
+        book['seq'] = seq
+        # Only the events that arrived while the snapshot loaded and are not in it
+        for event in book.pop('events'):
+            if event['seq'] > seq:
+                self.buffer_book_deltas(book, event)
+        await self.send(text_data=dumps_text({
+            'responseType': 'bookSnapshot',
+            'clientMessageId': client_message_id,
+            'fromCurrencyId': pair[0],
+            'toCurrencyId': pair[1],
+            'seq': seq,
+            'offers': offers,
+            'hasMore': has_more
         }))
+        if book['deltas'] and book['task'] is None:
+            book['task'] = asyncio.ensure_future(self.flush_book(pair))
 
-    def send_message(self, event):
-        # Receive message from room group
-        message = event['message']
+    async def receive_unsubscribe_book(self, data, client_message_id):
+        try:
+            pair = int(data['fromCurrencyId']), int(data['toCurrencyId'])
+        except (KeyError, TypeError):
+            raise ValidationError("Some field(s) does not exist")
+        book = self.books.pop(pair, None)
+        if book is not None:
+            if book['task'] is not None:
+                book['task'].cancel()
+            await self.channel_layer.group_discard(book_group(*pair), self.channel_name)
+            self.groups.remove(book_group(*pair))
+        await self.send_ack(client_message_id)
+
+    def buffer_book_deltas(self, book, event):
+        book['received'] = max(book.get('received', 0), event['seq'])
+        for delta in event['deltas']:
+            coalesce(book['deltas'], {**delta, 'seq': event['seq']})
+
+    async def flush_book(self, pair):
+        # Sends the deltas of one BOOK_FEED_WINDOW as a single frame, one entry per offer
+        await asyncio.sleep(BOOK_FEED_WINDOW)
+        book = self.books.get(pair, None)
+        if book is None:
+            return
+        deltas, book['deltas'], book['task'] = book['deltas'], {}, None
+        book['seq'] = book['received']
+        if not deltas:
+            # Everything in the window cancelled out
+            return
+        await self.send(text_data=dumps_text({
+            'responseType': 'bookDelta',
+            'fromCurrencyId': pair[0],
+            'toCurrencyId': pair[1],
+            'seq': book['seq'],
+            'deltas': [{key: value for key, value in delta.items() if key != 'seq'} for delta in deltas.values()]
+        }))
+
+    async def send_ack(self, client_message_id, **fields):
+        await self.send(text_data=dumps_text({
+            'responseType': 'ack',
+            'clientMessageId': client_message_id,
+            **fields
+        }))
+
+    async def send_error(self, client_message_id, error):
+        await self.send(text_data=dumps_text({
+            'responseType': 'error',
+            'clientMessageId': client_message_id,
+            'error': error
+        }))
+
+    async def create_session(self, event):
+        # Receive message from the user group and start following the session
+        await self.join_group(session_group(event['sessionId']))
         # Send message to WebSocket
-        self.send(text_data=json.dumps({
-            'responseType': 'messageSent',
-            'message': message
+        await self.send(text_data=SessionEventToFrame(event, self.user_id))
+        await self.send(text_data=MessageJsonToFrame(event['message'], event['messageSeq']))
+
+    async def send_message(self, event):
+        # Receive message from room group; the message arrives already encoded
+        await self.send(text_data=MessageJsonToFrame(event['message'], event['seq']))
+
+    async def message_failed(self, event):
+        # A message sent earlier could not be stored
+        await self.send(text_data=dumps_text({
+            'responseType': 'messageFailed',
+            'sessionId': event['sessionId'],
+            'messageId': event['messageId']
         }))
 
-    def close_session(self, event):
+    async def typing(self, event):
+        # Other participants only, the typing user already knows
+        if event['userId'] == self.user_id:
+            return
+        await self.send(text_data=dumps_text({
+            'responseType': 'typing',
+            'sessionId': event['sessionId'],
+            'userId': event['userId']
+        }))
+
+    async def close_session(self, event):
         # Receive message from room group
-        session = event['session']
         # Send message to WebSocket
-        print("HERE")
-        self.send(text_data=json.dumps({
-            'responseType': 'sessionClosed',
-            'session': session
-        }))
+        await self.send(text_data=SessionEventToFrame(event, self.user_id))
+
+    async def book_delta(self, event):
+        # Buffered for the window; kept whole until the snapshot tells which are stale
+        pair = event['fromCurrencyId'], event['toCurrencyId']
+        book = self.books.get(pair, None)
+        if book is None:
+            return
+        if book['seq'] is None:
+            book['events'].append(event)
+            return
+        if event['seq'] <= book['seq']:
+            return
+        self.buffer_book_deltas(book, event)
+        if book['task'] is None:
+            book['task'] = asyncio.ensure_future(self.flush_book(pair))
@@ -0,0 +1,69 @@
+import hashlib
+import threading
+
+from django.core.cache import caches
+
+from offer.models import Currency
+
+# Django cache key of the catalogue version shared by every worker
+CURRENCIES_VERSION_KEY = 'currencies-version'
+
+
+class CurrencyCache:
+    # Process-wide copy of the Currency table, tagged with the catalogue version
+    # kept in the Django cache (shared by every worker whenever CACHES points to
+    # a shared backend). invalidate() bumps that version. A worker compares
+    # against it on all() and etag(), and on a get() miss: currencies are never
+    # edited, so a miss is the only case a stale copy answers wrongly.
+    def __init__(self, cache_alias='default'):
+        self.cache_alias = cache_alias
+        self.lock = threading.Lock()
+        self.version = None
+        self.snapshot = None
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def shared_version(self):
+        return self.cache.get(CURRENCIES_VERSION_KEY, 0)
+
+    def load(self, check=False):
+        # The version is read before the table, so an add that lands in between
+        # is picked up by the next check
+        version = self.shared_version() if check or self.snapshot is None else self.version
+        with self.lock:
+            if self.snapshot is None or self.version != version:
+                currencies = {currency.currency_id: currency for currency in Currency.objects.order_by('currency_id')}
+                digest = hashlib.md5()
+                for currency in currencies.values():
+                    digest.update(repr((currency.currency_id, currency.name, currency.capital_name,
+                                        currency.unicode_symbol, currency.color_hex)).encode())
+                self.snapshot = (currencies, '"{}"'.format(digest.hexdigest()))
+                self.version = version
+            return self.snapshot
+
+    def all(self):
+        return list(self.load(check=True)[0].values())
+
+    def get(self, currency_id):
+        try:
+            currency_id = int(currency_id)
+        except (TypeError, ValueError):
+            return None
+        currency = self.load()[0].get(currency_id)
+        if currency is None:
+            currency = self.load(check=True)[0].get(currency_id)
+        return currency
+
+    def etag(self):
+        return self.load(check=True)[1]
+
+    def invalidate(self):
+        self.cache.add(CURRENCIES_VERSION_KEY, 0, None)
+        self.cache.incr(CURRENCIES_VERSION_KEY)
+        with self.lock:
+            self.snapshot = None
+
+
+currency_cache = CurrencyCache()
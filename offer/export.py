@@ -0,0 +1,121 @@
+import csv
+import io
+
+from asgiref.sync import sync_to_async
+from django.db.models import Exists, OuterRef
+
+from obmennik.renderers import dumps, format_datetime
+from offer.models import Session, SessionUser, Messages
+
+# Rows fetched per query, and so the most an export holds in memory at once
+EXPORT_CHUNK_SIZE = 2000
+
+EXPORT_FORMATS = ('ndjson', 'csv')
+EXPORT_CONTENT_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv; charset=utf-8'}
+# One CSV header for all record types; fields a record does not have stay empty
+CSV_COLUMNS = ('record', 'sessionId', 'offerId', 'sessionOwnerId', 'sessionState', 'sessionLastMessage', 'userId',
+               'userName', 'messageId', 'messageDate', 'messageText')
+
+
+def keyset_pages(queryset, key, chunk_size):
+    # Pages over queryset in `key` order, each page one bounded query that
+    # starts after the previous page. Unlike iterator() this keeps memory
+    # constant on MySQL too, where the driver buffers whole result sets.
+    last = None
+    while True:
+        page = queryset.order_by(key)
+        if last is not None:
+            page = page.filter(**{key + '__gt': last})
+        page = list(page[:chunk_size])
+        if not page:
+            return
+        yield page
+        last = getattr(page[-1], key)
+
+
+def export_records(user_id=None, since=None, until=None, chunk_size=EXPORT_CHUNK_SIZE):
+    # Sessions, then their participants, then their messages, as pages of
+    # dicts. user_id limits the export to that user's sessions, since/until to
+    # sessions with messages in [since, until) and to those messages.
+    sessions = Session.objects.all()
+    messages = Messages.objects.all()
+    if user_id is not None:
+        sessions = sessions.filter(sessionuser__user_id=user_id)
+    if since is not None:
+        messages = messages.filter(message_date__gte=since)
+    if until is not None:
+        messages = messages.filter(message_date__lt=until)
+    if since is not None or until is not None:
+        sessions = sessions.filter(Exists(messages.filter(message_session_id=OuterRef('session_id'))))
+    session_ids = sessions.values('session_id')
+
+    for page in keyset_pages(sessions, 'session_id', chunk_size):
+        yield [{
+            'record': 'session',
+            'sessionId': session.session_id,
+            'offerId': session.offer_id,
+            'sessionOwnerId': session.session_owner_id,
+            'sessionState': session.session_state,
+            'sessionLastMessage': format_datetime(session.last_message_date)
+        } for session in page]
+
+    participants = SessionUser.objects.filter(session_id__in=session_ids).select_related('user')
+    for page in keyset_pages(participants, 'session_user_id', chunk_size):
+        yield [{
+            'record': 'participant',
+            'sessionId': participant.session_id,
+            'userId': participant.user_id,
+            'userName': participant.user.user_name
+        } for participant in page]
+
+    messages = messages.filter(message_session_id__in=session_ids).select_related('message_sender')
+    for page in keyset_pages(messages, 'message_id', chunk_size):
+        yield [{
+            'record': 'message',
+            'sessionId': message.message_session_id,
+            'messageId': message.message_id,
+            'messageDate': format_datetime(message.message_date),
+            'userId': message.message_sender_id,
+            'userName': message.message_sender.user_name,
+            'messageText': message.message_text
+        } for message in page]
+
+
+def ndjson_chunks(pages):
+    for page in pages:
+        yield b''.join(dumps(record) + b'\n' for record in page)
+
+
+def csv_chunks(pages):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_COLUMNS)
+    writer.writeheader()
+    for page in pages:
+        writer.writerows(page)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # Header of an empty export
+        yield buffer.getvalue().encode()
+
+
+def export_chunks(export_format, **filters):
+    # Encoded chunks, one per page of records
+    pages = export_records(**filters)
+    if export_format == 'csv':
+        return csv_chunks(pages)
+    return ndjson_chunks(pages)
+
+
+async def aiter_chunks(chunks):
+    # For requests served by Django's ASGI handler, which reads a plain iterator
+    # in a single sync_to_async(list) call, i.e. buffers the whole export; pages
+    # are pulled one at a time from a thread instead. WSGI streams the plain
+    # iterator as it is.
+    chunks = iter(chunks)
+    while True:
+        chunk = await sync_to_async(next)(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
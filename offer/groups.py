@@ -0,0 +1,13 @@
+# Channel layer group names shared by the views and TextRoomConsumer.
+
+
+def session_group(session_id):
+    return 'session_{}'.format(session_id)
+
+
+def user_group(user_id):
+    return 'user_{}'.format(user_id)
+
+
+def book_group(from_currency_id, to_currency_id):
+    return 'book_{}_{}'.format(from_currency_id, to_currency_id)
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import threading
+import uuid
+
+from asgiref.sync import async_to_sync
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+# Channel layer group of the index listeners of all worker processes
+INDEX_GROUP = 'indexes'
+# Seconds between renewals of the listener's group membership
+INDEX_GROUP_REFRESH = 3600
+
+
+class IndexFeed:
+    # Keeps the per-process indexes of all workers in step. A write applies a
+    # change to its own index and publishes it to INDEX_GROUP; a daemon thread
+    # in every other process receives it and hands it to the handler registered
+    # for its type. Changes carry full values, so one applied after the index
+    # loaded the same row is harmless. Workers only listen once they use an
+    # index, and not at all with the in-process channel layer, which nothing
+    # outside the process shares.
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self.channel = 'index.{}'.format(self.origin)
+        self.handlers = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def register(self, change_type, handler):
+        self.handlers[change_type] = handler
+
+    def publish(self, change_type, **fields):
+        try:
+            async_to_sync(get_channel_layer().group_send)(INDEX_GROUP, {
+                'type': change_type,
+                'origin': self.origin,
+                **fields
+            })
+        except Exception:
+            # The write itself has succeeded; other workers miss this change
+            logger.exception('Publishing %s failed', change_type)
+
+    def start(self):
+        # Called before an index loads, so that no change published during the
+        # load is lost
+        if isinstance(get_channel_layer(), InMemoryChannelLayer):
+            return
+        with self.lock:
+            if self.thread is None:
+                started = threading.Event()
+                self.thread = threading.Thread(target=asyncio.run, args=(self.listen(started),), daemon=True)
+                self.thread.start()
+                started.wait()
+
+    async def listen(self, started):
+        # A plain channel name, so the layer reads it in this thread's own loop
+        layer = get_channel_layer()
+        try:
+            await layer.group_add(INDEX_GROUP, self.channel)
+        except Exception:
+            logger.exception('Joining %s failed', INDEX_GROUP)
+        started.set()
+        refresh = asyncio.ensure_future(self.refresh(layer))
+        try:
+            while True:
+                try:
+                    message = await layer.receive(self.channel)
+                except Exception:
+                    logger.exception('Reading %s failed', self.channel)
+                    await asyncio.sleep(1)
+                    continue
+                handler = self.handlers.get(message.get('type', None), None)
+                if handler is None or message.get('origin', None) == self.origin:
+                    continue
+                try:
+                    handler(message)
+                except Exception:
+                    logger.exception('Applying %s failed', message['type'])
+        finally:
+            refresh.cancel()
+
+    async def refresh(self, layer):
+        while True:
+            await asyncio.sleep(INDEX_GROUP_REFRESH)
+            try:
+                await layer.group_add(INDEX_GROUP, self.channel)
+            except Exception:
+                logger.exception('Joining %s failed', INDEX_GROUP)
+
+
+index_feed = IndexFeed()
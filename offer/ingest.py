@@ -0,0 +1,290 @@
+import atexit
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import caches
+from django.db import connection, transaction, IntegrityError
+from django.db.models import F, Max
+
+from offer.groups import session_group
+from offer.models import Messages, OutboxEvent, Session, SessionUser, Sequence
+from offer.outbox import outbox
+from offer.responsecache import response_cache
+
+logger = logging.getLogger(__name__)
+
+# A batch is written once it holds this many messages...
+MESSAGE_BATCH_SIZE = 100
+# ...or this many seconds after its first message was queued
+MESSAGE_FLUSH_INTERVAL = 0.05
+# Ids the 'message' sequence row gives the shared counter at a time
+MESSAGE_ID_BLOCK = 1000
+# Pipelines that can have unstored messages at the same time
+MESSAGE_PIPELINE_SLOTS = 64
+# Seconds a pipeline slot is kept after its pipeline last touched it
+MESSAGE_SLOT_TIMEOUT = 300
+
+# Django cache keys of the message id counter and of the highest id it may hand out
+MESSAGE_ID_KEY = 'message-id'
+MESSAGE_ID_LIMIT_KEY = 'message-id-limit'
+
+
+def reserveIds(name, count, start):
+    # Write first and read back: the UPDATE takes the row (or SQLite write) lock
+    # before anything is read, so concurrent reservations queue up instead of
+    # deadlocking
+    with transaction.atomic():
+        if not Sequence.objects.filter(name=name).update(next_value=F('next_value') + count):
+            Sequence.objects.create(name=name, next_value=start() + count)
+        next_value = Sequence.objects.get(name=name).next_value
+    return range(next_value - count, next_value)
+
+
+def firstFreeMessageId():
+    return (Messages.objects.aggregate(Max('message_id'))['message_id__max'] or 0) + 1
+
+
+class MessageIds:
+    # Message ids come from a counter in the Django cache (shared by every
+    # worker whenever CACHES points to a shared backend), so they follow
+    # submission order across workers without a database write per message.
+    # The 'message' sequence row is only moved a block at a time and stays
+    # above every id handed out: a counter lost from the cache restarts there.
+    #
+    # Ids are handed out before their rows are written, and a worker may store
+    # a higher id before another worker stores a lower one. A pipeline with
+    # unstored messages holds a slot in the cache with a bound below its
+    # unstored ids; flushed() is the id up to which every message is stored
+    # (or was dropped), and readers go no further than that.
+    #
+    # The same ids number the socket frames kept by offer.outbox: a message
+    # frame's seq is its message id, other frames reserve() one.
+    def __init__(self, cache_alias='default'):
+        self.cache_alias = cache_alias
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def slot_key(slot):
+        return 'message-pipeline:{}'.format(slot)
+
+    def current(self):
+        # The last id handed out
+        current = self.cache.get(MESSAGE_ID_KEY)
+        if current is None:
+            block = reserveIds('message', MESSAGE_ID_BLOCK, firstFreeMessageId)
+            if self.cache.add(MESSAGE_ID_KEY, block.start - 1, None):
+                self.cache.set(MESSAGE_ID_LIMIT_KEY, block[-1], None)
+            current = self.cache.get(MESSAGE_ID_KEY)
+        return current
+
+    def next(self):
+        # Must be called outside of a transaction: a rolled back block would be
+        # handed out again
+        try:
+            message_id = self.cache.incr(MESSAGE_ID_KEY)
+        except ValueError:
+            self.current()
+            message_id = self.cache.incr(MESSAGE_ID_KEY)
+        while message_id > self.cache.get(MESSAGE_ID_LIMIT_KEY, 0):
+            limit = reserveIds('message', MESSAGE_ID_BLOCK, firstFreeMessageId)[-1]
+            self.cache.set(MESSAGE_ID_LIMIT_KEY, limit, None)
+        return message_id
+
+    def hold_slot(self):
+        # A slot whose bound is below every id handed out from now on
+        lowest = self.current() + 1
+        for slot in range(MESSAGE_PIPELINE_SLOTS):
+            if self.cache.add(self.slot_key(slot), lowest, MESSAGE_SLOT_TIMEOUT):
+                return slot
+        raise RuntimeError('Every message pipeline slot is taken')
+
+    def move_slot(self, slot, lowest):
+        self.cache.set(self.slot_key(slot), lowest, MESSAGE_SLOT_TIMEOUT)
+
+    def release_slot(self, slot):
+        self.cache.delete(self.slot_key(slot))
+
+    @contextmanager
+    def reserve(self):
+        # An id for a row stored right away instead of through a pipeline; the
+        # slot keeps flushed() below it until the block exits
+        slot = self.hold_slot()
+        try:
+            yield self.next()
+        finally:
+            self.release_slot(slot)
+
+    def wait_flushed(self, target, timeout):
+        # flushed() once it reaches target, or after timeout seconds
+        deadline = time.monotonic() + timeout
+        flushed = self.flushed()
+        while flushed < target and time.monotonic() < deadline:
+            time.sleep(MESSAGE_FLUSH_INTERVAL)
+            flushed = self.flushed()
+        return flushed
+
+    def flushed(self):
+        # The counter is read before the slots: an id handed out by a pipeline
+        # whose slot was not seen yet is above it
+        last = self.cache.get(MESSAGE_ID_KEY)
+        if last is None:
+            last = firstFreeMessageId() - 1
+        bounds = self.cache.get_many([self.slot_key(slot) for slot in range(MESSAGE_PIPELINE_SLOTS)])
+        return min([last] + [lowest - 1 for lowest in bounds.values()])
+
+
+message_ids = MessageIds()
+
+
+class MessagePipeline:
+    # Write-behind queue for chat messages. submit() gives the message its id
+    # right away (see MessageIds) so it can be fanned out before it is stored.
+    # Rows are then written with bulk_create in batches, in submission order,
+    # and each batch advances Session.last_message_date with one conditional
+    # UPDATE per session. While messages are queued or being written the
+    # pipeline holds a MessageIds slot, moved up past every written batch.
+    # A batch that fails to write goes back to the head of the queue, and the
+    # queue is drained when the process exits.
+    def __init__(self, batch_size=MESSAGE_BATCH_SIZE, flush_interval=MESSAGE_FLUSH_INTERVAL, ids=message_ids):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.ids = ids
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = []
+        self.slot = None
+        self.timer = None
+
+    def submit(self, message: Messages):
+        # Must be called outside of a transaction (see MessageIds.next).
+        # Reserving and queueing under one lock keeps the queue in id order.
+        with self.lock:
+            if self.slot is None:
+                self.slot = self.ids.hold_slot()
+            message.message_id = self.ids.next()
+            self.pending.append(message)
+            full = len(self.pending) >= self.batch_size
+            if not full:
+                self.schedule()
+        if full:
+            self.try_flush()
+        return message
+
+    def schedule(self):
+        # Called with self.lock held
+        if self.timer is None:
+            self.timer = threading.Timer(self.flush_interval, self.flush_in_background)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush_in_background(self):
+        try:
+            self.try_flush()
+        finally:
+            connection.close()
+
+    def try_flush(self):
+        # The messages are already acknowledged, so a failed write is retried
+        # later instead of failing the caller
+        try:
+            self.flush()
+        except Exception:
+            logger.exception('Message flush failed, batch kept for the next flush')
+            with self.lock:
+                if self.slot is not None and self.pending:
+                    # Keeps the slot from timing out while the writes fail
+                    self.ids.move_slot(self.slot, self.pending[0].message_id)
+                self.schedule()
+
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, []
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+            if not batch:
+                return
+            try:
+                self.write(batch)
+            except Exception:
+                with self.lock:
+                    self.pending[:0] = batch
+                raise
+            with self.lock:
+                if self.pending:
+                    self.ids.move_slot(self.slot, self.pending[0].message_id)
+                else:
+                    self.ids.release_slot(self.slot)
+                    self.slot = None
+
+    def write(self, batch):
+        try:
+            self.store(batch)
+        except IntegrityError:
+            # One bad row must not hold back the rest. Messages are checked before
+            # they are queued, so this is a session or sender deleted since.
+            failed = []
+            for message in batch:
+                try:
+                    self.store([message])
+                except IntegrityError:
+                    logger.exception('Could not store message %s of session %s', message.message_id,
+                                     message.message_session_id)
+                    failed.append(message)
+            self.report_failed(failed)
+
+    def report_failed(self, messages):
+        # The messages were acknowledged and fanned out already: the sockets of
+        # the session are told to take them back
+        for message in messages:
+            try:
+                async_to_sync(get_channel_layer().group_send)(session_group(message.message_session_id), {
+                    'type': 'message_failed',
+                    'sessionId': message.message_session_id,
+                    'messageId': message.message_id
+                })
+            except Exception:
+                logger.exception('Could not report message %s as failed', message.message_id)
+
+    def store(self, batch):
+        latest = {}
+        for message in batch:
+            session_id = message.message_session_id
+            if session_id not in latest or latest[session_id] < message.message_date:
+                latest[session_id] = message.message_date
+
+        participants = {}
+        for session_id, user_id in SessionUser.objects.filter(session_id__in=latest).values_list('session_id',
+                                                                                                'user_id'):
+            participants.setdefault(session_id, []).append(user_id)
+
+        with transaction.atomic():
+            Messages.objects.bulk_create(batch)
+            for session_id, message_date in latest.items():
+                Session.objects.filter(session_id=session_id, last_message_date__lt=message_date) \
+                    .update(last_message_date=message_date)
+            # For every participant, the sender included: any of their devices
+            # that was not connected replays the messages when it reconnects
+            outbox.add([OutboxEvent(user_id=user_id, seq=message.message_id, message=message) for message in batch
+                        for user_id in participants.get(message.message_session_id, ())])
+        # Session lists of the participants now show the new messages
+        response_cache.invalidate(user_id for user_ids in participants.values() for user_id in user_ids)
+
+    def drain(self):
+        try:
+            while self.pending:
+                self.flush()
+        except Exception:
+            logger.exception('Could not drain %s queued message(s)', len(self.pending))
+
+
+message_pipeline = MessagePipeline()
+atexit.register(message_pipeline.drain)
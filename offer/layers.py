@@ -0,0 +1,276 @@
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+import uuid
+import weakref
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+from redis.asyncio import BlockingConnectionPool, Redis
+from redis.exceptions import NoScriptError
+
+logger = logging.getLogger(__name__)
+
+# Pushes the frame for each list in KEYS that holds fewer frames than its
+# capacity and refreshes that list's expiry, in one step on the server. ARGV is
+# the expiry, then a capacity and a frame per key; returns 1 or 0 per key.
+PUSH_SCRIPT = """
+local pushed = {}
+for index, key in ipairs(KEYS) do
+    if redis.call('LLEN', key) < tonumber(ARGV[index * 2]) then
+        redis.call('RPUSH', key, ARGV[index * 2 + 1])
+        redis.call('EXPIRE', key, ARGV[1])
+        pushed[index] = 1
+    else
+        pushed[index] = 0
+    end
+end
+return pushed
+"""
+PUSH_SCRIPT_SHA = hashlib.sha1(PUSH_SCRIPT.encode()).hexdigest()
+
+
+class HashRing:
+    # Consistent hashing of names onto shards: each shard owns `replicas` points
+    # on the ring and a name goes to the first point after its own hash, so adding
+    # a shard only moves the names that land on its new points.
+    def __init__(self, nodes, replicas=100):
+        points = sorted((self.hash('{}#{}'.format(node, replica)), index)
+                        for index, node in enumerate(nodes) for replica in range(replicas))
+        self.keys = [point for point, _ in points]
+        self.nodes = [index for _, index in points]
+
+    @staticmethod
+    def hash(value):
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+    def get(self, name):
+        return self.nodes[bisect.bisect(self.keys, self.hash(name)) % len(self.keys)]
+
+
+class ShardedRedisChannelLayer(BaseChannelLayer):
+    # Channel layer over one or more Redis servers, so that every ASGI worker
+    # pointed at the same hosts shares group fan-out. Channel queues and groups
+    # are spread over the hosts with a HashRing, and each host is reached through
+    # a bounded connection pool (one set of pools per event loop).
+    #
+    # Process-specific channels ("specific.<process>!<socket>") of one layer
+    # share a single Redis list, read by one BLPOP loop that fills a local
+    # buffer per channel, so open sockets do not each hold a connection. A
+    # group_send puts one frame on that list for all of the process's members,
+    # and capacity applies to each local buffer; process_capacity only bounds
+    # the shared list, e.g. for a worker that went away.
+    extensions = ['groups', 'flush']
+
+    def __init__(self, hosts=None, prefix='asgi', expiry=60, group_expiry=86400, capacity=100,
+                 channel_capacity=None, process_capacity=10000, pool_size=50, blpop_timeout=5):
+        super().__init__(expiry=expiry, capacity=capacity)
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.process_capacity = process_capacity
+        self.hosts = hosts or ['redis://localhost:6379/0']
+        self.ring = HashRing(self.hosts)
+        self.prefix = prefix
+        self.group_expiry = group_expiry
+        self.pool_size = pool_size
+        self.blpop_timeout = blpop_timeout
+        self.process_channel = 'specific.{}!'.format(uuid.uuid4().hex)
+        self.clients = weakref.WeakKeyDictionary()
+        self.buffers = {}
+        self.reader = None
+
+    # Connections
+
+    def clients_for_loop(self):
+        loop = asyncio.get_running_loop()
+        clients = self.clients.get(loop)
+        if clients is None:
+            clients = self.clients[loop] = [
+                Redis(connection_pool=BlockingConnectionPool.from_url(host, max_connections=self.pool_size))
+                for host in self.hosts
+            ]
+            self.close_with_loop(loop)
+        return clients
+
+    def close_with_loop(self, loop):
+        # async_to_sync gives each call from a sync view a short lived loop of its
+        # own; disconnect that loop's pools when it closes instead of leaking them
+        close = loop.close
+
+        def close_loop():
+            for client in self.clients.pop(loop, []):
+                loop.run_until_complete(client.connection_pool.disconnect())
+            close()
+
+        loop.close = close_loop
+
+    def connection(self, key):
+        return self.clients_for_loop()[self.ring.get(key)]
+
+    # Keys and wire format
+
+    def channel_key(self, channel):
+        return '{}:channel:{}'.format(self.prefix, self.non_local_name(channel))
+
+    def group_key(self, group):
+        return '{}:group:{}'.format(self.prefix, group)
+
+    @staticmethod
+    def pack(message):
+        return msgpack.packb(message, use_bin_type=True)
+
+    @staticmethod
+    def frame(channels, body):
+        # The target channels, comma separated: channel names never contain a
+        # comma or a newline, so the packed body can follow them
+        return ','.join(channels).encode() + b'\n' + body
+
+    @staticmethod
+    def unframe(frame):
+        channels, body = frame.split(b'\n', 1)
+        return channels.decode().split(','), msgpack.unpackb(body, raw=False, strict_map_key=False)
+
+    def is_process_key(self, key):
+        return key.endswith('!')
+
+    def key_capacity(self, key, channels):
+        if self.is_process_key(key):
+            return self.process_capacity
+        return self.get_capacity(channels[0])
+
+    # Channel layer API
+
+    async def new_channel(self, prefix='specific'):
+        channel = '{}{}.{}'.format(self.process_channel, prefix, uuid.uuid4().hex)
+        self.buffers[channel] = self.new_buffer(channel)
+        return channel
+
+    def new_buffer(self, channel):
+        return asyncio.Queue(maxsize=self.get_capacity(channel))
+
+    async def send(self, channel, message):
+        # A full local buffer of a process-specific channel drops the message
+        # when it is read, like group_send does for every member
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        key = self.channel_key(channel)
+        if not await self.push(self.connection(key), {key: [channel]}, self.pack(message)):
+            raise ChannelFull()
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        if not channel.startswith(self.process_channel):
+            key = self.channel_key(channel)
+            while True:
+                result = await self.connection(key).blpop(key, timeout=self.blpop_timeout)
+                if result is not None:
+                    return self.unframe(result[1])[1]
+
+        buffer = self.buffers.get(channel, None)
+        if buffer is None:
+            buffer = self.buffers[channel] = self.new_buffer(channel)
+        if self.reader is None or self.reader.done():
+            self.reader = asyncio.ensure_future(self.read_process_channel())
+        try:
+            return await buffer.get()
+        except asyncio.CancelledError:
+            # The consumer is gone, messages still on the way to it are dropped
+            self.buffers.pop(channel, None)
+            raise
+
+    async def read_process_channel(self):
+        key = self.channel_key(self.process_channel)
+        while self.buffers:
+            try:
+                result = await self.connection(key).blpop(key, timeout=self.blpop_timeout)
+            except Exception:
+                logger.exception('Reading %s failed', key)
+                await asyncio.sleep(1)
+                continue
+            if result is None:
+                continue
+            channels, message = self.unframe(result[1])
+            for channel in channels:
+                buffer = self.buffers.get(channel, None)
+                if buffer is None:
+                    continue
+                try:
+                    buffer.put_nowait(message)
+                except asyncio.QueueFull:
+                    # Like a full channel on the other layers, this socket misses the message
+                    pass
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        key = self.group_key(group)
+        async with self.connection(key).pipeline(transaction=False) as pipe:
+            pipe.zadd(key, {channel: time.time()})
+            pipe.expire(key, self.group_expiry)
+            await pipe.execute()
+
+    async def group_discard(self, group, channel):
+        assert self.valid_group_name(group), 'Group name not valid'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        key = self.group_key(group)
+        await self.connection(key).zrem(key, channel)
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), 'Group name not valid'
+        key = self.group_key(group)
+        async with self.connection(key).pipeline(transaction=False) as pipe:
+            pipe.zremrangebyscore(key, 0, time.time() - self.group_expiry)
+            pipe.zrange(key, 0, -1)
+            _, channels = await pipe.execute()
+
+        # The message is packed once, each process list gets one frame naming
+        # its members there, and every shard holding member queues gets one
+        # pipelined push; like the other layers, members whose queue is full
+        # silently miss the message
+        body = self.pack(message)
+        shards = {}
+        for channel in channels:
+            channel = channel.decode()
+            channel_key = self.channel_key(channel)
+            shards.setdefault(self.ring.get(channel_key), {}).setdefault(channel_key, []).append(channel)
+        clients = self.clients_for_loop()
+        await asyncio.gather(*(self.push(clients[shard], keys, body) for shard, keys in shards.items()))
+
+    async def push(self, connection, keys, body):
+        # keys maps each Redis list to the channels the frame is for. The
+        # capacity check and the push are one script, so producers racing for
+        # the last free places never take each other's frames. Returns whether
+        # every list took the frame.
+        args = [self.expiry]
+        for key, channels in keys.items():
+            args += [self.key_capacity(key, channels), self.frame(channels, body)]
+        try:
+            pushed = await connection.evalsha(PUSH_SCRIPT_SHA, len(keys), *keys, *args)
+        except NoScriptError:
+            await connection.script_load(PUSH_SCRIPT)
+            pushed = await connection.evalsha(PUSH_SCRIPT_SHA, len(keys), *keys, *args)
+        return all(pushed)
+
+    async def stop_reader(self):
+        # Without buffers the reader loop ends, a frame nobody listens to wakes
+        # up its BLPOP
+        self.buffers = {}
+        if self.reader is not None and not self.reader.done():
+            key = self.channel_key(self.process_channel)
+            await self.connection(key).rpush(key, self.frame([self.process_channel], self.pack({})))
+            await self.reader
+        self.reader = None
+
+    async def flush(self):
+        await self.stop_reader()
+        for client in self.clients_for_loop():
+            keys = await client.keys('{}:*'.format(self.prefix))
+            if keys:
+                await client.delete(*keys)
+
+    async def close(self):
+        await self.stop_reader()
+        for client in self.clients.pop(asyncio.get_running_loop(), []):
+            await client.connection_pool.disconnect()
@@ -0,0 +1,275 @@
+import asyncio
+import fnmatch
+import hashlib
+import threading
+import time
+
+from offer.layers import PUSH_SCRIPT
+
+NULL_ARRAY = object()
+
+
+class CommandError(Exception):
+    prefix = 'ERR'
+
+
+class NoScriptError(CommandError):
+    prefix = 'NOSCRIPT'
+
+
+class LocalRedisServer:
+    # In-process stand-in for a Redis server, speaking RESP2 over TCP and
+    # covering the commands ShardedRedisChannelLayer uses. It runs its own event
+    # loop in a daemon thread, so the channel layer can be exercised offline,
+    # including from several worker processes. Nothing is persisted. Lua is not
+    # run: each script the layer loads has a Python equivalent, found by SHA1.
+    scripts = {
+        hashlib.sha1(PUSH_SCRIPT.encode()).hexdigest(): 'script_push',
+    }
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.loaded = set()
+        self.data = {}
+        self.expires = {}
+        self.waiters = {}
+        self.loop = None
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'redis://{}:{}/0'.format(self.host, self.port)
+
+    def start(self):
+        started = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(started,), daemon=True)
+        self.thread.start()
+        started.wait()
+        return self.url
+
+    def run(self, started):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(asyncio.start_server(self.serve, self.host, self.port))
+        self.port = self.server.sockets[0].getsockname()[1]
+        started.set()
+        self.loop.run_forever()
+
+        self.server.close()
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    # Protocol
+
+    async def serve(self, reader, writer):
+        try:
+            while True:
+                command = await self.read_command(reader)
+                if command is None:
+                    break
+                try:
+                    reply = await self.execute(command, reader)
+                except CommandError as error:
+                    writer.write('-{} {}\r\n'.format(error.prefix, error).encode())
+                else:
+                    writer.write(self.encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_command(reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        command = []
+        for _ in range(int(line[1:])):
+            length = int((await reader.readline())[1:])
+            command.append((await reader.readexactly(length + 2))[:-2])
+        return command
+
+    def encode(self, reply):
+        if reply is None:
+            return b'$-1\r\n'
+        if reply is NULL_ARRAY:
+            return b'*-1\r\n'
+        if isinstance(reply, str):
+            return '+{}\r\n'.format(reply).encode()
+        if isinstance(reply, int):
+            return ':{}\r\n'.format(reply).encode()
+        if isinstance(reply, bytes):
+            return b'$%d\r\n%s\r\n' % (len(reply), reply)
+        return b'*%d\r\n' % len(reply) + b''.join(self.encode(item) for item in reply)
+
+    async def execute(self, command, reader):
+        name, args = command[0].decode().lower(), command[1:]
+        handler = getattr(self, 'command_{}'.format(name), None)
+        if handler is None:
+            raise CommandError("unknown command '{}'".format(name))
+        if asyncio.iscoroutinefunction(handler):
+            return await handler(reader, *args)
+        return handler(*args)
+
+    # Keyspace
+
+    def get(self, key, default=None):
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+        return self.data.get(key, default)
+
+    def delete(self, key):
+        self.expires.pop(key, None)
+        return self.data.pop(key, None) is not None
+
+    def drop_if_empty(self, key):
+        if not self.data.get(key):
+            self.delete(key)
+
+    # Commands
+
+    def command_ping(self, *args):
+        return 'PONG'
+
+    def command_expire(self, key, seconds):
+        if self.get(key) is None:
+            return 0
+        self.expires[key] = time.time() + int(seconds)
+        return 1
+
+    def command_del(self, *keys):
+        return sum(self.get(key) is not None and self.delete(key) for key in keys)
+
+    def command_keys(self, pattern):
+        pattern = pattern.decode()
+        return [key for key in list(self.data)
+                if self.get(key) is not None and fnmatch.fnmatchcase(key.decode(), pattern)]
+
+    def command_flushall(self, *args):
+        self.data.clear()
+        self.expires.clear()
+        return 'OK'
+
+    def command_rpush(self, key, *values):
+        self.get(key)
+        items = self.data.setdefault(key, [])
+        items.extend(values)
+        for waiter in self.waiters.pop(key, []):
+            if not waiter.done():
+                waiter.set_result(None)
+        return len(items)
+
+    def command_rpop(self, key):
+        items = self.get(key)
+        if not items:
+            return None
+        value = items.pop()
+        self.drop_if_empty(key)
+        return value
+
+    def command_llen(self, key):
+        return len(self.get(key, []))
+
+    async def command_blpop(self, reader, *args):
+        keys, timeout = args[:-1], float(args[-1])
+        deadline = time.monotonic() + timeout if timeout else None
+        # A blocked client sends nothing until it gets its reply, so anything
+        # read meanwhile means it went away; like Redis, its BLPOP is dropped
+        # then instead of popping an item nobody will receive
+        gone = asyncio.ensure_future(reader.read(1))
+        try:
+            while True:
+                for key in keys:
+                    items = self.get(key)
+                    if items:
+                        value = items.pop(0)
+                        self.drop_if_empty(key)
+                        return [key, value]
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return NULL_ARRAY
+                waiter = self.loop.create_future()
+                for key in keys:
+                    self.waiters.setdefault(key, []).append(waiter)
+                try:
+                    await asyncio.wait([waiter, gone], timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    for key in keys:
+                        if waiter in self.waiters.get(key, []):
+                            self.waiters[key].remove(waiter)
+                if gone.done():
+                    raise ConnectionError()
+        finally:
+            gone.cancel()
+            await asyncio.wait([gone])
+
+    def command_script(self, subcommand, *args):
+        if subcommand.lower() != b'load':
+            raise CommandError("unknown subcommand '{}'".format(subcommand.decode()))
+        sha = hashlib.sha1(args[0]).hexdigest()
+        if sha not in self.scripts:
+            raise CommandError('script not supported')
+        self.loaded.add(sha)
+        return sha.encode()
+
+    def command_evalsha(self, sha, numkeys, *args):
+        sha = sha.decode()
+        if sha not in self.loaded:
+            raise NoScriptError('No matching script. Please use EVAL.')
+        keys, argv = args[:int(numkeys)], args[int(numkeys):]
+        # Runs without awaiting, so nothing else happens in between, as in Redis
+        return getattr(self, self.scripts[sha])(keys, argv)
+
+    def script_push(self, keys, argv):
+        pushed = []
+        for index, key in enumerate(keys):
+            if self.command_llen(key) < int(argv[index * 2 + 1]):
+                self.command_rpush(key, argv[index * 2 + 2])
+                self.command_expire(key, argv[0])
+                pushed.append(1)
+            else:
+                pushed.append(0)
+        return pushed
+
+    def command_zadd(self, key, *args):
+        self.get(key)
+        members = self.data.setdefault(key, {})
+        added = 0
+        for score, member in zip(args[::2], args[1::2]):
+            added += member not in members
+            members[member] = float(score)
+        return added
+
+    def command_zrem(self, key, *members):
+        current = self.get(key, {})
+        removed = sum(current.pop(member, None) is not None for member in members)
+        self.drop_if_empty(key)
+        return removed
+
+    def command_zrange(self, key, start, stop):
+        members = sorted(self.get(key, {}).items(), key=lambda item: (item[1], item[0]))
+        start, stop = int(start), int(stop)
+        stop = len(members) + stop if stop < 0 else stop
+        return [member for member, _ in members[start:stop + 1]]
+
+    def command_zremrangebyscore(self, key, minimum, maximum):
+        current = self.get(key, {})
+        minimum, maximum = float(minimum), float(maximum)
+        removed = [member for member, score in current.items() if minimum <= score <= maximum]
+        for member in removed:
+            del current[member]
+        self.drop_if_empty(key)
+        return len(removed)
@@ -0,0 +1,11 @@
+from django.core.management.base import CommandError
+from django.db import connection
+
+
+def require_benchmark_database(command):
+    # Benchmarks write rows of their own, and what they publish on the way
+    # (order book changes, message ids, outbox events) reaches other workers,
+    # so they refuse to run against anything but a throwaway SQLite database
+    if connection.vendor != 'sqlite':
+        raise CommandError('{} writes to the database, run it with '
+                           '--settings=obmennik.benchmark_settings'.format(command))
@@ -0,0 +1,426 @@
+import asyncio
+import json
+import os
+import random
+import time
+from datetime import datetime, timedelta
+from urllib.parse import urlencode
+
+from channels.routing import URLRouter
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from obmennik.metrics import metrics
+from offer.management.benchmarks import require_benchmark_database
+from offer.models import User, Currency, Offer, Session, SessionUser, Messages
+from offer.routing import websocket_urlpatterns
+
+# Fields compared against a previous run, and whether a higher value is worse
+COMPARED_FIELDS = {'p95_ms': True, 'queries_mean': True, 'throughput_rps': False}
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    return {
+        'p50_ms': round(latencies[len(latencies) // 2] * 1e3, 3),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1e3, 3),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1e3, 3),
+    }
+
+
+async def get_response(communicator, timeout):
+    # HttpCommunicator.get_response() expects a body in every message, but
+    # Django's ASGI handler ends a streaming response with an empty one
+    await communicator.send_input({'type': 'http.request', 'body': communicator.body})
+    response = await communicator.receive_output(timeout)
+    response['body'] = b''
+    while True:
+        chunk = await communicator.receive_output(timeout)
+        response['body'] += chunk.get('body', b'')
+        if not chunk.get('more_body', False):
+            return response
+
+
+class Seed:
+    # Ids of the seeded rows, for building valid requests
+    def __init__(self, rng):
+        self.rng = rng
+        self.user_ids = []
+        self.currency_ids = []
+        self.offers = []
+        self.watchlist = []
+        self.sessions = []
+
+    def user(self):
+        return self.rng.choice(self.user_ids)
+
+    def pair(self):
+        return self.rng.sample(self.currency_ids, 2)
+
+    def offer(self):
+        return self.rng.choice(self.offers)
+
+    def session(self):
+        return self.rng.choice(self.sessions)
+
+
+class Command(BaseCommand):
+    help = ('Seed a fresh SQLite database and load test every REST endpoint and ws/<user_id>/, reporting '
+            'latency percentiles, throughput and queries per request. '
+            'Run with --settings=obmennik.benchmark_settings')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--currencies', type=int, default=20)
+        parser.add_argument('--offers', type=int, default=5000)
+        parser.add_argument('--sessions', type=int, default=1000)
+        parser.add_argument('--messages', type=int, default=20000)
+        parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint')
+        parser.add_argument('--bulk-items', type=int, default=20, help='Items per offer/bulk/ request')
+        parser.add_argument('--concurrency', type=int, default=10)
+        parser.add_argument('--sockets', type=int, default=100)
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', default='benchmark.json')
+        parser.add_argument('--compare', help='Results of an earlier run to check for regressions')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Allowed relative slowdown against --compare before a run fails')
+
+    def handle(self, *args, **options):
+        require_benchmark_database('benchmark_api')
+        database = settings.DATABASES['default']
+        if str(database['NAME']) == ':memory:':
+            raise CommandError('benchmark_api recreates the database, run it with '
+                               '--settings=obmennik.benchmark_settings')
+
+        connection.close()
+        if os.path.exists(database['NAME']):
+            os.remove(database['NAME'])
+        call_command('migrate', run_syncdb=True, verbosity=0)
+        with connection.cursor() as cursor:
+            # Lets the readers run while a writer commits
+            cursor.execute('PRAGMA journal_mode=WAL')
+
+        seed = self.seed(options)
+        self.stdout.write('Seeded {} users, {} currencies, {} offers, {} sessions, {} messages'.format(
+            options['users'], options['currencies'], options['offers'], options['sessions'], options['messages']))
+
+        results = asyncio.run(self.run(seed, options))
+        results['options'] = {name: options[name] for name in (
+            'users', 'currencies', 'offers', 'sessions', 'messages', 'requests', 'bulk_items', 'concurrency', 'sockets',
+            'seed')}
+
+        for name, result in list(results['endpoints'].items()) + list(results['websocket'].items()):
+            self.stdout.write('{:<28} p50 {:>8.2f}ms p95 {:>8.2f}ms p99 {:>8.2f}ms {:>8.0f} req/s{}'.format(
+                name, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['throughput_rps'],
+                '' if result.get('queries_mean') is None else ' {:>6.1f} queries'.format(result['queries_mean'])))
+
+        with open(options['output'], 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        self.stdout.write('Results written to {}'.format(options['output']))
+
+        if options['compare']:
+            self.compare(results, options['compare'], options['tolerance'])
+
+    # Seeding
+
+    def seed(self, options):
+        rng = random.Random(options['seed'])
+        seed = Seed(rng)
+
+        Currency.objects.bulk_create([
+            Currency(name='Currency {}'.format(index), capital_name='C{}'.format(index), unicode_symbol='C',
+                     color_hex='#{:06x}'.format(rng.randrange(1 << 24)))
+            for index in range(options['currencies'])
+        ])
+        seed.currency_ids = list(Currency.objects.values_list('currency_id', flat=True))
+
+        User.objects.bulk_create([User(user_name='User {}'.format(index), user_rating=0)
+                                  for index in range(options['users'])], batch_size=1000)
+        seed.user_ids = list(User.objects.values_list('user_id', flat=True))
+
+        offers = []
+        for _ in range(options['offers']):
+            from_currency_id, to_currency_id = seed.pair()
+            from_amount = rng.randint(1, 10000)
+            exchange_rate = round(rng.uniform(0.01, 100), 4)
+            offers.append(Offer(from_currency_id=from_currency_id, to_currency_id=to_currency_id,
+                                from_amount=from_amount, to_amount=from_amount * exchange_rate,
+                                exchange_rate=exchange_rate, user_id=seed.user()))
+        Offer.objects.bulk_create(offers, batch_size=1000)
+        seed.offers = list(Offer.objects.values_list('offer_id', 'user_id', 'from_currency_id', 'to_currency_id'))
+
+        watchlist = {(seed.user(), seed.offer()[0]) for _ in range(options['users'] * 5)}
+        User.user_watchlist.through.objects.bulk_create(
+            [User.user_watchlist.through(user_id=user_id, offer_id=offer_id) for user_id, offer_id in watchlist],
+            batch_size=1000)
+        seed.watchlist = sorted(watchlist)
+
+        Session.objects.bulk_create([Session(offer_id=offer_id, session_owner_id=owner_id)
+                                     for offer_id, owner_id, _, _ in rng.choices(seed.offers, k=options['sessions'])],
+                                    batch_size=1000)
+        sessions = list(Session.objects.values_list('session_id', 'session_owner_id'))
+        seed.sessions = [(session_id, owner_id, seed.user()) for session_id, owner_id in sessions]
+        SessionUser.objects.bulk_create(
+            [SessionUser(session_id=session_id, user_id=user_id)
+             for session_id, owner_id, other_id in seed.sessions for user_id in {owner_id, other_id}],
+            batch_size=1000)
+
+        started = datetime(2023, 1, 1)
+        latest = {}
+        messages = []
+        for index in range(options['messages']):
+            session_id, owner_id, other_id = seed.session()
+            message_date = started + timedelta(seconds=index)
+            latest[session_id] = message_date
+            messages.append(Messages(message_sender_id=rng.choice((owner_id, other_id)), message_date=message_date,
+                                     message_session_id=session_id, message_text='Message {}'.format(index)))
+        Messages.objects.bulk_create(messages, batch_size=2000)
+        Session.objects.bulk_update([Session(session_id=session_id, last_message_date=message_date)
+                                     for session_id, message_date in latest.items()],
+                                    ['last_message_date'], batch_size=1000)
+        return seed
+
+    # Requests
+
+    def scenarios(self, seed, options):
+        # (name, method, builder) in run order, session/close/ last since it
+        # changes the sessions the other endpoints use. A builder returns the
+        # path with its query string and the JSON body.
+        rng = seed.rng
+        watchlist = list(seed.watchlist)
+        rng.shuffle(watchlist)
+        sessions_to_close = [session_id for session_id, _, _ in seed.sessions]
+        rng.shuffle(sessions_to_close)
+
+        def query(path, **params):
+            return '{}?{}'.format(path, urlencode(params))
+
+        def offer_book():
+            from_currency_id, to_currency_id = seed.pair()
+            return query('/offer/book/', userId=seed.user(), fromCurrencyId=from_currency_id,
+                         toCurrencyId=to_currency_id), None
+
+        def offer_match():
+            from_currency_id, to_currency_id = seed.pair()
+            return query('/offer/match/', userId=seed.user(), fromCurrencyId=from_currency_id,
+                         toCurrencyId=to_currency_id, exchangeRate=round(rng.uniform(0.01, 100), 4)), None
+
+        def offer_create():
+            from_currency_id, to_currency_id = seed.pair()
+            return '/offer/create/', {'creatorId': seed.user(), 'fromCurrencyId': from_currency_id,
+                                      'toCurrencyId': to_currency_id, 'fromAmount': 100, 'toAmount': 200,
+                                      'exchangeRate': 2}
+
+        def offer_edit():
+            offer_id, user_id, from_currency_id, to_currency_id = seed.offer()
+            return '/offer/edit/', {'offerId': offer_id, 'creatorId': user_id, 'fromCurrencyId': from_currency_id,
+                                    'toCurrencyId': to_currency_id, 'fromAmount': 100,
+                                    'toAmount': 300, 'exchangeRate': 3}
+
+        def offer_bulk():
+            # Creates in random pairs plus a reprice of one of the creator's offers
+            offer_id, user_id, from_currency_id, to_currency_id = seed.offer()
+            items = [{'action': 'update', 'offerId': offer_id, 'toAmount': 300, 'exchangeRate': 3}]
+            for _ in range(options['bulk_items'] - 1):
+                from_currency_id, to_currency_id = seed.pair()
+                items.append({'action': 'create', 'fromCurrencyId': from_currency_id, 'toCurrencyId': to_currency_id,
+                              'fromAmount': 100, 'toAmount': 200, 'exchangeRate': 2})
+            return '/offer/bulk/', {'creatorId': user_id, 'offers': items}
+
+        def remove_watchlist():
+            user_id, offer_id = watchlist.pop() if watchlist else (seed.user(), seed.offer()[0])
+            return query('/user/removeWatchlist/', userId=user_id, offerId=offer_id), None
+
+        def session_create():
+            offer_id, owner_id, _, _ = seed.offer()
+            return '/session/create/', {'ownerId': owner_id, 'userIds': list({owner_id, seed.user()}),
+                                        'offerId': offer_id,
+                                        'initialMessage': {'senderId': owner_id, 'messageDate': '2023-06-01 00:00:00',
+                                                           'messageText': 'Hello'}}
+
+        def session_send_message():
+            session_id, owner_id, _ = seed.session()
+            return '/session/sendMessage/', {'senderId': owner_id, 'sessionId': session_id,
+                                             'messageDate': '2023-06-01 00:00:00', 'messageText': 'Hello'}
+
+        def session_messages():
+            session_id, owner_id, _ = seed.session()
+            return query('/session/messages/', userId=owner_id, sessionId=session_id), None
+
+        def session_mark_read():
+            session_id, owner_id, _ = seed.session()
+            return query('/session/markRead/', userId=owner_id, sessionId=session_id, messageId=1 << 30), None
+
+        def search():
+            # Prefixes of seeded user and currency names, from broad to exact
+            text = rng.choice(('User {}'.format(rng.randrange(len(seed.user_ids))),
+                               'Currency {}'.format(rng.randrange(len(seed.currency_ids)))))
+            return query('/search/', userId=seed.user(), query=text[:rng.randint(1, len(text))]), None
+
+        def session_close():
+            session_id = sessions_to_close.pop() if sessions_to_close else seed.session()[0]
+            return query('/session/close/', sessionId=session_id), None
+
+        return [
+            ('user/create/', 'POST', lambda: ('/user/create/', None)),
+            ('user/getOffers/', 'GET', lambda: (query('/user/getOffers/', userId=seed.user()), None)),
+            ('user/watchlist/', 'GET', lambda: (query('/user/watchlist/', userId=seed.user()), None)),
+            ('user/addWatchlist/', 'POST',
+             lambda: (query('/user/addWatchlist/', userId=seed.user(), offerId=seed.offer()[0]), None)),
+            ('user/removeWatchlist/', 'POST', remove_watchlist),
+            ('user/addWatchlistBulk/', 'POST',
+             lambda: ('/user/addWatchlistBulk/', {'userId': seed.user(),
+                                                  'offerIds': [seed.offer()[0] for _ in range(20)]})),
+            ('user/removeWatchlistBulk/', 'POST',
+             lambda: ('/user/removeWatchlistBulk/', {'userId': seed.user(),
+                                                     'offerIds': [seed.offer()[0] for _ in range(20)]})),
+            ('user/rename/', 'POST', lambda: (query('/user/rename/', userId=seed.user(), newName='Renamed'), None)),
+            ('user/info/', 'GET', lambda: (query('/user/info/', userId=seed.user()), None)),
+            ('user/updateRating/', 'POST',
+             lambda: (query('/user/updateRating/', userId=seed.user(), newRating=rng.randint(1, 5)), None)),
+            ('currency/getList/', 'GET', lambda: ('/currency/getList/', None)),
+            ('currency/add/', 'POST',
+             lambda: ('/currency/add/', {'data': [{'name': 'Added', 'capitalName': 'ADD', 'unicodeSymbol': 'A',
+                                                   'colorHex': '#000000'}]})),
+            ('offer/getList/', 'GET', lambda: (query('/offer/getList/', userId=seed.user()), None)),
+            ('offer/book/', 'GET', offer_book),
+            ('offer/match/', 'GET', offer_match),
+            ('offer/create/', 'POST', offer_create),
+            ('offer/edit/', 'POST', offer_edit),
+            ('offer/bulk/', 'POST', offer_bulk),
+            ('session/create/', 'POST', session_create),
+            ('session/sendMessage/', 'POST', session_send_message),
+            ('session/messages/', 'GET', session_messages),
+            ('session/export/', 'GET', lambda: (query('/session/export/', userId=seed.user()), None)),
+            ('session/markRead/', 'POST', session_mark_read),
+            ('session/list/', 'GET', lambda: (query('/session/list/', userId=seed.user()), None)),
+            ('search/', 'GET', search),
+            ('metrics/', 'GET', lambda: ('/metrics/', None)),
+            ('session/close/', 'POST', session_close),
+        ]
+
+    async def run(self, seed, options):
+        application = get_asgi_application()
+        results = {'endpoints': {}, 'websocket': {}}
+        for route, method, build in self.scenarios(seed, options):
+            requests = [build() for _ in range(options['requests'])]
+            results['endpoints'][route] = await self.run_endpoint(application, route, method, requests,
+                                                                  options['concurrency'])
+        results['websocket'] = await self.run_websocket(seed, options)
+        return results
+
+    async def run_endpoint(self, application, route, method, requests, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+        statuses = {}
+        metrics.request_queries.series.pop((route, method), None)
+
+        async def request(path, body):
+            async with semaphore:
+                payload = json.dumps(body).encode() if body is not None else b''
+                headers = [(b'host', b'localhost'), (b'content-type', b'application/json'),
+                           (b'content-length', str(len(payload)).encode())]
+                communicator = HttpCommunicator(application, method, path, payload, headers)
+                started = time.perf_counter()
+                response = await get_response(communicator, timeout=60)
+                elapsed = time.perf_counter() - started
+                statuses[response['status']] = statuses.get(response['status'], 0) + 1
+                return elapsed
+
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(request(path, body) for path, body in requests))
+        elapsed = time.perf_counter() - started
+
+        # The query counts come from MetricsMiddleware, which sees every request
+        _, count, total = metrics.request_queries.series.get((route, method), (None, 0, 0))
+        return {
+            **percentiles(latencies),
+            'throughput_rps': round(len(latencies) / elapsed, 1),
+            'queries_mean': round(total / count, 2) if count else None,
+            'query_budget': getattr(settings, 'QUERY_BUDGETS', {}).get(route, None),
+            'statuses': {str(status): number for status, number in sorted(statuses.items())},
+        }
+
+    async def run_websocket(self, seed, options):
+        application = URLRouter(websocket_urlpatterns)
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        sessions = seed.sessions[:options['sockets']]
+        messages_per_socket = max(1, options['requests'] // max(1, len(sessions)))
+
+        async def connect(session):
+            async with semaphore:
+                communicator = WebsocketCommunicator(application, '/ws/{}/'.format(session[1]))
+                started = time.perf_counter()
+                connected, _ = await communicator.connect(timeout=60)
+                if not connected:
+                    raise CommandError('Socket for user {} was rejected'.format(session[1]))
+                return communicator, time.perf_counter() - started
+
+        async def send_messages(communicator, session_id):
+            # Time from sending a sendMessage frame to receiving the message
+            # back through the session group; other frames are skipped
+            latencies = []
+            for index in range(messages_per_socket):
+                client_message_id = '{}-{}'.format(session_id, index)
+                started = time.perf_counter()
+                await communicator.send_json_to({'type': 'sendMessage', 'clientMessageId': client_message_id,
+                                                 'data': {'sessionId': session_id, 'messageText': 'Hello'}})
+                message_id = None
+                while True:
+                    frame = await communicator.receive_json_from(timeout=60)
+                    if frame.get('clientMessageId') == client_message_id:
+                        if frame['responseType'] == 'error':
+                            raise CommandError('sendMessage over ws failed: {}'.format(frame))
+                        message_id = frame['messageId']
+                    elif frame.get('responseType') == 'messageSent' and message_id is not None \
+                            and frame['message']['messageId'] == message_id:
+                        break
+                latencies.append(time.perf_counter() - started)
+            return latencies
+
+        started = time.perf_counter()
+        connected = await asyncio.gather(*(connect(session) for session in sessions))
+        connect_elapsed = time.perf_counter() - started
+
+        started = time.perf_counter()
+        sent = await asyncio.gather(*(send_messages(communicator, session[0])
+                                      for (communicator, _), session in zip(connected, sessions)))
+        send_elapsed = time.perf_counter() - started
+        await asyncio.gather(*(communicator.disconnect() for communicator, _ in connected))
+
+        send_latencies = [latency for latencies in sent for latency in latencies]
+        return {
+            'ws/connect': {**percentiles([latency for _, latency in connected]),
+                           'throughput_rps': round(len(connected) / connect_elapsed, 1)},
+            'ws/sendMessage': {**percentiles(send_latencies),
+                               'throughput_rps': round(len(send_latencies) / send_elapsed, 1)},
+        }
+
+    # Regressions
+
+    def compare(self, results, path, tolerance):
+        with open(path) as previous_file:
+            previous = json.load(previous_file)
+
+        regressions = []
+        for section in ('endpoints', 'websocket'):
+            for name, result in results[section].items():
+                before = previous.get(section, {}).get(name, None)
+                if before is None:
+                    continue
+                for field, higher_is_worse in COMPARED_FIELDS.items():
+                    old, new = before.get(field, None), result.get(field, None)
+                    if old is None or new is None:
+                        continue
+                    if higher_is_worse and new > old * (1 + tolerance) or \
+                            not higher_is_worse and new < old * (1 - tolerance):
+                        regressions.append('{} {}: {} -> {}'.format(name, field, old, new))
+
+        for regression in regressions:
+            self.stdout.write('Regression: {}'.format(regression))
+        if regressions:
+            raise CommandError('{} regression(s) against {}'.format(len(regressions), path))
+        self.stdout.write('No regressions against {}'.format(path))
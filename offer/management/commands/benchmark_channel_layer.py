@@ -0,0 +1,79 @@
+import asyncio
+import multiprocessing
+import time
+
+from django.core.management.base import BaseCommand
+
+from offer.layers import ShardedRedisChannelLayer
+from offer.localredis import LocalRedisServer
+
+
+def run_worker(hosts, groups, messages, workers, barrier, results):
+    results.put(asyncio.run(worker(hosts, groups, messages, workers, barrier)))
+
+
+async def worker(hosts, groups, messages, workers, barrier):
+    # Every worker joins every group with one socket-like channel and sends its
+    # share of group messages, so each message fans out to all workers
+    layer = ShardedRedisChannelLayer(hosts=hosts, capacity=messages * workers)
+    channels = [await layer.new_channel() for _ in range(groups)]
+    for group, channel in enumerate(channels):
+        await layer.group_add('benchmark_{}'.format(group), channel)
+    await asyncio.get_running_loop().run_in_executor(None, barrier.wait)
+
+    started = time.perf_counter()
+    expected = messages * workers // groups
+
+    async def receive(channel):
+        for _ in range(expected):
+            await layer.receive(channel)
+
+    async def send():
+        for index in range(messages):
+            await layer.group_send('benchmark_{}'.format(index % groups), {'type': 'benchmark', 'index': index})
+
+    await asyncio.wait_for(asyncio.gather(send(), *(receive(channel) for channel in channels)), timeout=300)
+    elapsed = time.perf_counter() - started
+    await layer.close()
+    return elapsed
+
+
+class Command(BaseCommand):
+    help = 'Measure group fan-out throughput of the sharded channel layer across several worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hosts', nargs='+', help='Redis URLs, by default in-process local servers are used')
+        parser.add_argument('--shards', type=int, default=2, help='Local servers to start when --hosts is not given')
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+        parser.add_argument('--groups', type=int, default=20)
+        parser.add_argument('--messages', type=int, default=2000, help='Group messages sent by each worker')
+
+    def handle(self, *args, **options):
+        servers = []
+        hosts = options['hosts']
+        if not hosts:
+            servers = [LocalRedisServer() for _ in range(options['shards'])]
+            hosts = [server.start() for server in servers]
+        # Messages must divide evenly over the groups for the receive counts
+        messages = options['messages'] - options['messages'] % options['groups']
+
+        context = multiprocessing.get_context('spawn')
+        try:
+            for workers in options['workers']:
+                barrier = context.Barrier(workers)
+                results = context.Queue()
+                processes = [context.Process(target=run_worker,
+                                             args=(hosts, options['groups'], messages, workers, barrier, results))
+                             for _ in range(workers)]
+                for process in processes:
+                    process.start()
+                elapsed = max(results.get() for _ in processes)
+                for process in processes:
+                    process.join()
+
+                delivered = messages * workers * workers
+                self.stdout.write('{} worker(s): {} group messages, {} deliveries, {:.0f} deliveries/s'.format(
+                    workers, messages * workers, delivered, delivered / elapsed))
+        finally:
+            for server in servers:
+                server.stop()
@@ -0,0 +1,70 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory
+
+from obmennik import view as views
+from obmennik.view import SessionViewSet
+from offer.ingest import MessagePipeline
+from offer.management.benchmarks import require_benchmark_database
+from offer.models import User, Currency, Offer
+
+
+class Command(BaseCommand):
+    help = 'Measure query count and latency of session/create/ for different participant counts'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--participants', nargs='+', type=int, default=[2, 10, 50])
+        parser.add_argument('--repeat', type=int, default=20)
+
+    def handle(self, *args, **options):
+        require_benchmark_database('benchmark_create_session')
+        view = SessionViewSet.as_view({'post': 'create_session'})
+        factory = APIRequestFactory()
+
+        # Everything runs in one transaction that is rolled back at the end, so
+        # the benchmark database keeps no rows. The initial messages go to a
+        # pipeline that is never flushed, so message writes are not part of the
+        # numbers.
+        views.message_pipeline = MessagePipeline(batch_size=float('inf'), flush_interval=3600)
+        with transaction.atomic():
+            users = User.objects.bulk_create(
+                [User(user_name='benchmark', user_rating=0) for _ in range(max(options['participants']))])
+            if users[0].user_id is None:
+                users = list(User.objects.filter(user_name='benchmark').order_by('user_id'))
+            currency = Currency.objects.create(name='benchmark', capital_name='BNC', unicode_symbol='B',
+                                               color_hex='#000000')
+            offer = Offer.objects.create(from_currency=currency, to_currency=currency, from_amount=1, to_amount=1,
+                                         exchange_rate=1, user=users[0])
+
+            for participants in options['participants']:
+                user_ids = [user.user_id for user in users[:participants]]
+                latencies = []
+                queries = 0
+                for _ in range(options['repeat']):
+                    request = factory.post('/session/create/', {
+                        'ownerId': user_ids[0],
+                        'userIds': user_ids,
+                        'offerId': offer.offer_id,
+                        'initialMessage': {
+                            'senderId': user_ids[0],
+                            'messageDate': '2023-01-01 00:00:00',
+                            'messageText': 'benchmark'
+                        }
+                    }, format='json')
+                    with CaptureQueriesContext(connection) as captured:
+                        started = time.perf_counter()
+                        view(request)
+                        latencies.append(time.perf_counter() - started)
+                    queries = len(captured)
+
+                latencies.sort()
+                self.stdout.write('{:>3} participants: {} queries, p50 {:.2f}ms p95 {:.2f}ms'.format(
+                    participants, queries,
+                    latencies[len(latencies) // 2] * 1e3,
+                    latencies[int(len(latencies) * 0.95)] * 1e3,
+                ))
+
+            transaction.set_rollback(True)
@@ -0,0 +1,77 @@
+import asyncio
+import json
+import time
+
+from channels.layers import InMemoryChannelLayer, channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+from obmennik.view import SessionViewSet
+from offer.ingest import message_pipeline
+from offer.management.benchmarks import require_benchmark_database
+from offer.models import User, Currency, Offer, Session, SessionUser
+from offer.routing import websocket_urlpatterns
+
+
+class Command(BaseCommand):
+    help = 'Compare chat messages per second over session/sendMessage/ and over the WebSocket'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        require_benchmark_database('benchmark_messaging')
+        channel_layers.set('default', InMemoryChannelLayer())
+        SessionViewSet.channel_layer = channel_layers['default']
+
+        sender = User.objects.create(user_name='benchmark', user_rating=0)
+        receiver = User.objects.create(user_name='benchmark', user_rating=0)
+        currency = Currency.objects.create(name='benchmark', capital_name='BNC', unicode_symbol='B',
+                                           color_hex='#000000')
+        try:
+            offer = Offer.objects.create(from_currency=currency, to_currency=currency, from_amount=1, to_amount=1,
+                                         exchange_rate=1, user=sender)
+            session = Session.objects.create(session_owner=sender, offer=offer)
+            SessionUser.objects.bulk_create([SessionUser(session=session, user=sender),
+                                             SessionUser(session=session, user=receiver)])
+
+            http = self.run_http(sender.user_id, session.session_id, options['messages'])
+            ws = asyncio.run(self.run_ws(sender.user_id, session.session_id, options['messages']))
+            message_pipeline.drain()
+        finally:
+            User.objects.filter(user_id__in=[sender.user_id, receiver.user_id]).delete()
+            currency.delete()
+
+        self.stdout.write('HTTP session/sendMessage/: {:.0f} messages/s'.format(http))
+        self.stdout.write('WebSocket sendMessage:     {:.0f} messages/s'.format(ws))
+
+    def run_http(self, user_id, session_id, count):
+        client = Client()
+        started = time.perf_counter()
+        for index in range(count):
+            client.post('/session/sendMessage/', json.dumps({
+                'senderId': user_id,
+                'sessionId': session_id,
+                'messageDate': '2023-01-01 00:00:00',
+                'messageText': 'http {}'.format(index)
+            }), content_type='application/json')
+        return count / (time.perf_counter() - started)
+
+    async def run_ws(self, user_id, session_id, count):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/{}/'.format(user_id))
+        await communicator.connect()
+        started = time.perf_counter()
+        for index in range(count):
+            await communicator.send_json_to({
+                'type': 'sendMessage',
+                'clientMessageId': index,
+                'data': {'sessionId': session_id, 'messageText': 'ws {}'.format(index)}
+            })
+            # The ack and the sender's own copy of the message
+            await communicator.receive_json_from(timeout=10)
+            await communicator.receive_json_from(timeout=10)
+        elapsed = time.perf_counter() - started
+        await communicator.disconnect()
+        return count / elapsed
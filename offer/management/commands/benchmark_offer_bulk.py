@@ -0,0 +1,79 @@
+import json
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import Client
+
+from offer.currencies import currency_cache
+from offer.management.benchmarks import require_benchmark_database
+from offer.models import User, Currency, Offer
+
+
+class Command(BaseCommand):
+    help = 'Compare offer creates and reprices per second over offer/create/ + offer/edit/ and over offer/bulk/'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--offers', type=int, default=1000)
+        parser.add_argument('--batch', type=int, default=200, help='Items per offer/bulk/ request')
+
+    def handle(self, *args, **options):
+        require_benchmark_database('benchmark_offer_bulk')
+        rng = random.Random(0)
+        user = User.objects.create(user_name='benchmark', user_rating=0)
+        currencies = [Currency.objects.create(name='benchmark', capital_name='BN{}'.format(index), unicode_symbol='B',
+                                              color_hex='#000000') for index in range(2)]
+        currency_cache.invalidate()
+        # localhost passes ALLOWED_HOSTS under DEBUG and the benchmark settings
+        client = Client(HTTP_HOST='localhost')
+        try:
+            pair = {'fromCurrencyId': currencies[0].currency_id, 'toCurrencyId': currencies[1].currency_id}
+
+            def offer_data():
+                rate = rng.uniform(0.5, 1.5)
+                return {**pair, 'fromAmount': 100, 'toAmount': 100 * rate, 'exchangeRate': rate}
+
+            started = time.perf_counter()
+            offer_ids = []
+            for _ in range(options['offers']):
+                response = client.post('/offer/create/', json.dumps({'creatorId': user.user_id, **offer_data()}),
+                                       content_type='application/json')
+                offer_ids.append(response.json()['offerId'])
+            single_create = options['offers'] / (time.perf_counter() - started)
+
+            started = time.perf_counter()
+            for offer_id in offer_ids:
+                client.post('/offer/edit/', json.dumps({'offerId': offer_id, 'creatorId': user.user_id, **offer_data()}),
+                            content_type='application/json')
+            single_edit = options['offers'] / (time.perf_counter() - started)
+
+            started = time.perf_counter()
+            offer_ids = []
+            for start in range(0, options['offers'], options['batch']):
+                count = min(options['batch'], options['offers'] - start)
+                response = client.post('/offer/bulk/', json.dumps({
+                    'creatorId': user.user_id,
+                    'offers': [{'action': 'create', **offer_data()} for _ in range(count)]
+                }), content_type='application/json')
+                offer_ids += [result['offer']['offerId'] for result in response.json()]
+            bulk_create = options['offers'] / (time.perf_counter() - started)
+
+            started = time.perf_counter()
+            for start in range(0, len(offer_ids), options['batch']):
+                client.post('/offer/bulk/', json.dumps({
+                    'creatorId': user.user_id,
+                    'offers': [{'action': 'update', 'offerId': offer_id, **offer_data()}
+                               for offer_id in offer_ids[start:start + options['batch']]]
+                }), content_type='application/json')
+            bulk_update = options['offers'] / (time.perf_counter() - started)
+        finally:
+            Offer.objects.filter(user=user).delete()
+            user.delete()
+            for currency in currencies:
+                currency.delete()
+            currency_cache.invalidate()
+
+        self.stdout.write('offer/create/: {:>8.0f} offers/s   offer/edit/: {:>8.0f} offers/s'.format(
+            single_create, single_edit))
+        self.stdout.write('offer/bulk/:   {:>8.0f} creates/s  offer/bulk/: {:>8.0f} updates/s  ({} per request)'.format(
+            bulk_create, bulk_update, options['batch']))
@@ -0,0 +1,44 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from offer.orderbook import OrderBooks
+
+
+class Command(BaseCommand):
+    help = 'Measure order book match latency with synthetic resting offers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000])
+        parser.add_argument('--pairs', type=int, default=10)
+        parser.add_argument('--queries', type=int, default=10000)
+        parser.add_argument('--limit', type=int, default=10)
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        for size in options['sizes']:
+            books = OrderBooks()
+            books.load((offer_id, offer_id % options['pairs'], -1, rng.uniform(0.5, 1.5))
+                       for offer_id in range(size))
+
+            latencies = []
+            for _ in range(options['queries']):
+                from_currency_id = rng.randrange(options['pairs'])
+                started = time.perf_counter()
+                books.best(from_currency_id, -1, options['limit'], rng.uniform(0.5, 1.5))
+                latencies.append(time.perf_counter() - started)
+
+            repriced = range(0, size, max(1, size // 1000))
+            started = time.perf_counter()
+            for offer_id in repriced:
+                books.books[(offer_id % options['pairs'], -1)].add(offer_id, rng.uniform(0.5, 1.5))
+            reprice = (time.perf_counter() - started) / len(repriced)
+
+            latencies.sort()
+            self.stdout.write('{:>9} offers: match p50 {:.1f}us p99 {:.1f}us, reprice {:.1f}us'.format(
+                size,
+                latencies[len(latencies) // 2] * 1e6,
+                latencies[int(len(latencies) * 0.99)] * 1e6,
+                reprice * 1e6,
+            ))
@@ -0,0 +1,59 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from offer.management.benchmarks import require_benchmark_database
+from offer.models import User
+from offer.search import search_index
+
+
+class Command(BaseCommand):
+    help = 'Load the user name search index over --users users and time prefix lookups, creates and renames'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000)
+        parser.add_argument('--lookups', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        require_benchmark_database('benchmark_search')
+        rng = random.Random(0)
+        words = ['alex', 'anna', 'boris', 'ivan', 'john', 'maria', 'olga', 'smith', 'trader', 'petrov']
+        first_id = (User.objects.order_by('-user_id').values_list('user_id', flat=True).first() or 0) + 1
+        for start in range(0, options['users'], 10000):
+            User.objects.bulk_create([
+                User(user_id=first_id + index, user_rating=0,
+                     user_name='{} {} {}'.format(rng.choice(words), rng.choice(words), first_id + index))
+                for index in range(start, min(start + 10000, options['users']))
+            ])
+        users = User.objects.filter(user_id__gte=first_id)
+        try:
+            search_index.clear()
+            started = time.perf_counter()
+            search_index.ensure_loaded()
+            load = time.perf_counter() - started
+
+            queries = [rng.choice(words)[:rng.randint(1, 4)] for _ in range(options['lookups'])]
+            queries += [str(first_id + rng.randrange(options['users']))[:rng.randint(1, 7)]
+                        for _ in range(options['lookups'])]
+            timings = []
+            for query in queries:
+                started = time.perf_counter()
+                search_index.search_users(query, 20)
+                timings.append(time.perf_counter() - started)
+            timings.sort()
+
+            renamed = list(users.order_by('?')[:1000])
+            started = time.perf_counter()
+            for user in renamed:
+                user.user_name = '{} {}'.format(rng.choice(words), user.user_id)
+                search_index.add_user(user)
+            update = (time.perf_counter() - started) / len(renamed)
+        finally:
+            users.delete()
+            search_index.clear()
+
+        self.stdout.write('load: {:.1f} s for {} users'.format(load, options['users']))
+        self.stdout.write('lookup (limit 20): p50 {:.1f} us  p99 {:.1f} us  max {:.1f} us'.format(
+            timings[len(timings) // 2] * 1e6, timings[len(timings) * 99 // 100] * 1e6, timings[-1] * 1e6))
+        self.stdout.write('create/rename: {:.1f} us per user'.format(update * 1e6))
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from offer.export import EXPORT_CHUNK_SIZE, EXPORT_FORMATS, export_chunks
+from offer.models import parseDateTime
+
+
+class Command(BaseCommand):
+    help = 'Write sessions, participants and messages to a file as NDJSON or CSV, page by page like session/export/'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='File to write')
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='ndjson')
+        parser.add_argument('--user', type=int, default=None, help='Only the sessions of this user')
+        parser.add_argument('--since', default=None, help='Only messages at or after this "YYYY-MM-DD HH:MM:SS"')
+        parser.add_argument('--until', default=None, help='Only messages before this "YYYY-MM-DD HH:MM:SS"')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            since = parseDateTime(options['since']) if options['since'] is not None else None
+            until = parseDateTime(options['until']) if options['until'] is not None else None
+        except ValueError as exc:
+            raise CommandError(exc)
+
+        written = 0
+        with open(options['output'], 'wb') as output:
+            for chunk in export_chunks(options['format'], user_id=options['user'], since=since, until=until,
+                                       chunk_size=options['chunk_size']):
+                output.write(chunk)
+                written += len(chunk)
+        self.stdout.write('Wrote {} bytes to {}'.format(written, options['output']))
@@ -0,0 +1,65 @@
+import asyncio
+import time
+import tracemalloc
+
+from channels.layers import InMemoryChannelLayer, channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+
+from offer.management.benchmarks import require_benchmark_database
+from offer.models import User
+from offer.routing import websocket_urlpatterns
+
+
+class Command(BaseCommand):
+    help = 'Open many simulated sockets against TextRoomConsumer and report connect latency and memory'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sockets', type=int, default=10000)
+        parser.add_argument('--concurrency', type=int, default=100)
+
+    def handle(self, *args, **options):
+        require_benchmark_database('loadtest_consumer')
+        users = User.objects.bulk_create(
+            [User(user_name='loadtest', user_rating=0) for _ in range(options['sockets'])])
+        user_ids = [user.user_id for user in users]
+        if None in user_ids:
+            user_ids = list(User.objects.filter(user_name='loadtest').values_list('user_id', flat=True))
+        try:
+            latencies, memory = asyncio.run(self.run(user_ids, options['concurrency']))
+        finally:
+            User.objects.filter(user_id__in=user_ids).delete()
+
+        latencies.sort()
+        self.stdout.write('{} sockets: connect p50 {:.2f}ms p95 {:.2f}ms p99 {:.2f}ms, {:.1f} KiB per connection'.format(
+            len(latencies),
+            latencies[len(latencies) // 2] * 1e3,
+            latencies[int(len(latencies) * 0.95)] * 1e3,
+            latencies[int(len(latencies) * 0.99)] * 1e3,
+            memory / len(latencies) / 1024,
+        ))
+
+    async def run(self, user_ids, concurrency):
+        application = URLRouter(websocket_urlpatterns)
+        # Always measure against a fresh in-memory layer, whatever the settings say
+        channel_layers.set('default', InMemoryChannelLayer())
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def connect(user_id):
+            async with semaphore:
+                communicator = WebsocketCommunicator(application, '/ws/{}/'.format(user_id))
+                started = time.perf_counter()
+                connected, _ = await communicator.connect(timeout=60)
+                if not connected:
+                    raise RuntimeError('Socket for user {} was rejected'.format(user_id))
+                return communicator, time.perf_counter() - started
+
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        results = await asyncio.gather(*(connect(user_id) for user_id in user_ids))
+        memory = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+
+        await asyncio.gather(*(communicator.disconnect() for communicator, _ in results))
+        return [latency for _, latency in results], memory
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from offer.outbox import outbox
+
+
+class Command(BaseCommand):
+    help = 'Delete queued socket frames older than the outbox TTL; run it periodically, replays delete nothing'
+
+    def handle(self, *args, **options):
+        deleted = outbox.prune()
+        self.stdout.write('Deleted {} expired outbox event(s)'.format(deleted))
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from offer.models import User, SessionUser
+
+
+def actual_closed_sessions():
+    # Correlated count of closed sessions the user took part in
+    return Coalesce(Subquery(
+        SessionUser.objects.filter(user_id=OuterRef('user_id'), session__session_state=0).values('user_id')
+        .annotate(value=Count('session_id', distinct=True)).values('value')
+    ), 0, output_field=IntegerField())
+
+
+class Command(BaseCommand):
+    help = 'Recompute the User.closed_sessions counter, or report users whose counter drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Only report inconsistent users, do not write')
+
+    def handle(self, *args, **options):
+        if options['check']:
+            self.check_counters()
+            return
+
+        updated = User.objects.update(closed_sessions=actual_closed_sessions())
+        self.stdout.write('Recomputed closed session counters for {} user(s)'.format(updated))
+
+    def check_counters(self):
+        users = User.objects.annotate(actual=actual_closed_sessions()) \
+            .values_list('user_id', 'closed_sessions', 'actual')
+
+        inconsistent = 0
+        for user_id, closed_sessions, actual in users.iterator(chunk_size=2000):
+            if closed_sessions != actual:
+                inconsistent += 1
+                self.stdout.write('user {}: stored {}, actual {}'.format(user_id, closed_sessions, actual))
+        self.stdout.write('{} inconsistent user(s)'.format(inconsistent))
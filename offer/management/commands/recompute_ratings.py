@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F, FloatField, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from offer.models import User, UserRating
+
+
+def rating_aggregate(aggregate, output_field):
+    # Correlated per-user aggregate over UserRating, 0 for users without ratings
+    return Coalesce(Subquery(
+        UserRating.objects.filter(user_id=OuterRef('user_id')).values('user_id')
+        .annotate(value=aggregate).values('value')
+    ), 0, output_field=output_field)
+
+
+def actual_rating_count():
+    return rating_aggregate(Count('user_rating_id'), IntegerField())
+
+
+def actual_rating_sum():
+    return rating_aggregate(Sum('rating'), FloatField())
+
+
+class Command(BaseCommand):
+    help = 'Recompute User rating aggregates from UserRating rows, or report users whose aggregates drifted'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true', help='Only report inconsistent users, do not write')
+
+    def handle(self, *args, **options):
+        if options['check']:
+            self.check_aggregates()
+            return
+
+        # Set-based statements, whatever the number of users and ratings
+        with transaction.atomic():
+            updated = User.objects.update(rating_count=actual_rating_count(), rating_sum=actual_rating_sum())
+            User.objects.filter(rating_count__gt=0).update(user_rating=F('rating_sum') / F('rating_count'))
+        self.stdout.write('Recomputed rating aggregates for {} user(s)'.format(updated))
+
+    def check_aggregates(self):
+        users = User.objects.annotate(actual_count=actual_rating_count(), actual_sum=actual_rating_sum()) \
+            .values_list('user_id', 'rating_count', 'rating_sum', 'actual_count', 'actual_sum')
+
+        inconsistent = 0
+        for user_id, rating_count, rating_sum, actual_count, actual_sum in users.iterator(chunk_size=2000):
+            if rating_count != actual_count or abs(rating_sum - actual_sum) > 1e-6:
+                inconsistent += 1
+                self.stdout.write('user {}: stored {}/{}, actual {}/{}'.format(
+                    user_id, rating_sum, rating_count, actual_sum, actual_count))
+        self.stdout.write('{} inconsistent user(s)'.format(inconsistent))
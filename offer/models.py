@@ -1,6 +1,7 @@
 from datetime import datetime
 
 from django.db import models
+from django.utils import timezone
 
 
 def parseDateTime(date_time_str):
@@ -11,8 +12,10 @@ class User(models.Model):
     user_id = models.AutoField(primary_key=True)
     user_name = models.CharField(max_length=256)
     user_rating = models.FloatField()
+    rating_count = models.IntegerField(default=0)
+    rating_sum = models.FloatField(default=0)
+    closed_sessions = models.IntegerField(default=0)
     user_watchlist = models.ManyToManyField('Offer', related_name="watchlist")
-    user_channel_name = models.CharField(max_length=256, default='nc')
 
     class Meta:
         db_table = 'user'
@@ -40,6 +43,13 @@ class Offer(models.Model):
 
     class Meta:
         db_table = 'offer'
+        indexes = [
+            models.Index(fields=['from_currency', 'to_currency', 'exchange_rate', 'offer_id'],
+                         name='offer_pair_rate_idx'),
+            models.Index(fields=['from_currency', 'exchange_rate', 'offer_id'], name='offer_from_rate_idx'),
+            models.Index(fields=['user', 'exchange_rate', 'offer_id'], name='offer_user_rate_idx'),
+            models.Index(fields=['exchange_rate', 'offer_id'], name='offer_rate_idx'),
+        ]
 
 
 class Session(models.Model):
@@ -57,6 +67,7 @@ class SessionUser(models.Model):
     session_user_id = models.AutoField(primary_key=True)
     session = models.ForeignKey(Session, on_delete=models.CASCADE)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
+    last_read_message_id = models.IntegerField(null=True, default=None)
 
     class Meta:
         db_table = 'user_session'
@@ -71,6 +82,9 @@ class Messages(models.Model):
 
     class Meta:
         db_table = 'message'
+        indexes = [
+            models.Index(fields=['message_session', 'message_date', 'message_id'], name='message_session_date_idx'),
+        ]
 
 
 class UserRating(models.Model):
@@ -80,3 +94,33 @@ class UserRating(models.Model):
 
     class Meta:
         db_table = 'user_rating'
+
+
+class Sequence(models.Model):
+    # Named counters: ids assigned by the application instead of the database,
+    # and the highest pruned outbox seq (offer.outbox)
+    name = models.CharField(max_length=64, primary_key=True)
+    next_value = models.BigIntegerField()
+
+    class Meta:
+        db_table = 'sequence'
+
+
+class OutboxEvent(models.Model):
+    # A socket frame sent to a user, replayed to their reconnecting devices in
+    # seq order. seq is the number the frame carried live, shared by every
+    # recipient; message frames use the message id and are rebuilt from the
+    # message.
+    event_id = models.BigAutoField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    seq = models.BigIntegerField()
+    message = models.ForeignKey(Messages, null=True, default=None, on_delete=models.CASCADE)
+    frame = models.TextField(null=True, default=None)
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        db_table = 'outbox_event'
+        indexes = [
+            models.Index(fields=['user', 'seq'], name='outbox_user_seq_idx'),
+            models.Index(fields=['created'], name='outbox_created_idx'),
+        ]
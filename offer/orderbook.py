@@ -0,0 +1,132 @@
+import logging
+import threading
+
+from bisect import bisect_right, insort
+
+from django.db import connection
+
+from offer.indexfeed import index_feed
+from offer.models import Offer
+
+logger = logging.getLogger(__name__)
+
+
+class OrderBook:
+    # Resting offers of one (from_currency, to_currency) pair, kept as a sorted
+    # array of (exchange_rate, offer_id) keys so the best offers are a prefix.
+    def __init__(self):
+        self.keys = []
+        self.rates = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, offer_id, exchange_rate):
+        if offer_id in self.rates:
+            self.remove(offer_id)
+        self.rates[offer_id] = exchange_rate
+        insort(self.keys, (exchange_rate, offer_id))
+
+    def remove(self, offer_id):
+        exchange_rate = self.rates.pop(offer_id, None)
+        if exchange_rate is None:
+            return
+        index = bisect_right(self.keys, (exchange_rate, offer_id)) - 1
+        del self.keys[index]
+
+    def best(self, limit, max_rate=None):
+        end = len(self.keys)
+        if max_rate is not None:
+            end = bisect_right(self.keys, (max_rate, float('inf')))
+        return [offer_id for _, offer_id in self.keys[:min(limit, end)]]
+
+
+class OrderBooks:
+    # Per-process registry of order books, loaded from Offer on first use and
+    # kept current by the offer views through update(), which also passes the
+    # change to the other workers over index_feed. Their copies follow a moment
+    # later, so callers must re-read the returned ids from the database.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.books = {}
+        self.pairs = {}
+        self.loaded = False
+
+    def load(self, offers):
+        books = {}
+        pairs = {}
+        for offer_id, from_currency_id, to_currency_id, exchange_rate in offers:
+            pair = (from_currency_id, to_currency_id)
+            book = books.setdefault(pair, OrderBook())
+            book.rates[offer_id] = exchange_rate
+            book.keys.append((exchange_rate, offer_id))
+            pairs[offer_id] = pair
+        for book in books.values():
+            book.keys.sort()
+        self.books = books
+        self.pairs = pairs
+        self.loaded = True
+
+    def ensure_loaded(self):
+        if self.loaded:
+            return
+        index_feed.start()
+        with self.lock:
+            if not self.loaded:
+                self.load(Offer.objects.values_list('offer_id', 'from_currency_id', 'to_currency_id',
+                                                    'exchange_rate').iterator(chunk_size=10000))
+
+    def warm(self):
+        # Loads in a background thread when the server starts, so that the
+        # first match request does not wait for it; requests made meanwhile
+        # wait on the lock, and a failed load is retried by the next request
+        def load():
+            try:
+                self.ensure_loaded()
+            except Exception:
+                logger.exception('Loading the order books failed')
+            finally:
+                connection.close()
+
+        threading.Thread(target=load, daemon=True).start()
+
+    def update(self, offers=(), removed_ids=()):
+        # Created or edited offers and deleted offer ids of one request
+        offers = [(offer.offer_id, int(offer.from_currency_id), int(offer.to_currency_id),
+                   float(offer.exchange_rate)) for offer in offers]
+        removed_ids = list(removed_ids)
+        self.ensure_loaded()
+        self._update(offers, removed_ids)
+        index_feed.publish('order_books.changed', offers=offers, removed=removed_ids)
+
+    def apply(self, message):
+        # A change made by another worker; one that arrives before this worker
+        # has loaded is already in the rows the load reads
+        if self.loaded:
+            self._update([tuple(offer) for offer in message['offers']], message['removed'])
+
+    def _update(self, offers, removed_ids):
+        with self.lock:
+            for offer_id, from_currency_id, to_currency_id, exchange_rate in offers:
+                self._remove(offer_id)
+                self.books.setdefault((from_currency_id, to_currency_id), OrderBook()).add(offer_id, exchange_rate)
+                self.pairs[offer_id] = (from_currency_id, to_currency_id)
+            for offer_id in removed_ids:
+                self._remove(offer_id)
+
+    def _remove(self, offer_id):
+        pair = self.pairs.pop(offer_id, None)
+        if pair is not None:
+            self.books[pair].remove(offer_id)
+
+    def best(self, from_currency_id, to_currency_id, limit, max_rate=None):
+        self.ensure_loaded()
+        with self.lock:
+            book = self.books.get((from_currency_id, to_currency_id))
+            if book is None:
+                return []
+            return book.best(limit, max_rate)
+
+
+order_books = OrderBooks()
+index_feed.register('order_books.changed', order_books.apply)
@@ -0,0 +1,61 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from offer.models import OutboxEvent, Sequence
+
+# Most frames replayed to one socket; past this the client reloads its state
+OUTBOX_SIZE = 500
+# Seconds a frame is kept
+OUTBOX_TTL = 7 * 24 * 3600
+# Sequence row holding the highest seq prune() may have deleted
+OUTBOX_PRUNED = 'outbox_pruned'
+
+
+class Outbox:
+    # Per-user log of the socket frames sent to a user, stored as OutboxEvent
+    # rows whether or not the user was online. Every frame carries its seq
+    # live as well: each of a user's devices passes the last one it has seen
+    # when it reconnects and gets the newer frames, which may repeat frames it
+    # received live. Replaying deletes nothing, so one device never takes
+    # frames from another; rows only go once they are older than the TTL, by
+    # prune().
+    def __init__(self, size=OUTBOX_SIZE, ttl=OUTBOX_TTL):
+        self.size = size
+        self.ttl = ttl
+
+    def cutoff(self):
+        return timezone.now() - timedelta(seconds=self.ttl)
+
+    def add(self, events):
+        if events:
+            OutboxEvent.objects.bulk_create(events)
+
+    def pruned(self):
+        return Sequence.objects.filter(name=OUTBOX_PRUNED).values_list('next_value', flat=True).first() or 0
+
+    def replay(self, user_id, since, until):
+        # (events after since up to until oldest first, complete). Frames past
+        # until may not all be stored yet. complete is False when frames after
+        # since may have been pruned, or past the size bound.
+        pending = list(OutboxEvent.objects.filter(user_id=user_id, seq__gt=since, seq__lte=until)
+                       .select_related('message__message_sender').order_by('seq')[:self.size + 1])
+        return pending[:self.size], since >= self.pruned() and len(pending) <= self.size
+
+    def prune(self):
+        # Records how far it deleted first, so a replay from before that point
+        # is reported incomplete
+        expired = OutboxEvent.objects.filter(created__lt=self.cutoff())
+        last = expired.aggregate(Max('seq'))['seq__max']
+        if last is None:
+            return 0
+        with transaction.atomic():
+            if not Sequence.objects.filter(name=OUTBOX_PRUNED, next_value__lt=last).update(next_value=last):
+                Sequence.objects.get_or_create(name=OUTBOX_PRUNED, defaults={'next_value': last})
+            deleted, _ = expired.filter(seq__lte=last).delete()
+        return deleted
+
+
+outbox = Outbox()
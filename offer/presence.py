@@ -0,0 +1,56 @@
+import time
+
+from django.core.cache import caches
+
+# Seconds a channel stays live without a heartbeat from its socket
+PRESENCE_TTL = 90
+
+
+class PresenceRegistry:
+    # Live channel names per user, kept in the Django cache so that it is shared
+    # by every worker whenever CACHES points to a shared backend. Each user maps
+    # to {channel_name: expires_at}; expired channels are dropped on read, which
+    # covers sockets whose disconnect was never delivered. Updates are a read
+    # and a write, so a join racing a leave of the same user may be lost until
+    # the next heartbeat: nothing that delivers frames depends on it.
+    def __init__(self, cache_alias='default', ttl=PRESENCE_TTL):
+        self.cache_alias = cache_alias
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def key(self, user_id):
+        return 'presence:{}'.format(user_id)
+
+    def live(self, channels, now):
+        return {channel_name: expires_at for channel_name, expires_at in (channels or {}).items()
+                if expires_at > now}
+
+    async def ajoin(self, user_id, channel_name):
+        now = time.time()
+        channels = self.live(await self.cache.aget(self.key(user_id)), now)
+        channels[channel_name] = now + self.ttl
+        await self.cache.aset(self.key(user_id), channels, self.ttl)
+
+    aheartbeat = ajoin
+
+    async def aleave(self, user_id, channel_name):
+        channels = self.live(await self.cache.aget(self.key(user_id)), time.time())
+        channels.pop(channel_name, None)
+        if channels:
+            await self.cache.aset(self.key(user_id), channels, self.ttl)
+        else:
+            await self.cache.adelete(self.key(user_id))
+
+    def channels(self, user_id):
+        return set(self.live(self.cache.get(self.key(user_id)), time.time()))
+
+    def online(self, user_ids):
+        now = time.time()
+        keys = {self.key(user_id): user_id for user_id in user_ids}
+        return {keys[key] for key, channels in self.cache.get_many(keys).items() if self.live(channels, now)}
+
+
+presence = PresenceRegistry()
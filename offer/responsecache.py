@@ -0,0 +1,111 @@
+import functools
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from obmennik.renderers import dumps
+
+# Responses kept per process, least recently used ones are dropped first
+RESPONSE_CACHE_SIZE = 10000
+# Upper bound on how long an entry is served, for writes made by other processes
+RESPONSE_CACHE_TTL = 30
+
+
+class ResponseCache:
+    # Process-wide LRU of rendered GET responses, keyed by the requesting user,
+    # the user's version, the route and the query string. The versions live in
+    # the Django cache, shared by every worker, and writes call invalidate()
+    # with every user whose responses they change: a new version makes the old
+    # entries unreachable in all workers and the LRU ages them out. A version
+    # outlives every entry stored before it, so one that expired cannot bring
+    # an outdated entry back.
+    def __init__(self, size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, cache_alias='default'):
+        self.size = size
+        self.ttl = ttl
+        self.cache_alias = cache_alias
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def version_key(user_id):
+        return 'response-version:{}'.format(user_id)
+
+    def key(self, user_id, route, params):
+        version = self.cache.get(self.version_key(user_id), 0)
+        return user_id, version, route, tuple(sorted(params))
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1], entry[2]
+
+    def set(self, key, etag, body):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), etag, body)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_ids):
+        # One round trip for all users; a fresh token never matches a stored entry
+        version = uuid.uuid4().hex
+        versions = {self.version_key(int(user_id)): version for user_id in user_ids}
+        if versions:
+            self.cache.set_many(versions, 2 * self.ttl)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+response_cache = ResponseCache()
+
+
+def etag_response(request, etag, body):
+    # 304 without a body when the client already has this version
+    if request.META.get('HTTP_IF_NONE_MATCH', None) == etag:
+        return HttpResponse(status=304, headers={'ETag': etag})
+    return HttpResponse(body, content_type='application/json', headers={'ETag': etag})
+
+
+def cached_per_user(view):
+    # For ViewSet GET methods taking a userId parameter. Successful responses
+    # are stored rendered, with an ETag over the body; everything else
+    # (missing or invalid userId, errors) goes through the view uncached.
+    @functools.wraps(view)
+    def wrapper(self, request, *args, **kwargs):
+        try:
+            user_id = int(request.GET.get('userId', None))
+        except (TypeError, ValueError):
+            return view(self, request, *args, **kwargs)
+
+        # The key is taken before the view runs, so a write that lands meanwhile
+        # leaves this response under the outdated version
+        key = response_cache.key(user_id, request.resolver_match.route, request.GET.items())
+        cached = response_cache.get(key)
+        if cached is not None:
+            return etag_response(request, *cached)
+
+        response = view(self, request, *args, **kwargs)
+        if response.status_code != 200:
+            return response
+        body = dumps(response.data)
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        response_cache.set(key, etag, body)
+        return etag_response(request, etag, body)
+    return wrapper
@@ -1,14 +1,24 @@
 from channels.routing import ProtocolTypeRouter, URLRouter
+from django.conf import settings
+from django.core.asgi import get_asgi_application
 from django.urls import re_path
 from offer.consumers import TextRoomConsumer
+from offer.orderbook import order_books
 websocket_urlpatterns = [
     re_path(r'^ws/(?P<user_id>[^/]+)/$', TextRoomConsumer.as_asgi()),
 ]
 # the websocket will open at 127.0.0.1:8000/ws/<room_name>
 application = ProtocolTypeRouter({
+    # Django's own ASGI handler, which streams async response iterators
+    # (channels' AsgiHandler fallback reads every response into memory)
+    'http': get_asgi_application(),
     'websocket':
         URLRouter(
             websocket_urlpatterns
         )
     ,
-})
\ No newline at end of file
+})
+
+# Importing the ASGI application is the server starting up
+if getattr(settings, 'WARM_ORDER_BOOKS', False):
+    order_books.warm()
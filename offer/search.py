@@ -0,0 +1,176 @@
+import itertools
+import threading
+
+from bisect import bisect_left, bisect_right, insort
+
+from offer.currencies import currency_cache
+from offer.indexfeed import index_feed
+from offer.models import User
+
+# Entries per block of a PrefixIndex; a block is split once it doubles
+BLOCK_SIZE = 1000
+
+
+def normalize(text):
+    return ' '.join(text.casefold().split())
+
+
+def word_suffixes(text):
+    # "New user 12" -> "new user 12", "user 12", "12": a prefix of any of them
+    # is a query that starts at a word boundary of the name
+    words = normalize(text).split(' ')
+    return {' '.join(words[index:]) for index in range(len(words)) if words[index]}
+
+
+def word_keys(texts):
+    keys = set()
+    for text in texts:
+        keys |= word_suffixes(text)
+    return keys
+
+
+def matches(query, text):
+    query = normalize(query)
+    return any(key.startswith(query) for key in word_suffixes(text))
+
+
+class PrefixIndex:
+    # Word suffixes of every indexed text as sorted (key, id) entries, so the
+    # hits of a prefix are a contiguous run found by bisection. The entries are
+    # split into blocks of about BLOCK_SIZE, which keeps an insert or delete
+    # from shifting millions of entries.
+    def __init__(self):
+        self.blocks = []
+        self.firsts = []
+        self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self, items):
+        keys = []
+        for item_id, texts in items:
+            self.entries[item_id] = word_keys(texts)
+            keys += [(key, item_id) for key in self.entries[item_id]]
+        keys.sort()
+        self.blocks = [keys[start:start + BLOCK_SIZE] for start in range(0, len(keys), BLOCK_SIZE)]
+        self.firsts = [block[0] for block in self.blocks]
+
+    def add(self, item_id, *texts):
+        self.remove(item_id)
+        self.entries[item_id] = word_keys(texts)
+        for key in self.entries[item_id]:
+            self._insert((key, item_id))
+
+    def remove(self, item_id):
+        for key in self.entries.pop(item_id, ()):
+            self._delete((key, item_id))
+
+    def _block(self, entry):
+        return max(bisect_right(self.firsts, entry) - 1, 0)
+
+    def _insert(self, entry):
+        if not self.blocks:
+            self.blocks.append([entry])
+            self.firsts.append(entry)
+            return
+        index = self._block(entry)
+        block = self.blocks[index]
+        insort(block, entry)
+        self.firsts[index] = block[0]
+        if len(block) > 2 * BLOCK_SIZE:
+            self.blocks[index:index + 1] = [block[:BLOCK_SIZE], block[BLOCK_SIZE:]]
+            self.firsts[index + 1:index + 1] = [block[BLOCK_SIZE]]
+
+    def _delete(self, entry):
+        index = self._block(entry)
+        block = self.blocks[index]
+        del block[bisect_left(block, entry)]
+        if block:
+            self.firsts[index] = block[0]
+        else:
+            del self.blocks[index]
+            del self.firsts[index]
+
+    def search(self, query, limit):
+        query = normalize(query)
+        found = {}
+        index = self._block((query,))
+        start = bisect_left(self.blocks[index], (query,)) if self.blocks else 0
+        for block in itertools.islice(self.blocks, index, None):
+            for key, item_id in itertools.islice(block, start, None):
+                if not key.startswith(query):
+                    return list(found)
+                # An id whose name has the prefix at several words is listed once
+                found.setdefault(item_id, None)
+                if len(found) == limit:
+                    return list(found)
+            start = 0
+        return list(found)
+
+
+class SearchIndex:
+    # Per-process prefix search over user names and currency names. Users are
+    # loaded on first use and kept current by create_user and rename through
+    # add_user(), which also passes the name to the other workers over
+    # index_feed. Their copies follow a moment later, so callers must re-read
+    # the returned ids from the database and re-check them with matches().
+    # Currencies are rebuilt from currency_cache whenever it loads a new
+    # catalogue version.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = None
+        self.currencies = None
+        self.currencies_version = None
+
+    def ensure_loaded(self):
+        if self.users is not None:
+            return
+        index_feed.start()
+        with self.lock:
+            if self.users is None:
+                users = PrefixIndex()
+                users.load((user_id, (user_name,)) for user_id, user_name in
+                           User.objects.values_list('user_id', 'user_name').iterator(chunk_size=10000))
+                self.users = users
+
+    def add_user(self, user: User):
+        self._add_users([(user.user_id, user.user_name)])
+        index_feed.publish('search.users_changed', users=[[user.user_id, user.user_name]])
+
+    def apply(self, message):
+        # A name saved by another worker
+        self._add_users(message['users'])
+
+    def _add_users(self, users):
+        with self.lock:
+            # Not loaded yet: the saved rows are read with the rest on first use
+            if self.users is not None:
+                for user_id, user_name in users:
+                    self.users.add(user_id, user_name)
+
+    def search_users(self, query, limit):
+        self.ensure_loaded()
+        with self.lock:
+            return self.users.search(query, limit)
+
+    def search_currencies(self, query, limit):
+        currencies = currency_cache.all()
+        version = currency_cache.version
+        with self.lock:
+            if self.currencies_version != version:
+                self.currencies = PrefixIndex()
+                self.currencies.load((currency.currency_id, (currency.name, currency.capital_name))
+                                     for currency in currencies)
+                self.currencies_version = version
+            return self.currencies.search(query, limit)
+
+    def clear(self):
+        with self.lock:
+            self.users = None
+            self.currencies = None
+            self.currencies_version = None
+
+
+search_index = SearchIndex()
+index_feed.register('search.users_changed', search_index.apply)
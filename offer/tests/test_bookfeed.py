@@ -0,0 +1,124 @@
+import json
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from offer.bookfeed import BookChanges, BookFeed, coalesce
+from offer.consumers import TextRoomConsumer
+from offer.groups import book_group
+
+
+def delta(op, offer_id, exchange_rate=1.0):
+    return {'op': op, 'offerId': offer_id, 'exchangeRate': exchange_rate}
+
+
+class CoalesceTests(SimpleTestCase):
+    def coalesced(self, *deltas):
+        folded = {}
+        for change in deltas:
+            coalesce(folded, change)
+        return list(folded.values())
+
+    def test_the_latest_values_of_an_offer_are_kept(self):
+        self.assertEqual(self.coalesced(delta('update', 1, 1.0), delta('update', 1, 2.0)), [delta('update', 1, 2.0)])
+
+    def test_an_offer_added_within_the_window_stays_an_add(self):
+        self.assertEqual(self.coalesced(delta('add', 1, 1.0), delta('update', 1, 2.0)), [delta('add', 1, 2.0)])
+
+    def test_an_offer_added_and_removed_within_the_window_is_left_out(self):
+        self.assertEqual(self.coalesced(delta('add', 1), delta('update', 1), delta('remove', 1), delta('add', 2)),
+                         [delta('add', 2)])
+
+    def test_a_known_offer_that_is_removed_stays_removed(self):
+        self.assertEqual(self.coalesced(delta('update', 1), delta('remove', 1)), [delta('remove', 1)])
+
+    def test_changes_of_one_request_are_published_once_per_pair(self):
+        changes = BookChanges()
+        changes.add((1, 2), delta('add', 1))
+        changes.add((1, 2), delta('remove', 1))
+        changes.add((2, 1), delta('update', 2))
+        with mock.patch('offer.bookfeed.book_feed') as book_feed:
+            changes.publish()
+
+        book_feed.publish.assert_called_once_with((2, 1), [delta('update', 2)])
+
+
+class BookFeedTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_each_pair_counts_its_own_events(self):
+        # Two workers sharing the Django cache
+        worker, other = BookFeed(), BookFeed()
+
+        self.assertEqual(worker.current((1, 2)), 0)
+        self.assertEqual([worker.next((1, 2)), other.next((1, 2)), other.next((2, 1))], [1, 2, 1])
+        self.assertEqual(worker.current((1, 2)), 2)
+
+
+@mock.patch('offer.consumers.BOOK_FEED_WINDOW', 0)
+class SubscribeBookTests(SimpleTestCase):
+    def setUp(self):
+        self.consumer = TextRoomConsumer()
+        self.consumer.channel_layer = mock.Mock(group_add=mock.AsyncMock(), group_discard=mock.AsyncMock())
+        self.consumer.channel_name = 'socket'
+        self.consumer.send = mock.AsyncMock()
+
+    def event(self, seq, *deltas):
+        return {'type': 'book_delta', 'fromCurrencyId': 1, 'toCurrencyId': 2, 'seq': seq, 'deltas': list(deltas)}
+
+    def frames(self):
+        return [json.loads(call.kwargs['text_data']) for call in self.consumer.send.call_args_list]
+
+    async def subscribe(self, seq, offers, *arriving):
+        # Events in arriving reach the socket while its snapshot loads
+        async def snapshot(from_currency_id, to_currency_id, limit):
+            for event in arriving:
+                await self.consumer.book_delta(event)
+            return seq, offers, False
+
+        with mock.patch('offer.consumers.database_sync_to_async', return_value=snapshot):
+            await self.consumer.receive_subscribe_book({'fromCurrencyId': 1, 'toCurrencyId': 2}, 'subscribe')
+
+    async def flushed(self):
+        book = self.consumer.books[(1, 2)]
+        if book['task'] is not None:
+            await book['task']
+
+    async def test_events_already_in_the_snapshot_are_dropped(self):
+        await self.subscribe(5, [{'offerId': 1}],
+                             self.event(4, delta('add', 1)), self.event(5, delta('update', 1)),
+                             self.event(6, delta('add', 2)))
+        await self.flushed()
+
+        self.consumer.channel_layer.group_add.assert_called_once_with(book_group(1, 2), 'socket')
+        snapshot, changes = self.frames()
+        self.assertEqual((snapshot['responseType'], snapshot['seq'], snapshot['offers']),
+                         ('bookSnapshot', 5, [{'offerId': 1}]))
+        self.assertEqual((changes['responseType'], changes['seq'], changes['deltas']),
+                         ('bookDelta', 6, [delta('add', 2)]))
+
+    async def test_live_events_continue_after_the_snapshot_seq(self):
+        await self.subscribe(5, [])
+        for event in (self.event(5, delta('add', 1)), self.event(6, delta('add', 2)),
+                      self.event(7, delta('remove', 2)), self.event(8, delta('update', 3))):
+            await self.consumer.book_delta(event)
+        await self.flushed()
+        # Repeated after the frame was sent
+        await self.consumer.book_delta(self.event(8, delta('update', 3)))
+
+        self.assertEqual([(frame['seq'], frame.get('deltas', None)) for frame in self.frames()],
+                         [(5, None), (8, [delta('update', 3)])])
+        self.assertIsNone(self.consumer.books[(1, 2)]['task'])
+
+    async def test_events_of_a_pair_unsubscribed_meanwhile_are_not_sent(self):
+        async def unsubscribe(event):
+            await self.consumer.receive_unsubscribe_book({'fromCurrencyId': 1, 'toCurrencyId': 2}, 'unsubscribe')
+
+        with mock.patch.object(self.consumer, 'book_delta', side_effect=unsubscribe):
+            await self.subscribe(5, [], self.event(6, delta('add', 2)))
+        await self.consumer.book_delta(self.event(7, delta('add', 3)))
+
+        self.assertEqual([frame['responseType'] for frame in self.frames()], ['ack'])
+        self.assertEqual(self.consumer.groups, [])
@@ -0,0 +1,173 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+
+from obmennik.middleware import QueryBudgetExceeded, query_budget
+from offer.currencies import currency_cache
+from offer.ingest import message_pipeline, message_ids
+from offer.models import User, Currency, Offer, Session, SessionUser, Messages
+from offer.responsecache import response_cache
+from offer.search import search_index
+
+# Rows per list in the fixture, more than any budget allows queries
+ROWS = 25
+
+
+class QueryBudgetTests(TestCase):
+    # Calls every route of settings.QUERY_BUDGETS against lists longer than its
+    # budget; QUERY_BUDGET_STRICT makes a request over budget raise
+    @classmethod
+    def setUpTestData(cls):
+        Currency.objects.bulk_create([
+            Currency(name='Currency {}'.format(index), capital_name='C{}'.format(index), unicode_symbol='C',
+                     color_hex='#000000')
+            for index in range(3)
+        ])
+        cls.currency_ids = list(Currency.objects.values_list('currency_id', flat=True))
+        User.objects.bulk_create([User(user_name='User {}'.format(index), user_rating=0) for index in range(3)])
+        cls.owner, cls.other, cls.third = User.objects.order_by('user_id')
+
+        Offer.objects.bulk_create([
+            Offer(from_currency_id=cls.currency_ids[0], to_currency_id=cls.currency_ids[1], from_amount=100,
+                  to_amount=100 * (index + 1), exchange_rate=index + 1, user=user)
+            for user in (cls.owner, cls.other) for index in range(ROWS)
+        ])
+        cls.offers = list(Offer.objects.order_by('offer_id'))
+        cls.owner.user_watchlist.add(*cls.offers[ROWS:])
+
+        Session.objects.bulk_create([Session(session_owner=cls.owner, offer=offer) for offer in cls.offers[ROWS:]])
+        cls.sessions = list(Session.objects.order_by('session_id'))
+        SessionUser.objects.bulk_create([SessionUser(session=session, user=user)
+                                         for session in cls.sessions for user in (cls.owner, cls.other)])
+        started = datetime(2023, 1, 1)
+        Messages.objects.bulk_create([
+            Messages(message_sender=(cls.owner, cls.other)[index % 2], message_session=session,
+                     message_text='Message {}'.format(index), message_date=started + timedelta(minutes=index))
+            for session in cls.sessions for index in range(ROWS)
+        ])
+
+    def setUp(self):
+        # Process-wide caches outlive the rows of earlier tests
+        cache.clear()
+        currency_cache.invalidate()
+        response_cache.clear()
+        search_index.clear()
+        # Seeded once per deployment, not by the requests
+        message_ids.current()
+
+    def tearDown(self):
+        message_pipeline.drain()
+
+    def assertWithinBudget(self, route, method, path, data=None):
+        self.assertIn(route, settings.QUERY_BUDGETS)
+        call = self.client.get if method == 'GET' else self.client.post
+        response = call(path, data, content_type='application/json') if data is not None else call(path)
+        self.assertLess(response.status_code, 400)
+        if response.streaming:
+            # Rows are read while the body is sent, after the middleware counted
+            self.assertTrue(b''.join(response.streaming_content))
+        return response
+
+    def test_user_routes(self):
+        owner = self.owner.user_id
+        offer_ids = [offer.offer_id for offer in self.offers[:ROWS]]
+        self.assertWithinBudget('user/create/', 'POST', '/user/create/')
+        self.assertWithinBudget('user/getOffers/', 'GET', '/user/getOffers/?userId={}'.format(owner))
+        self.assertWithinBudget('user/watchlist/', 'GET', '/user/watchlist/?userId={}'.format(owner))
+        self.assertWithinBudget('user/addWatchlist/', 'POST',
+                                '/user/addWatchlist/?userId={}&offerId={}'.format(owner, offer_ids[0]))
+        self.assertWithinBudget('user/removeWatchlist/', 'POST',
+                                '/user/removeWatchlist/?userId={}&offerId={}'.format(owner, offer_ids[0]))
+        self.assertWithinBudget('user/addWatchlistBulk/', 'POST', '/user/addWatchlistBulk/',
+                                {'userId': owner, 'offerIds': offer_ids})
+        self.assertWithinBudget('user/removeWatchlistBulk/', 'POST', '/user/removeWatchlistBulk/',
+                                {'userId': owner, 'offerIds': offer_ids})
+        self.assertWithinBudget('user/rename/', 'POST', '/user/rename/?userId={}&newName=Renamed'.format(owner))
+        self.assertWithinBudget('user/info/', 'GET', '/user/info/?userId={}'.format(owner))
+        self.assertWithinBudget('user/updateRating/', 'POST',
+                                '/user/updateRating/?userId={}&newRating=4'.format(self.other.user_id))
+
+    def test_currency_routes(self):
+        self.assertWithinBudget('currency/getList/', 'GET', '/currency/getList/')
+        self.assertWithinBudget('currency/add/', 'POST', '/currency/add/', {'data': [
+            {'name': 'Added', 'capitalName': 'ADD', 'unicodeSymbol': 'A', 'colorHex': '#000000'}]})
+
+    def test_offer_routes(self):
+        owner = self.owner.user_id
+        from_currency_id, to_currency_id = self.currency_ids[:2]
+        offer = self.offers[0]
+        self.assertWithinBudget('offer/create/', 'POST', '/offer/create/', {
+            'creatorId': owner, 'fromCurrencyId': from_currency_id, 'toCurrencyId': to_currency_id,
+            'fromAmount': 100, 'toAmount': 200, 'exchangeRate': 2})
+        self.assertWithinBudget('offer/getList/', 'GET', '/offer/getList/?userId={}'.format(owner))
+        self.assertWithinBudget('offer/book/', 'GET', '/offer/book/?userId={}&fromCurrencyId={}&toCurrencyId={}'.format(
+            self.third.user_id, from_currency_id, to_currency_id))
+        self.assertWithinBudget('offer/match/', 'GET',
+                                '/offer/match/?userId={}&fromCurrencyId={}&toCurrencyId={}&exchangeRate=100'.format(
+                                    self.third.user_id, to_currency_id, from_currency_id))
+        self.assertWithinBudget('offer/edit/', 'POST', '/offer/edit/', {
+            'offerId': offer.offer_id, 'creatorId': owner, 'fromCurrencyId': from_currency_id,
+            'toCurrencyId': to_currency_id, 'fromAmount': 100, 'toAmount': 300, 'exchangeRate': 3})
+
+    def test_session_routes(self):
+        owner = self.owner.user_id
+        session = self.sessions[0]
+        with mock.patch.object(message_pipeline, 'flush_interval', 3600):
+            self.assertWithinBudget('session/create/', 'POST', '/session/create/', {
+                'ownerId': owner, 'userIds': [owner, self.third.user_id], 'offerId': self.offers[0].offer_id,
+                'initialMessage': {'senderId': owner, 'messageDate': '2023-06-01 00:00:00', 'messageText': 'Hello'}})
+            self.assertWithinBudget('session/sendMessage/', 'POST', '/session/sendMessage/', {
+                'senderId': owner, 'sessionId': session.session_id, 'messageDate': '2023-06-01 00:00:00',
+                'messageText': 'Hello'})
+        self.assertWithinBudget('session/messages/', 'GET',
+                                '/session/messages/?userId={}&sessionId={}'.format(owner, session.session_id))
+        self.assertWithinBudget('session/export/', 'GET', '/session/export/?userId={}'.format(owner))
+        self.assertWithinBudget('session/markRead/', 'POST', '/session/markRead/?userId={}&sessionId={}&messageId={}'.format(
+            owner, session.session_id, 1 << 30))
+        self.assertWithinBudget('session/list/', 'GET', '/session/list/?userId={}'.format(owner))
+        self.assertWithinBudget('session/close/', 'POST', '/session/close/?sessionId={}'.format(session.session_id))
+
+    def test_search_and_metrics_routes(self):
+        self.assertWithinBudget('search/', 'GET', '/search/?userId={}&query=user'.format(self.owner.user_id))
+        self.assertWithinBudget('metrics/', 'GET', '/metrics/')
+
+    def test_every_budgeted_route_is_covered(self):
+        with mock.patch.object(self, 'assertWithinBudget') as called:
+            self.test_user_routes()
+            self.test_currency_routes()
+            self.test_offer_routes()
+            self.test_session_routes()
+            self.test_search_and_metrics_routes()
+        self.assertEqual({call.args[0] for call in called.call_args_list}, set(settings.QUERY_BUDGETS))
+
+    @override_settings(QUERY_BUDGETS={'user/info/': 0})
+    def test_a_route_over_budget_fails_in_strict_mode(self):
+        with self.assertRaises(QueryBudgetExceeded):
+            self.client.get('/user/info/?userId={}'.format(self.owner.user_id))
+
+    @override_settings(QUERY_BUDGETS={'user/info/': 0}, QUERY_BUDGET_STRICT=False)
+    def test_a_route_over_budget_is_logged_otherwise(self):
+        with self.assertLogs('obmennik.middleware', 'WARNING'):
+            response = self.client.get('/user/info/?userId={}'.format(self.owner.user_id))
+        self.assertEqual(response.status_code, 200)
+
+
+class QueryBudgetContextTests(TestCase):
+    def run_queries(self, count):
+        with connection.cursor() as cursor:
+            for _ in range(count):
+                cursor.execute('SELECT 1')
+
+    def test_counts_the_queries_of_the_block(self):
+        with query_budget(3) as counter:
+            self.run_queries(3)
+        self.assertEqual(counter.count, 3)
+
+    def test_fails_a_block_over_budget(self):
+        with self.assertRaisesMessage(QueryBudgetExceeded, 'Export ran 2 queries, the budget is 1'):
+            with query_budget(1, 'Export'):
+                self.run_queries(2)
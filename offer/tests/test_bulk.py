@@ -0,0 +1,77 @@
+from django.core.cache import cache
+from django.test import TestCase
+
+from offer.models import User, Currency, Offer
+
+
+class BulkOfferTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.creator = User.objects.create(user_name='creator', user_rating=0)
+        self.other = User.objects.create(user_name='other', user_rating=0)
+        self.dollar = Currency.objects.create(name='Dollar', capital_name='USD', unicode_symbol='$',
+                                              color_hex='#000000')
+        self.euro = Currency.objects.create(name='Euro', capital_name='EUR', unicode_symbol='E', color_hex='#000000')
+        self.own = self.offer(self.creator)
+        self.foreign = self.offer(self.other)
+
+    def offer(self, user):
+        return Offer.objects.create(from_currency=self.dollar, to_currency=self.euro, from_amount=100, to_amount=90,
+                                    exchange_rate=0.9, user=user)
+
+    def bulk(self, items):
+        response = self.client.post('/offer/bulk/', {'creatorId': self.creator.user_id, 'offers': items},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def create_item(self, **fields):
+        return {'action': 'create', 'fromCurrencyId': self.dollar.currency_id, 'toCurrencyId': self.euro.currency_id,
+                'fromAmount': 100, 'toAmount': 110, 'exchangeRate': 1.1, **fields}
+
+    def test_valid_items_are_applied_next_to_the_errors_of_invalid_ones(self):
+        results = self.bulk([
+            self.create_item(),
+            {'action': 'update', 'offerId': self.own.offer_id, 'exchangeRate': 0.8},
+            {'action': 'delete', 'offerId': self.foreign.offer_id},
+            {'action': 'update', 'offerId': 0, 'exchangeRate': 0.8},
+        ])
+
+        self.assertEqual([result['status'] for result in results], ['created', 'updated', 'error', 'error'])
+        self.assertEqual(results[0]['offer']['exchangeRate'], 1.1)
+        self.assertEqual(results[1]['offer']['exchangeRate'], 0.8)
+        self.assertEqual(results[2]['error'], 'Offer belongs to another user')
+        self.assertEqual(results[3]['error'], 'Offer does not exist')
+        self.own.refresh_from_db()
+        self.assertEqual(self.own.exchange_rate, 0.8)
+        self.assertTrue(Offer.objects.filter(offer_id=self.foreign.offer_id).exists())
+        self.assertEqual(Offer.objects.count(), 3)
+
+    def test_each_malformed_item_gets_its_own_error(self):
+        results = self.bulk([
+            'offer',
+            {'action': 'move', 'offerId': self.own.offer_id},
+            {'action': 'delete', 'offerId': [self.own.offer_id]},
+            {'action': 'delete', 'offerId': {'id': self.own.offer_id}},
+            {'action': 'delete', 'offerId': str(self.own.offer_id)},
+            {'action': 'delete'},
+            self.create_item(exchangeRate=None),
+            self.create_item(fromAmount=[1]),
+            self.create_item(toCurrencyId=0),
+        ])
+
+        self.assertEqual([result['error'] for result in results], [
+            'Invalid offer', 'Invalid action', 'Invalid offerId', 'Invalid offerId', 'Invalid offerId',
+            'Some field(s) does not exist', 'Some field(s) does not exist', 'Invalid fromAmount',
+            'Currency does not exist'])
+        self.assertEqual(Offer.objects.count(), 2)
+
+    def test_an_offer_is_changed_once_per_request(self):
+        results = self.bulk([
+            {'action': 'update', 'offerId': self.own.offer_id, 'exchangeRate': 0.8},
+            {'action': 'delete', 'offerId': self.own.offer_id},
+        ])
+
+        self.assertEqual([result['status'] for result in results], ['updated', 'error'])
+        self.assertEqual(results[1]['error'], 'Offer appears more than once')
+        self.assertTrue(Offer.objects.filter(offer_id=self.own.offer_id).exists())
@@ -0,0 +1,192 @@
+from datetime import datetime
+from unittest import mock
+
+from django.core.cache import cache
+from django.db import DatabaseError, IntegrityError
+from django.test import TestCase
+
+from offer.ingest import MessagePipeline, MESSAGE_ID_KEY, message_ids, message_pipeline
+from offer.models import User, Currency, Offer, Session, SessionUser, Messages
+
+
+class MessagePipelineTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create(user_name='sender', user_rating=0)
+        self.receiver = User.objects.create(user_name='receiver', user_rating=0)
+        currency = Currency.objects.create(name='Dollar', capital_name='USD', unicode_symbol='$', color_hex='#000000')
+        offer = Offer.objects.create(from_currency=currency, to_currency=currency, from_amount=1, to_amount=1,
+                                     exchange_rate=1, user=self.sender)
+        self.session = Session.objects.create(session_owner=self.sender, offer=offer)
+        SessionUser.objects.bulk_create([SessionUser(session=self.session, user=self.sender),
+                                         SessionUser(session=self.session, user=self.receiver)])
+        # Batches are flushed by the tests, not by the timer
+        self.pipeline = MessagePipeline(batch_size=100, flush_interval=3600)
+
+    def submit(self, text, pipeline=None, minute=0):
+        return (pipeline or self.pipeline).submit(Messages(
+            message_sender=self.sender, message_session=self.session, message_text=text,
+            message_date=datetime(2023, 4, 1, 10, minute)))
+
+    def stored(self):
+        return list(Messages.objects.order_by('message_id').values_list('message_id', 'message_text'))
+
+    def test_rows_are_written_in_submission_order(self):
+        messages = [self.submit('message {}'.format(index), minute=index) for index in range(5)]
+        self.assertEqual(Messages.objects.count(), 0)
+
+        self.pipeline.flush()
+
+        self.assertEqual(self.stored(), [(message.message_id, message.message_text) for message in messages])
+        self.assertEqual([message.message_id for message in messages],
+                         sorted(message.message_id for message in messages))
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.last_message_date.minute, 4)
+
+    def test_ids_follow_submission_order_across_pipelines(self):
+        # Two workers submitting in turns
+        other = MessagePipeline(batch_size=100, flush_interval=3600)
+        messages = [self.submit('message {}'.format(index), pipeline=(self.pipeline, other)[index % 2])
+                    for index in range(6)]
+
+        ids = [message.message_id for message in messages]
+        self.assertEqual(ids, list(range(ids[0], ids[0] + 6)))
+
+    def test_full_batch_is_written_on_submit(self):
+        self.pipeline.batch_size = 3
+        for index in range(3):
+            self.submit('message {}'.format(index))
+
+        self.assertEqual(Messages.objects.count(), 3)
+        self.assertEqual(self.pipeline.pending, [])
+
+    def test_failed_batch_is_kept_at_the_head_of_the_queue(self):
+        first = self.submit('first')
+        with mock.patch.object(self.pipeline, 'store', side_effect=DatabaseError('gone away')):
+            with self.assertLogs('offer.ingest', 'ERROR'):
+                self.pipeline.try_flush()
+        self.assertEqual(self.pipeline.pending, [first])
+        self.assertEqual(Messages.objects.count(), 0)
+
+        second = self.submit('second')
+        self.pipeline.flush()
+        self.assertEqual(self.stored(), [(first.message_id, 'first'), (second.message_id, 'second')])
+
+    def test_drain_writes_every_queued_message(self):
+        self.pipeline.batch_size = 2
+        with mock.patch.object(self.pipeline, 'try_flush'):
+            # Full batches stay queued, as if their flush had not run yet
+            for index in range(5):
+                self.submit('message {}'.format(index))
+        self.assertEqual(len(self.pipeline.pending), 5)
+
+        self.pipeline.drain()
+
+        self.assertEqual(Messages.objects.count(), 5)
+        self.assertEqual(self.pipeline.pending, [])
+
+    def test_drain_keeps_the_queue_when_the_database_is_down(self):
+        messages = [self.submit('message {}'.format(index)) for index in range(3)]
+        with mock.patch.object(self.pipeline, 'store', side_effect=DatabaseError('gone away')):
+            with self.assertLogs('offer.ingest', 'ERROR'):
+                self.pipeline.drain()
+
+        self.assertEqual(self.pipeline.pending, messages)
+        self.assertEqual(Messages.objects.count(), 0)
+
+
+    def test_a_lost_counter_restarts_above_every_id_handed_out(self):
+        first = self.submit('first')
+        cache.delete(MESSAGE_ID_KEY)
+
+        self.assertGreater(self.submit('second').message_id, first.message_id)
+
+    def test_flushed_stops_below_the_messages_another_pipeline_has_not_stored(self):
+        other = MessagePipeline(batch_size=100, flush_interval=3600)
+        first = self.submit('first', pipeline=other)
+        second = self.submit('second')
+        self.pipeline.flush()
+        self.assertEqual(message_ids.flushed(), first.message_id - 1)
+
+        # A client reading the session now must not skip over the first message
+        response = self.client.get('/session/messages/', {
+            'userId': self.receiver.user_id, 'sessionId': self.session.session_id, 'sinceMessageId': 0})
+        self.assertEqual(response.json()['messages'], [])
+
+        other.flush()
+        self.assertEqual(message_ids.flushed(), second.message_id)
+        response = self.client.get('/session/messages/', {
+            'userId': self.receiver.user_id, 'sessionId': self.session.session_id, 'sinceMessageId': 0})
+        self.assertEqual([message['messageId'] for message in response.json()['messages']],
+                         [first.message_id, second.message_id])
+
+    def test_a_failed_write_keeps_the_slot(self):
+        message = self.submit('message')
+        with mock.patch.object(self.pipeline, 'store', side_effect=DatabaseError('gone away')):
+            with self.assertLogs('offer.ingest', 'ERROR'):
+                self.pipeline.try_flush()
+        self.assertEqual(message_ids.flushed(), message.message_id - 1)
+
+        self.pipeline.flush()
+        self.assertIsNone(self.pipeline.slot)
+        self.assertEqual(message_ids.flushed(), message.message_id)
+
+
+    def test_a_row_the_database_rejects_is_reported_to_the_session(self):
+        good = self.submit('good')
+        bad = self.pipeline.submit(Messages(message_sender=self.sender, message_session_id=self.session.session_id + 1,
+                                            message_text='bad', message_date=datetime(2023, 4, 1, 10)))
+        store = self.pipeline.store
+
+        def store_or_reject(batch):
+            # SQLite only checks foreign keys when the test's transaction commits
+            if bad in batch:
+                raise IntegrityError('FOREIGN KEY constraint failed')
+            store(batch)
+
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        with mock.patch.object(self.pipeline, 'store', side_effect=store_or_reject), \
+                mock.patch('offer.ingest.get_channel_layer', return_value=channel_layer):
+            with self.assertLogs('offer.ingest', 'ERROR'):
+                self.pipeline.flush()
+
+        self.assertEqual(self.stored(), [(good.message_id, 'good')])
+        channel_layer.group_send.assert_called_once_with('session_{}'.format(bad.message_session_id), {
+            'type': 'message_failed', 'sessionId': bad.message_session_id, 'messageId': bad.message_id})
+
+
+class SendMessageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create(user_name='sender', user_rating=0)
+        self.outsider = User.objects.create(user_name='outsider', user_rating=0)
+        currency = Currency.objects.create(name='Dollar', capital_name='USD', unicode_symbol='$', color_hex='#000000')
+        offer = Offer.objects.create(from_currency=currency, to_currency=currency, from_amount=1, to_amount=1,
+                                     exchange_rate=1, user=self.sender)
+        self.session = Session.objects.create(session_owner=self.sender, offer=offer)
+        SessionUser.objects.create(session=self.session, user=self.sender)
+        # Seeded once per deployment, not by the requests
+        message_ids.current()
+
+    def tearDown(self):
+        message_pipeline.drain()
+
+    def send(self, **fields):
+        data = {'senderId': self.sender.user_id, 'sessionId': self.session.session_id,
+                'messageDate': '2023-04-01 10:00:00', 'messageText': 'hello', **fields}
+        return self.client.post('/session/sendMessage/', data, content_type='application/json')
+
+    def test_a_message_is_queued_and_acknowledged(self):
+        self.assertEqual(self.send().status_code, 200)
+        message_pipeline.drain()
+        self.assertEqual(Messages.objects.get().message_text, 'hello')
+
+    def test_a_message_that_cannot_be_stored_is_refused(self):
+        for fields, status_code in (({'sessionId': self.session.session_id + 1}, 404),
+                                    ({'senderId': self.outsider.user_id}, 403),
+                                    ({'sessionId': 'first'}, 400),
+                                    ({'messageDate': 'yesterday'}, 400),
+                                    ({'messageText': 'x' * 1025}, 400)):
+            with self.subTest(fields=fields):
+                self.assertEqual(self.send(**fields).status_code, status_code)
+        self.assertEqual(message_pipeline.pending, [])
@@ -0,0 +1,200 @@
+import asyncio
+
+from channels.exceptions import ChannelFull
+from django.test import SimpleTestCase
+
+from offer.layers import HashRing, ShardedRedisChannelLayer
+from offer.localredis import LocalRedisServer
+
+
+class HashRingTests(SimpleTestCase):
+    def test_names_map_to_the_same_shard(self):
+        ring = HashRing(['a', 'b', 'c'])
+        other = HashRing(['a', 'b', 'c'])
+        names = ['group:{}'.format(index) for index in range(1000)]
+
+        self.assertEqual([ring.get(name) for name in names], [other.get(name) for name in names])
+
+    def test_names_are_spread_over_all_shards(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = [0, 0, 0]
+        for index in range(3000):
+            counts[ring.get('group:{}'.format(index))] += 1
+
+        for count in counts:
+            self.assertGreater(count, 600)
+
+    def test_a_new_shard_only_takes_names_from_the_others(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        names = ['group:{}'.format(index) for index in range(3000)]
+
+        moved = [name for name in names if before.get(name) != after.get(name)]
+        self.assertTrue(all(after.get(name) == 3 for name in moved))
+        self.assertLess(len(moved), len(names) / 2)
+
+
+class ShardedRedisChannelLayerTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.servers = [LocalRedisServer(), LocalRedisServer()]
+        cls.hosts = [server.start() for server in cls.servers]
+
+    @classmethod
+    def tearDownClass(cls):
+        for server in cls.servers:
+            server.stop()
+        super().tearDownClass()
+
+    def layer(self, **config):
+        return ShardedRedisChannelLayer(hosts=self.hosts, blpop_timeout=1, **config)
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), 5)
+
+    async def test_send_and_receive_on_a_plain_channel(self):
+        layer = self.layer()
+        try:
+            await layer.send('plain.channel', {'type': 'hello', 'value': 1})
+
+            self.assertEqual(await self.receive(layer, 'plain.channel'), {'type': 'hello', 'value': 1})
+        finally:
+            await layer.flush()
+            await layer.close()
+
+    async def test_send_and_receive_on_process_channels(self):
+        layer = self.layer()
+        try:
+            first, second = await layer.new_channel(), await layer.new_channel()
+            await layer.send(second, {'type': 'to.second'})
+            await layer.send(first, {'type': 'to.first'})
+
+            self.assertEqual(await self.receive(layer, first), {'type': 'to.first'})
+            self.assertEqual(await self.receive(layer, second), {'type': 'to.second'})
+        finally:
+            await layer.flush()
+            await layer.close()
+
+    async def test_group_send_reaches_every_member_across_layers(self):
+        # Two workers, each with more local members than the channel capacity
+        workers = [self.layer(), self.layer()]
+        try:
+            members = []
+            for layer in workers:
+                for _ in range(150):
+                    channel = await layer.new_channel()
+                    await layer.group_add('room', channel)
+                    members.append((layer, channel))
+            await layer.group_add('room', 'plain.member')
+
+            await workers[0].group_send('room', {'type': 'chat', 'text': 'hi'})
+
+            for layer, channel in members:
+                self.assertEqual(await self.receive(layer, channel), {'type': 'chat', 'text': 'hi'})
+            self.assertEqual(await self.receive(workers[1], 'plain.member'), {'type': 'chat', 'text': 'hi'})
+        finally:
+            await workers[0].flush()
+            for layer in workers:
+                await layer.close()
+
+    async def test_group_discard_stops_delivery(self):
+        layer = self.layer()
+        try:
+            kept, gone = await layer.new_channel(), await layer.new_channel()
+            await layer.group_add('room', kept)
+            await layer.group_add('room', gone)
+            await layer.group_discard('room', gone)
+
+            await layer.group_send('room', {'type': 'chat'})
+
+            self.assertEqual(await self.receive(layer, kept), {'type': 'chat'})
+            self.assertTrue(layer.buffers[gone].empty())
+        finally:
+            await layer.flush()
+            await layer.close()
+
+    async def test_send_to_a_full_plain_channel_raises(self):
+        layer = self.layer(capacity=2)
+        try:
+            await layer.send('plain.channel', {'index': 0})
+            await layer.send('plain.channel', {'index': 1})
+            with self.assertRaises(ChannelFull):
+                await layer.send('plain.channel', {'index': 2})
+
+            self.assertEqual(await self.receive(layer, 'plain.channel'), {'index': 0})
+            self.assertEqual(await self.receive(layer, 'plain.channel'), {'index': 1})
+        finally:
+            await layer.flush()
+            await layer.close()
+
+    async def test_concurrent_sends_near_capacity_keep_exactly_the_accepted_frames(self):
+        # Workers racing for the only free place of a channel that others keep
+        # emptying: a send is accepted if and only if its frame arrives
+        workers = [self.layer(capacity=1) for _ in range(4)]
+        key = workers[0].channel_key('plain.channel')
+        try:
+            async def send(index):
+                try:
+                    await workers[index % 2].send('plain.channel', {'index': index})
+                except ChannelFull:
+                    return None
+                return index
+
+            async def read(layer):
+                received = []
+                while True:
+                    index = (await self.receive(layer, 'plain.channel'))['index']
+                    if index is None:
+                        return received
+                    received.append(index)
+
+            readers = [asyncio.ensure_future(read(layer)) for layer in workers[2:]]
+            accepted = [index for index in await asyncio.gather(*(send(index) for index in range(500)))
+                        if index is not None]
+            # One end marker per reader, pushed directly past the capacity
+            for _ in readers:
+                await workers[0].connection(key).rpush(key, workers[0].frame(['plain.channel'],
+                                                                             workers[0].pack({'index': None})))
+            received = [index for reader in readers for index in await reader]
+
+            self.assertEqual(sorted(received), accepted)
+        finally:
+            await workers[0].flush()
+            for layer in workers:
+                await layer.close()
+
+    async def test_channel_capacity_applies_per_local_buffer(self):
+        layer = self.layer(capacity=2)
+        try:
+            slow, fast = await layer.new_channel(), await layer.new_channel()
+            await layer.group_add('room', slow)
+            await layer.group_add('room', fast)
+
+            for index in range(4):
+                await layer.group_send('room', {'index': index})
+                self.assertEqual(await self.receive(layer, fast), {'index': index})
+
+            # The slow member kept the first messages up to its capacity
+            self.assertEqual(await self.receive(layer, slow), {'index': 0})
+            self.assertEqual(await self.receive(layer, slow), {'index': 1})
+            self.assertTrue(layer.buffers[slow].empty())
+        finally:
+            await layer.flush()
+            await layer.close()
+
+    async def test_group_send_skips_a_full_plain_channel(self):
+        layer = self.layer(channel_capacity={'plain.full': 1})
+        try:
+            await layer.group_add('room', 'plain.full')
+            await layer.group_add('room', 'plain.other')
+
+            await layer.group_send('room', {'index': 0})
+            await layer.group_send('room', {'index': 1})
+
+            self.assertEqual(await self.receive(layer, 'plain.full'), {'index': 0})
+            self.assertEqual(await self.receive(layer, 'plain.other'), {'index': 0})
+            self.assertEqual(await self.receive(layer, 'plain.other'), {'index': 1})
+        finally:
+            await layer.flush()
+            await layer.close()
@@ -0,0 +1,132 @@
+import json
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+
+from offer.consumers import TextRoomConsumer
+from offer.ingest import message_ids
+from offer.models import User, Currency, Offer, Session, SessionUser, Messages
+
+
+class MessageHistoryTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create(user_name='owner', user_rating=0)
+        self.other = User.objects.create(user_name='other', user_rating=0)
+        currency = Currency.objects.create(name='Dollar', capital_name='USD', unicode_symbol='$', color_hex='#000000')
+        offer = Offer.objects.create(from_currency=currency, to_currency=currency, from_amount=1, to_amount=1,
+                                     exchange_rate=1, user=self.owner)
+        self.session = Session.objects.create(session_owner=self.owner, offer=offer)
+        SessionUser.objects.bulk_create([SessionUser(session=self.session, user=self.owner),
+                                         SessionUser(session=self.session, user=self.other)])
+        # Messages sent within the same second share their date
+        started = datetime(2023, 4, 1, 10)
+        Messages.objects.bulk_create([
+            Messages(message_sender=self.owner, message_session=self.session, message_text='Message {}'.format(index),
+                     message_date=started + timedelta(seconds=index // 3))
+            for index in range(7)
+        ])
+        self.message_ids = list(Messages.objects.order_by('message_date', 'message_id')
+                                .values_list('message_id', flat=True))
+        cache.clear()
+        # Seeded once per deployment, not by the requests
+        message_ids.current()
+
+    def get(self, **params):
+        response = self.client.get('/session/messages/', {
+            'userId': self.owner.user_id, 'sessionId': self.session.session_id, 'limit': 2, **params})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [message['messageId'] for message in data['messages']], data['hasMore'], data['nextCursor']
+
+    def test_history_pages_walk_back_from_the_newest_message_through_equal_dates(self):
+        pages = []
+        page, has_more, cursor = self.get()
+        pages.append(page)
+        while has_more:
+            page, has_more, cursor = self.get(cursor=cursor)
+            pages.append(page)
+
+        self.assertIsNone(cursor)
+        self.assertEqual(pages[0], self.message_ids[-2:])
+        self.assertEqual([message_id for page in reversed(pages) for message_id in page], self.message_ids)
+
+    def test_a_message_sent_while_paging_does_not_shift_older_pages(self):
+        first, _, cursor = self.get()
+        Messages.objects.create(message_sender=self.other, message_session=self.session, message_text='Late',
+                                message_date=datetime(2023, 4, 1, 11))
+
+        second, _, _ = self.get(cursor=cursor)
+        self.assertEqual(second + first, self.message_ids[-4:])
+
+    def test_delta_mode_returns_what_follows_a_message_oldest_first(self):
+        page, has_more, cursor = self.get(sinceMessageId=self.message_ids[2])
+        self.assertEqual((page, has_more, cursor), (self.message_ids[3:5], True, None))
+
+        page, has_more, _ = self.get(sinceMessageId=page[-1])
+        self.assertEqual((page, has_more), (self.message_ids[5:7], False))
+
+    def test_malformed_paging_parameters_are_rejected(self):
+        for params in ({'cursor': 'not a cursor'}, {'sinceMessageId': 'last'}, {'limit': 0}):
+            with self.subTest(params=params):
+                response = self.client.get('/session/messages/', {
+                    'userId': self.owner.user_id, 'sessionId': self.session.session_id, **params})
+                self.assertEqual(response.status_code, 400)
+
+
+class MarkReadTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create(user_name='owner', user_rating=0)
+        currency = Currency.objects.create(name='Dollar', capital_name='USD', unicode_symbol='$', color_hex='#000000')
+        offer = Offer.objects.create(from_currency=currency, to_currency=currency, from_amount=1, to_amount=1,
+                                     exchange_rate=1, user=self.owner)
+        self.session = Session.objects.create(session_owner=self.owner, offer=offer)
+        SessionUser.objects.create(session=self.session, user=self.owner, last_read_message_id=5)
+
+    def mark_read(self, session_id, message_id):
+        return self.client.post('/session/markRead/?userId={}&sessionId={}&messageId={}'.format(
+            self.owner.user_id, session_id, message_id))
+
+    def last_read(self):
+        return SessionUser.objects.get().last_read_message_id
+
+    def test_the_read_marker_only_moves_forward(self):
+        self.assertEqual(self.mark_read(self.session.session_id, 3).status_code, 200)
+        self.assertEqual(self.last_read(), 5)
+        self.assertEqual(self.mark_read(self.session.session_id, 7).status_code, 200)
+        self.assertEqual(self.last_read(), 7)
+
+    def test_non_numeric_ids_are_rejected(self):
+        for session_id, message_id in ((self.session.session_id, 'last'), ('first', 7)):
+            with self.subTest(session_id=session_id, message_id=message_id):
+                response = self.mark_read(session_id, message_id)
+                self.assertEqual((response.status_code, response.json()), (400, ['Invalid field(s)']))
+        self.assertEqual(self.last_read(), 5)
+
+
+class SocketErrorTests(SimpleTestCase):
+    def setUp(self):
+        self.consumer = TextRoomConsumer()
+        self.consumer.user_id = 1
+        self.consumer.channel_layer = mock.Mock(group_add=mock.AsyncMock())
+        self.consumer.channel_name = 'socket'
+        self.consumer.send = mock.AsyncMock()
+
+    async def error(self, request_type, data):
+        await self.consumer.receive(json.dumps({'type': request_type, 'clientMessageId': 'request', 'data': data}))
+        frame = json.loads(self.consumer.send.call_args.kwargs['text_data'])
+        self.assertEqual((frame['responseType'], frame['clientMessageId']), ('error', 'request'))
+        return frame['error']
+
+    async def test_a_non_numeric_message_id_is_rejected_before_the_database(self):
+        with mock.patch('offer.consumers.database_sync_to_async') as database_sync_to_async:
+            self.assertEqual(await self.error('markRead', {'sessionId': 1, 'messageId': 'last'}),
+                             ['Invalid field(s)'])
+        database_sync_to_async.assert_not_called()
+
+    async def test_errors_do_not_echo_the_exception_text(self):
+        self.assertEqual(await self.error('subscribeBook', {'fromCurrencyId': 'x', 'toCurrencyId': 1}),
+                         'Invalid field(s)')
+        with mock.patch.object(self.consumer, 'receive_heartbeat', side_effect=User.DoesNotExist('User 1 ...')):
+            self.assertEqual(await self.error('heartbeat', {}), 'Not found')
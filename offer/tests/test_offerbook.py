@@ -0,0 +1,73 @@
+from django.core.cache import cache
+from django.test import TestCase
+
+from offer.models import User, Currency, Offer
+from offer.responsecache import response_cache
+
+
+class OfferBookTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        response_cache.clear()
+        self.user = User.objects.create(user_name='user', user_rating=0)
+        self.dollar, self.euro = Currency.objects.bulk_create([
+            Currency(name=name, capital_name=name, unicode_symbol='$', color_hex='#000000')
+            for name in ('Dollar', 'Euro')
+        ])
+        # Most offers share a rate, so pages have to split between equal rates
+        Offer.objects.bulk_create([
+            Offer(from_currency=from_currency, to_currency=to_currency, from_amount=from_amount,
+                  to_amount=from_amount * exchange_rate, exchange_rate=exchange_rate, user=self.user)
+            for from_currency, to_currency, exchange_rate, from_amount in (
+                (self.dollar, self.euro, 2, 10), (self.dollar, self.euro, 1, 20), (self.dollar, self.euro, 2, 30),
+                (self.dollar, self.dollar, 2, 40), (self.dollar, self.euro, 2, 50), (self.euro, self.dollar, 1, 60),
+                (self.dollar, self.euro, 3, 70))
+        ])
+
+    def page(self, cursor=None, **filters):
+        response = self.client.get('/offer/book/', {
+            'userId': self.user.user_id, 'limit': 2, **({'cursor': cursor} if cursor is not None else {}), **filters})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [offer['offerId'] for offer in data['offers']], data['nextCursor']
+
+    def pages(self, **filters):
+        offer_ids, cursor = self.page(**filters)
+        while cursor is not None:
+            more, cursor = self.page(cursor, **filters)
+            offer_ids += more
+        return offer_ids
+
+    def ordered(self, offers):
+        return list(offers.order_by('exchange_rate', 'offer_id').values_list('offer_id', flat=True))
+
+    def test_pages_walk_the_book_once_in_rate_order(self):
+        self.assertEqual(self.pages(), self.ordered(Offer.objects.all()))
+
+    def test_filters_apply_to_every_page(self):
+        for filters in ({'fromCurrencyId': self.dollar.currency_id},
+                        {'fromCurrencyId': self.dollar.currency_id, 'toCurrencyId': self.euro.currency_id},
+                        {'toCurrencyId': self.dollar.currency_id},
+                        {'creatorId': self.user.user_id, 'minAmount': 20, 'maxAmount': 60}):
+            with self.subTest(filters=filters):
+                offers = Offer.objects.all()
+                if 'fromCurrencyId' in filters:
+                    offers = offers.filter(from_currency=self.dollar)
+                if 'toCurrencyId' in filters:
+                    offers = offers.filter(to_currency_id=filters['toCurrencyId'])
+                if 'minAmount' in filters:
+                    offers = offers.filter(from_amount__gte=20, from_amount__lte=60)
+                self.assertEqual(self.pages(**filters), self.ordered(offers))
+
+    def test_an_offer_added_behind_the_cursor_does_not_shift_later_pages(self):
+        expected = self.ordered(Offer.objects.all())[:4]
+        first, cursor = self.page()
+        Offer.objects.create(from_currency=self.dollar, to_currency=self.euro, from_amount=1, to_amount=0.5,
+                             exchange_rate=0.5, user=self.user)
+
+        rest, _ = self.page(cursor)
+        self.assertEqual(first + rest, expected)
+
+    def test_a_malformed_cursor_is_rejected(self):
+        response = self.client.get('/offer/book/', {'userId': self.user.user_id, 'cursor': 'not a cursor'})
+        self.assertEqual(response.status_code, 400)
@@ -0,0 +1,99 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase
+
+from offer.indexfeed import index_feed
+from offer.models import User, Currency, Offer
+from offer.orderbook import OrderBook, OrderBooks
+
+
+class OrderBookTests(SimpleTestCase):
+    def setUp(self):
+        self.book = OrderBook()
+        for offer_id, exchange_rate in ((1, 2.0), (2, 1.5), (3, 2.0), (4, 0.5)):
+            self.book.add(offer_id, exchange_rate)
+
+    def test_best_offers_come_lowest_rate_first_and_oldest_first_at_equal_rates(self):
+        self.assertEqual(self.book.best(10), [4, 2, 1, 3])
+        self.assertEqual(self.book.best(2), [4, 2])
+
+    def test_max_rate_includes_offers_at_that_rate(self):
+        self.assertEqual(self.book.best(10, max_rate=2.0), [4, 2, 1, 3])
+        self.assertEqual(self.book.best(10, max_rate=1.9), [4, 2])
+        self.assertEqual(self.book.best(10, max_rate=0.1), [])
+
+    def test_adding_an_offer_again_moves_it_to_its_new_rate(self):
+        self.book.add(1, 0.1)
+
+        self.assertEqual(self.book.best(10), [1, 4, 2, 3])
+        self.assertEqual(len(self.book), 4)
+
+    def test_removing_takes_out_only_that_offer(self):
+        self.book.remove(1)
+        self.book.remove(1)
+        self.book.remove(99)
+
+        self.assertEqual(self.book.best(10), [4, 2, 3])
+        self.assertEqual(len(self.book), 3)
+
+
+class OrderBooksTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(user_name='user', user_rating=0)
+        self.dollar, self.euro = Currency.objects.bulk_create([
+            Currency(name=name, capital_name=name, unicode_symbol='$', color_hex='#000000')
+            for name in ('Dollar', 'Euro')
+        ])
+        self.offers = [Offer.objects.create(from_currency=from_currency, to_currency=to_currency, from_amount=1,
+                                            to_amount=exchange_rate, exchange_rate=exchange_rate, user=self.user)
+                       for from_currency, to_currency, exchange_rate in ((self.dollar, self.euro, 3),
+                                                                         (self.dollar, self.euro, 1),
+                                                                         (self.euro, self.dollar, 2))]
+        self.books = OrderBooks()
+
+    def best(self, from_currency, to_currency):
+        return self.books.best(from_currency.currency_id, to_currency.currency_id, 10)
+
+    def test_the_first_use_loads_every_pair_from_the_offers(self):
+        self.assertEqual(self.best(self.dollar, self.euro), [self.offers[1].offer_id, self.offers[0].offer_id])
+        self.assertEqual(self.best(self.euro, self.dollar), [self.offers[2].offer_id])
+        self.assertEqual(self.best(self.euro, self.euro), [])
+
+    def test_an_update_moves_edited_offers_between_pairs_and_is_published(self):
+        self.books.ensure_loaded()
+        moved = self.offers[2]
+        moved.from_currency, moved.to_currency = self.dollar, self.euro
+        with mock.patch.object(index_feed, 'publish') as publish:
+            self.books.update([moved], [self.offers[1].offer_id])
+
+        publish.assert_called_once_with('order_books.changed', removed=[self.offers[1].offer_id], offers=[
+            (moved.offer_id, self.dollar.currency_id, self.euro.currency_id, 2.0)])
+        self.assertEqual(self.best(self.dollar, self.euro), [moved.offer_id, self.offers[0].offer_id])
+        self.assertEqual(self.best(self.euro, self.dollar), [])
+
+    def test_a_change_by_another_worker_is_applied(self):
+        self.books.ensure_loaded()
+
+        self.books.apply({'type': 'order_books.changed', 'removed': [self.offers[0].offer_id],
+                          'offers': [[99, self.dollar.currency_id, self.euro.currency_id, 0.5]]})
+
+        self.assertEqual(self.best(self.dollar, self.euro), [99, self.offers[1].offer_id])
+
+    def test_changes_before_the_first_load_are_left_to_the_load(self):
+        self.books.apply({'type': 'order_books.changed', 'removed': [self.offers[0].offer_id], 'offers': []})
+
+        self.assertFalse(self.books.loaded)
+        self.assertEqual(self.best(self.dollar, self.euro), [self.offers[1].offer_id, self.offers[0].offer_id])
+
+    def test_warming_loads_the_books_in_the_background(self):
+        with mock.patch('offer.orderbook.threading.Thread') as thread, \
+                mock.patch('offer.orderbook.connection') as connection:
+            self.books.warm()
+            self.assertFalse(self.books.loaded)
+            # Run in this thread, which can see the rows of the test
+            thread.call_args.kwargs['target']()
+
+        thread.return_value.start.assert_called_once_with()
+        connection.close.assert_called_once_with()
+        self.assertTrue(self.books.loaded)
+        self.assertEqual(len(self.books.books[(self.dollar.currency_id, self.euro.currency_id)]), 2)
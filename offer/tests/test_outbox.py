@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from obmennik.view import replayOutbox, sendSessionEvent, SessionModelToSessionEvent, SessionEventToFrame, \
+    MessageModelToMessageEvent, MessageJsonToFrame
+from offer.ingest import MessagePipeline, message_ids
+from offer.models import User, Currency, Offer, Session, SessionUser, Messages, OutboxEvent
+from offer.outbox import Outbox, outbox
+from offer.presence import presence
+
+
+class OutboxTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.sender = User.objects.create(user_name='sender', user_rating=0)
+        self.receiver = User.objects.create(user_name='receiver', user_rating=0)
+        currency = Currency.objects.create(name='Dollar', capital_name='USD', unicode_symbol='$', color_hex='#000000')
+        offer = Offer.objects.create(from_currency=currency, to_currency=currency, from_amount=1, to_amount=1,
+                                     exchange_rate=1, user=self.sender)
+        self.session = Session.objects.create(session_owner=self.sender, offer=offer)
+        SessionUser.objects.bulk_create([SessionUser(session=self.session, user=self.sender),
+                                         SessionUser(session=self.session, user=self.receiver)])
+        self.pipeline = MessagePipeline(batch_size=100, flush_interval=3600)
+
+    def send(self, text):
+        message = self.pipeline.submit(Messages(
+            message_sender=self.sender, message_session=self.session, message_text=text,
+            message_date=datetime(2023, 4, 1, 10)))
+        self.pipeline.flush()
+        return message
+
+    def replayed_ids(self, user, since):
+        events, complete = outbox.replay(user.user_id, since, message_ids.flushed())
+        return [event.message_id for event in events], complete
+
+    def test_messages_are_queued_for_every_participant_online_or_not(self):
+        with mock.patch.object(presence, 'online', side_effect=lambda user_ids: set(user_ids)):
+            message = self.send('hello')
+
+        self.assertEqual(self.replayed_ids(self.receiver, 0), ([message.message_id], True))
+        # The sender's other devices see their own message too
+        self.assertEqual(self.replayed_ids(self.sender, 0), ([message.message_id], True))
+
+    def test_replaying_on_one_device_leaves_the_frames_of_another(self):
+        first = self.send('first')
+        _, phone_seq, _ = replayOutbox(self.receiver.user_id, 0)
+        second = self.send('second')
+
+        # The phone resumes after what it saw, the laptop has been away longer
+        self.assertEqual(self.replayed_ids(self.receiver, phone_seq), ([second.message_id], True))
+        self.assertEqual(self.replayed_ids(self.receiver, 0), ([first.message_id, second.message_id], True))
+
+    def test_a_fresh_socket_resumes_from_the_latest_event(self):
+        self.send('before')
+        frames, seq, complete = replayOutbox(self.receiver.user_id, None)
+        self.assertEqual((frames, complete), ([], True))
+        after = self.send('after')
+
+        self.assertEqual(self.replayed_ids(self.receiver, seq), ([after.message_id], True))
+
+    def test_replay_past_the_size_bound_is_incomplete(self):
+        small = Outbox(size=2)
+        messages = [self.send('message {}'.format(index)) for index in range(3)]
+
+        events, complete = small.replay(self.receiver.user_id, 0, message_ids.flushed())
+        self.assertEqual([event.message_id for event in events], [message.message_id for message in messages[:2]])
+        self.assertFalse(complete)
+
+    def test_prune_drops_expired_frames_and_marks_older_replays_incomplete(self):
+        old = self.send('old')
+        OutboxEvent.objects.update(created=timezone.now() - timedelta(seconds=outbox.ttl + 1))
+        _, seq, _ = replayOutbox(self.receiver.user_id, None)
+        new = self.send('new')
+
+        self.assertEqual(outbox.prune(), 2)
+
+        self.assertEqual(self.replayed_ids(self.receiver, 0), ([new.message_id], False))
+        self.assertEqual(self.replayed_ids(self.receiver, seq), ([new.message_id], True))
+        self.assertFalse(OutboxEvent.objects.filter(message=old).exists())
+
+    def test_live_frames_carry_the_seq_they_are_replayed_under(self):
+        message = self.send('hello')
+        message_event = MessageModelToMessageEvent(Messages.objects.get(message_id=message.message_id))
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        session_event = SessionModelToSessionEvent(self.session, 'close_session')
+        sendSessionEvent(channel_layer, ['session_{}'.format(self.session.session_id)], session_event,
+                         [self.receiver.user_id])
+        channel_layer.group_send.assert_called_once_with('session_{}'.format(self.session.session_id), session_event)
+
+        frames, seq, complete = replayOutbox(self.receiver.user_id, message.message_id - 1)
+        self.assertEqual(frames, [MessageJsonToFrame(message_event['message'], message_event['seq']),
+                                  SessionEventToFrame(session_event, self.receiver.user_id)])
+        self.assertEqual((seq, complete), (session_event['seq'], True))
+        self.assertEqual(replayOutbox(self.receiver.user_id, seq), ([], seq, True))
+
+    def test_replay_waits_for_frames_numbered_before_the_socket_connected(self):
+        stored = self.send('stored')
+        queued = self.pipeline.submit(Messages(
+            message_sender=self.sender, message_session=self.session, message_text='queued',
+            message_date=datetime(2023, 4, 1, 10)))
+
+        # Still queued when the wait runs out: the socket has to reload
+        with mock.patch('obmennik.view.OUTBOX_REPLAY_WAIT', 0):
+            frames, seq, complete = replayOutbox(self.receiver.user_id, 0)
+        self.assertEqual((len(frames), seq, complete), (1, stored.message_id, False))
+
+        self.pipeline.flush()
+        frames, seq, complete = replayOutbox(self.receiver.user_id, stored.message_id)
+        self.assertEqual((len(frames), seq, complete), (1, queued.message_id, True))
@@ -0,0 +1,54 @@
+import os
+import tempfile
+from unittest import mock
+
+from django.db import connection, DatabaseError
+from django.test import SimpleTestCase
+
+from obmennik.backends.pool import ConnectionPool
+from obmennik.backends.sqlite3.base import DatabaseWrapper
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    def setUp(self):
+        # The test database lives in memory and Django never closes it, so the
+        # wrapper gets a file of its own
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_dict = {**connection.settings_dict, 'NAME': os.path.join(directory.name, 'pool.sqlite3')}
+        self.wrapper = DatabaseWrapper(settings_dict, alias='pool')
+        self.addCleanup(self.wrapper.close)
+        self.pool = ConnectionPool(size=2)
+        patcher = mock.patch.object(DatabaseWrapper, 'pool', new_callable=mock.PropertyMock, return_value=self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def reopen(self):
+        self.wrapper.ensure_connection()
+        return self.wrapper.connection
+
+    def test_a_closed_connection_is_reused(self):
+        first = self.reopen()
+        self.wrapper.close()
+
+        self.assertIs(self.reopen(), first)
+
+    def test_a_connection_closed_after_an_error_is_discarded(self):
+        first = self.reopen()
+        self.wrapper.errors_occurred = True
+        self.wrapper.close()
+
+        self.assertEqual(self.pool.idle, [])
+        self.assertIsNot(self.reopen(), first)
+
+    def test_a_connection_that_cannot_roll_back_is_discarded(self):
+        first = self.reopen()
+        self.wrapper.set_autocommit(False)
+        # The server went away in the middle of the transaction
+        first.close()
+
+        with self.assertRaises(DatabaseError):
+            self.wrapper.close()
+
+        self.assertEqual(self.pool.idle, [])
+        self.assertIsNot(self.reopen(), first)
@@ -0,0 +1,40 @@
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from offer.responsecache import ResponseCache
+
+
+class ResponseCacheTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        # Two workers sharing the Django cache
+        self.worker, self.other = ResponseCache(), ResponseCache()
+
+    def store(self, response_cache, user_id):
+        key = response_cache.key(user_id, 'user/info/', [('userId', str(user_id))])
+        response_cache.set(key, '"etag"', b'{}')
+        return key
+
+    def test_entry_is_served_until_the_user_is_invalidated(self):
+        self.store(self.worker, 1)
+        self.assertEqual(self.worker.get(self.worker.key(1, 'user/info/', [('userId', '1')])), ('"etag"', b'{}'))
+
+        self.worker.invalidate([1])
+
+        self.assertIsNone(self.worker.get(self.worker.key(1, 'user/info/', [('userId', '1')])))
+
+    def test_invalidation_reaches_other_workers(self):
+        self.store(self.other, 1)
+        self.store(self.other, 2)
+
+        self.worker.invalidate([1])
+
+        self.assertIsNone(self.other.get(self.other.key(1, 'user/info/', [('userId', '1')])))
+        self.assertIsNotNone(self.other.get(self.other.key(2, 'user/info/', [('userId', '2')])))
+
+    def test_a_key_taken_before_an_invalidation_stays_outdated(self):
+        key = self.worker.key(1, 'user/info/', [('userId', '1')])
+        self.worker.invalidate([1])
+        self.worker.set(key, '"etag"', b'{}')
+
+        self.assertIsNone(self.worker.get(self.worker.key(1, 'user/info/', [('userId', '1')])))
@@ -0,0 +1,42 @@
+from unittest import mock
+
+from django.test import TestCase
+
+from offer.indexfeed import index_feed
+from offer.models import User
+from offer.search import SearchIndex
+
+
+class SearchIndexTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(user_name='Anna Petrova', user_rating=0)
+        self.index = SearchIndex()
+
+    def test_finds_users_by_the_prefix_of_any_word(self):
+        self.assertEqual(self.index.search_users('pet', 10), [self.user.user_id])
+        self.assertEqual(self.index.search_users('anna p', 10), [self.user.user_id])
+        self.assertEqual(self.index.search_users('etrova', 10), [])
+
+    def test_a_rename_is_published_to_the_other_workers(self):
+        self.index.ensure_loaded()
+        self.user.user_name = 'Olga Smirnova'
+        with mock.patch.object(index_feed, 'publish') as publish:
+            self.index.add_user(self.user)
+
+        publish.assert_called_once_with('search.users_changed', users=[[self.user.user_id, 'Olga Smirnova']])
+        self.assertEqual(self.index.search_users('olga', 10), [self.user.user_id])
+        self.assertEqual(self.index.search_users('anna', 10), [])
+
+    def test_a_rename_by_another_worker_is_applied(self):
+        self.index.ensure_loaded()
+
+        self.index.apply({'type': 'search.users_changed', 'users': [[self.user.user_id, 'Olga Smirnova']]})
+
+        self.assertEqual(self.index.search_users('smir', 10), [self.user.user_id])
+        self.assertEqual(self.index.search_users('pet', 10), [])
+
+    def test_changes_before_the_first_load_are_left_to_the_load(self):
+        self.index.apply({'type': 'search.users_changed', 'users': [[self.user.user_id, 'Olga Smirnova']]})
+
+        self.assertIsNone(self.index.users)
+        self.assertEqual(self.index.search_users('anna', 10), [self.user.user_id])
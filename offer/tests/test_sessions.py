@@ -0,0 +1,90 @@
+from datetime import datetime
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from obmennik.renderers import dumps_text
+from obmennik.view import SessionViewSet, SessionModelsToSharedSessionData, SharedSessionDataToSessionData, \
+    SharedSessionDataToEncodedSession, EncodedSessionToSessionJson
+from offer.ingest import message_pipeline, message_ids
+from offer.models import User, Currency, Offer, Session, SessionUser, Messages
+
+
+class EncodedSessionTests(TestCase):
+    def setUp(self):
+        # Text that looks like the markers the encoding once searched for
+        self.owner = User.objects.create(user_name='\x00isOnWatchlist\x00', user_rating=0)
+        self.other = User.objects.create(user_name='\\u0000sessionType\\u0000 "sessionUsers"', user_rating=0)
+        currency = Currency.objects.create(name='\x00sessionUnreadCount\x00', capital_name='USD', unicode_symbol='$',
+                                           color_hex='#000000')
+        offer = Offer.objects.create(from_currency=currency, to_currency=currency, from_amount=1, to_amount=1,
+                                     exchange_rate=1, user=self.owner)
+        self.session = Session.objects.create(session_owner=self.owner, offer=offer)
+        SessionUser.objects.bulk_create([SessionUser(session=self.session, user=self.owner),
+                                         SessionUser(session=self.session, user=self.other)])
+        Messages.objects.create(message_sender=self.other, message_session=self.session,
+                                message_text='\x00sessionUsers\x00,"isOnWatchlist":', message_date=datetime(2023, 4, 1))
+
+    def test_each_viewer_gets_the_session_data_as_encoded_in_one_go(self):
+        data = SessionModelsToSharedSessionData([self.session])[0]
+        encoded = SharedSessionDataToEncodedSession(data)
+
+        for user_id, is_on_watchlist, unread_count in ((self.owner.user_id, False, 0),
+                                                       (self.other.user_id, True, 3)):
+            with self.subTest(user_id=user_id):
+                self.assertEqual(
+                    EncodedSessionToSessionJson(encoded, user_id, self.owner.user_id, is_on_watchlist, unread_count),
+                    dumps_text(SharedSessionDataToSessionData(data, user_id, self.owner.user_id, is_on_watchlist,
+                                                              unread_count)))
+
+
+class CreateSessionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create(user_name='owner', user_rating=0)
+        self.other = User.objects.create(user_name='other', user_rating=0)
+        self.outsider = User.objects.create(user_name='outsider', user_rating=0)
+        currency = Currency.objects.create(name='Dollar', capital_name='USD', unicode_symbol='$', color_hex='#000000')
+        self.offer = Offer.objects.create(from_currency=currency, to_currency=currency, from_amount=1, to_amount=1,
+                                          exchange_rate=1, user=self.owner)
+        # Seeded once per deployment, not by the requests
+        message_ids.current()
+
+    def tearDown(self):
+        message_pipeline.drain()
+
+    def create(self, **message):
+        return self.client.post('/session/create/', {
+            'ownerId': self.owner.user_id, 'userIds': [self.owner.user_id, self.other.user_id],
+            'offerId': self.offer.offer_id, 'initialMessage': {
+                'senderId': self.owner.user_id, 'messageDate': '2023-04-01 10:00:00', 'messageText': 'hello', **message}
+        }, content_type='application/json')
+
+    def test_the_session_is_created_with_its_initial_message(self):
+        self.assertEqual(self.create().status_code, 200)
+        message_pipeline.drain()
+
+        session = Session.objects.get()
+        self.assertEqual(set(session.sessionuser_set.values_list('user_id', flat=True)),
+                         {self.owner.user_id, self.other.user_id})
+        self.assertEqual(Messages.objects.get().message_session_id, session.session_id)
+
+    def test_a_bad_initial_message_leaves_no_session_behind(self):
+        for message, status_code in (({'messageDate': 'yesterday'}, 400),
+                                     ({'messageText': None}, 400),
+                                     ({'messageText': 'x' * 1025}, 400),
+                                     ({'senderId': self.outsider.user_id}, 403)):
+            with self.subTest(message=message):
+                self.assertEqual(self.create(**message).status_code, status_code)
+        self.assertFalse(Session.objects.exists())
+        self.assertEqual(message_pipeline.pending, [])
+
+    def test_every_participant_is_sent_the_session_whatever_presence_says(self):
+        # Nobody is registered as online
+        channel_layer = mock.Mock(group_send=mock.AsyncMock())
+        with mock.patch.object(SessionViewSet, 'channel_layer', channel_layer):
+            self.assertEqual(self.create().status_code, 200)
+
+        self.assertEqual({call.args[0] for call in channel_layer.group_send.call_args_list},
+                         {'user_{}'.format(self.owner.user_id), 'user_{}'.format(self.other.user_id)})